@@ -5,12 +5,31 @@
 نسخه Flask
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, session, stream_with_context, g, has_app_context
+from werkzeug.exceptions import NotFound
+from werkzeug.local import LocalProxy
+from jinja2 import FileSystemBytecodeCache
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+import click
+import contextlib
+import cProfile
+import csv
 import sqlite3
 import datetime
+import functools
+import hmac
+import multiprocessing
+import queue
+import threading
+import time
 import os
 import io
+import pstats
+import re
 import json
+import math
+import zlib
 import base64
 
 try:
@@ -20,6 +39,25 @@ except ImportError:
     os.system('pip install jdatetime')
     import jdatetime
 
+try:
+    import numpy as np
+except ImportError:
+    print("Installing numpy...")
+    os.system('pip install numpy')
+    import numpy as np
+
+# فشرده‌سازی brotli اختیاری است؛ بدون آن gzip استفاده می‌شود
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# سریال‌سازی سریع JSON در API نسخه ۱ اختیاری است؛ بدون آن json استاندارد
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     import barcode
     from barcode.writer import ImageWriter
@@ -32,9 +70,95 @@ except ImportError:
 app = Flask(__name__)
 app.secret_key = 'nyto-warehouse-secret-key-2024'
 
+# ارسال تدریجی صفحات لیست و فشرده‌سازی پاسخ‌ها (پاسخ‌های کوچک‌تر از حد آستانه فشرده نمی‌شوند)
+app.config['STREAM_TEMPLATES'] = os.environ.get('STREAM_TEMPLATES', '1') != '0'
+app.config['COMPRESS_RESPONSES'] = os.environ.get('COMPRESS_RESPONSES', '1') != '0'
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+
 # مسیر دیتابیس
 DB_PATH = os.environ.get('DB_PATH', 'data/warehouse.db')
 
+# کش bytecode قالب‌ها کنار دیتابیس: بین workerها و بعد از restart مشترک است (خالی: غیرفعال)
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR', os.path.join(os.path.dirname(DB_PATH) or '.', 'jinja_cache'))
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# انتظار برای قفل دیتابیس (ثانیه) و پنجره جمع‌آوری نوشتن‌ها برای یک commit (میلی‌ثانیه)
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 15))
+WRITE_BATCH_WINDOW_MS = float(os.environ.get('WRITE_BATCH_WINDOW_MS', 2))
+
+# تعداد اتصال‌های فقط خواندنی نگه‌داشته شده برای گزارش‌ها (در هر پروسه)
+READ_POOL_SIZE = int(os.environ.get('READ_POOL_SIZE', 8))
+
+# مدت نگهداری کلیدهای یکتایی اسکن (روز) و حداکثر اسکن در هر درخواست دسته‌ای
+SCAN_KEY_RETENTION_DAYS = 30
+SCAN_BATCH_LIMIT = 200
+
+# حداکثر شماره سفارش یا ردیف در هر درخواست برگشت دسته‌ای
+RETURN_BATCH_LIMIT = 1000
+
+# لات‌های FIFO نگه‌داشته شده در حافظه هر worker (تعداد محصول) و تعداد تغییرات لات نگه‌داشته شده برای همگام‌سازی
+FIFO_CACHE_PRODUCTS = int(os.environ.get('FIFO_CACHE_PRODUCTS', 4096))
+FIFO_CHANGES_KEEP = 10000
+
+# جدول‌هایی که تغییراتشان در ژورنال ثبت و به نسخه آماده (standby) منتقل می‌شود
+# (جدول‌های مشتق‌شده مثل dirty ها، پیش‌بینی‌ها و app_meta قابل بازسازی هستند)
+JOURNAL_TABLES = ('products', 'inflows', 'sales_centers', 'commission_categories', 'commissions',
+                  'product_categories', 'outflows', 'settlements', 'cash_transactions', 'settlement_allocations',
+                  'fiscal_closings', 'fiscal_closing_centers', 'fiscal_closing_products', 'exchange_rates',
+                  'scan_requests', 'outflow_lots')
+STANDBY_DIR = os.environ.get('STANDBY_DIR', os.path.join(os.path.dirname(DB_PATH) or '.', 'standby'))
+
+# پروفایل درخواست‌ها: فقط با PROFILE_TOKEN (مدیر) و هدر X-Profile یا ?_profile=1 فعال می‌شود
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILES_DIR = os.environ.get('PROFILES_DIR', os.path.join(os.path.dirname(DB_PATH) or '.', 'profiles'))
+PROFILE_KEEP = 200
+PROFILE_TOP = 30
+
+# چند برند در یک استقرار: مسیریابی مستأجر بر اساس host یا پیشوند مسیر (off | host | path)
+# TENANTS="brand1=shop1.example.com|brand1.local,brand2" ؛ دیتابیس هر مستأجر: TENANTS_DIR/<name>/warehouse.db
+# (مستأجر default همان DB_PATH است)
+TENANT_ROUTING = os.environ.get('TENANT_ROUTING', 'off')
+TENANTS = os.environ.get('TENANTS', '')
+TENANTS_DIR = os.environ.get('TENANTS_DIR', os.path.join(os.path.dirname(DB_PATH) or '.', 'tenants'))
+TENANT_POOL_SIZE = int(os.environ.get('TENANT_POOL_SIZE', 8))
+TENANT_PATH_PREFIX = '/t/'
+DEFAULT_TENANT = 'default'
+PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 256))
+
+# مرز کلاس‌های ABC بر اساس سهم تجمعی (A تا ۸۰٪، B تا ۹۵٪، بقیه C)
+ABC_THRESHOLDS = (0.80, 0.95)
+PROFITABILITY_SORTS = ('revenue', 'profit', 'margin', 'return_rate', 'qty', 'cogs', 'commission', 'shipping',
+                       'revenue_rank', 'name')
+
+# نگهداری دیتابیس: فاصله اجرای هر کار (ثانیه) و مدت بدون نوشتن که پنجره بیکاری حساب می‌شود
+DB_MAINTENANCE = os.environ.get('DB_MAINTENANCE', '1') != '0'
+MAINTENANCE_IDLE_SECONDS = float(os.environ.get('MAINTENANCE_IDLE_SECONDS', 30))
+MAINTENANCE_INTERVALS = {
+    'incremental_vacuum': 600,
+    'analyze': 24 * 3600,
+    'quick_check': 24 * 3600,
+    'ledger_checkpoint': 24 * 3600,
+    'forecast': 900,
+}
+OPTIMIZE_ON_CLOSE_INTERVAL = 300
+VACUUM_STEP_PAGES = 256
+
+# نقاط کنترل دفتر حساب‌ها: پایان ماه‌های شمسی اخیر و دیروز؛ تعداد ردیف هر صفحه حساب نقدی
+LEDGER_CHECKPOINT_MONTHS = 12
+CASH_PAGE_SIZE = 100
+
+# سری زمانی قیمت: بازه‌های شمسی و تعداد نقطه پیش‌فرض/حداکثر بعد از کاهش نمونه
+PRICE_SERIES_BUCKETS = ('day', 'week', 'month')
+PRICE_SERIES_POINTS = 200
+PRICE_SERIES_MAX_POINTS = 2000
+
+# پنجره‌های سرعت فروش (روز)، زمان تأمین پیش‌فرض و ضریب موجودی اطمینان (سطح خدمت ۹۵٪)
+FORECAST_WINDOWS = (7, 30, 90)
+DEFAULT_LEAD_TIME_DAYS = 14
+SAFETY_STOCK_Z = 1.65
+
 
 # ==================== توابع کمکی تاریخ ====================
 def get_persian_today():
@@ -59,6 +183,36 @@ def persian_to_gregorian(year, month, day):
     except:
         return datetime.date.today().isoformat()
 
+def get_fiscal_year_range(year):
+    """بازه میلادی سال مالی شمسی: (شروع، شروع سال بعد)"""
+    return persian_to_gregorian(year, 1, 1), persian_to_gregorian(year + 1, 1, 1)
+
+def ledger_checkpoint_dates(months=LEDGER_CHECKPOINT_MONTHS):
+    """تاریخ‌های میلادی نقاط کنترل دفتر: آخرین روز ماه‌های شمسی اخیر و دیروز (صعودی)"""
+    first = get_persian_today().replace(day=1)
+    dates = {(datetime.date.today() - datetime.timedelta(days=1)).isoformat()}
+    for _ in range(months):
+        dates.add((first.togregorian() - datetime.timedelta(days=1)).isoformat())
+        first = (first - datetime.timedelta(days=1)).replace(day=1)
+    return sorted(dates)
+
+@functools.lru_cache(maxsize=8192)
+def persian_bucket(day, bucket):
+    """(شروع میلادی، برچسب شمسی) بازه روز/هفته (شنبه تا جمعه)/ماه شمسی یک تاریخ میلادی"""
+    gdate = datetime.date.fromisoformat(day[:10])
+    if bucket == 'week':
+        gdate -= datetime.timedelta(days=(gdate.weekday() + 2) % 7)
+    jdate = jdatetime.date.fromgregorian(date=gdate)
+    if bucket == 'month':
+        jdate = jdate.replace(day=1)
+        return jdate.togregorian().isoformat(), jdate.strftime("%Y/%m")
+    return gdate.isoformat(), jdate.strftime("%Y/%m/%d")
+
+@functools.lru_cache(maxsize=256)
+def api_model(resource, fields):
+    """مدل tuple (namedtuple بدون __dict__) برای ستون‌های انتخاب شده یک منبع API"""
+    return namedtuple(f"{resource.title()}Row", fields)
+
 def get_persian_months():
     return ["فروردین", "اردیبهشت", "خرداد", "تیر", "مرداد", "شهریور",
             "مهر", "آبان", "آذر", "دی", "بهمن", "اسفند"]
@@ -71,22 +225,469 @@ def format_number(num):
         return str(num)
 
 
+def lttb_indices(xs, ys, threshold):
+    """اندیس نقاط انتخاب شده با Largest-Triangle-Three-Buckets (اولین و آخرین نقطه همیشه می‌مانند)"""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    selected = [0]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # میانگین بازه بعدی رأس سوم مثلث است
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+        best, best_area = None, -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
 # ==================== کلاس مدیریت دیتابیس ====================
+# ستون‌های جداول قابل آرشیو (ترتیب ثابت برای UNION با فایل‌های آرشیو)
+INFLOW_COLUMNS = "id, product_id, quantity, remaining, buy_price, inflow_date, dollar_rate"
+OUTFLOW_COLUMNS = ("id, product_id, center_id, quantity, sell_price, cogs_unit, commission_amount, "
+                   "shipping_cost, outflow_date, order_number, is_returned, is_paid")
+CASH_COLUMNS = "id, transaction_type, amount, source, description, transaction_date"
+
+# رول‌آپ روزانه قیمت خرید و فروش؛ {row} در تریگرها NEW/OLD و در ساخت اولیه نام جدول است
+# (خروجی‌های قدیمی بدون مرکز زیر center_id = 0 جمع می‌شوند)
+PRICE_ROLLUPS = {
+    'buy': {
+        'table': 'inflows', 'date': 'inflow_date', 'where': '1', 'center': '0',
+        'qty': '{row}.quantity',
+        'amount': '{row}.quantity * {row}.buy_price',
+        'cost': '0',
+        'usd_qty': 'CASE WHEN {row}.dollar_rate > 0 THEN {row}.quantity ELSE 0 END',
+        'usd_amount': 'CASE WHEN {row}.dollar_rate > 0 THEN {row}.quantity * {row}.buy_price / {row}.dollar_rate ELSE 0 END',
+        'columns': 'product_id, quantity, buy_price, dollar_rate, inflow_date',
+    },
+    'sell': {
+        'table': 'outflows', 'date': 'outflow_date', 'where': '{row}.is_returned = 0', 'center': 'COALESCE({row}.center_id, 0)',
+        'qty': '{row}.quantity',
+        'amount': '{row}.quantity * {row}.sell_price',
+        'cost': '{row}.quantity * {row}.cogs_unit',
+        'usd_qty': '0',
+        'usd_amount': '0',
+        'columns': 'product_id, center_id, quantity, sell_price, cogs_unit, outflow_date, is_returned',
+    },
+}
+PRICE_ROLLUP_MEASURES = ('qty', 'amount', 'cost', 'usd_qty', 'usd_amount')
+
+# منابع API نسخه ۱: ستون‌ها (به ترتیب مدل)، فیلترهای query string و جدول قابل آرشیو
+API_V1_RESOURCES = {
+    'products': {
+        'table': 'products',
+        'fields': ('id', 'name', 'color', 'barcode', 'stock'),
+        'filters': {
+            'q': "(name LIKE '%' || ? || '%' OR barcode LIKE '%' || ? || '%')",
+            'barcode': "barcode = ?",
+            'in_stock': "(stock > 0) = ?",
+        },
+    },
+    'inflows': {
+        'table': 'inflows', 'archived': INFLOW_COLUMNS, 'date': 'inflow_date',
+        'fields': ('id', 'product_id', 'quantity', 'remaining', 'buy_price', 'inflow_date', 'dollar_rate'),
+        'filters': {
+            'product_id': "product_id = ?",
+            'start': "inflow_date >= ?",
+            'end': "inflow_date <= ?",
+        },
+    },
+    'outflows': {
+        'table': 'outflows', 'archived': OUTFLOW_COLUMNS, 'date': 'outflow_date',
+        'fields': ('id', 'product_id', 'center_id', 'quantity', 'sell_price', 'cogs_unit', 'commission_amount',
+                   'shipping_cost', 'outflow_date', 'order_number', 'is_returned', 'is_paid'),
+        'filters': {
+            'product_id': "product_id = ?",
+            'center_id': "center_id = ?",
+            'order_number': "order_number = ?",
+            'start': "outflow_date >= ?",
+            'end': "outflow_date <= ?",
+            'is_returned': "is_returned = ?",
+            'is_paid': "is_paid = ?",
+        },
+    },
+    'centers': {
+        'table': 'sales_centers',
+        'fields': ('id', 'name', 'shipping_type', 'shipping_percent', 'shipping_min', 'shipping_max', 'shipping_fixed'),
+        'filters': {},
+    },
+    'ledgers': {
+        'fields': ('account', 'as_of', 'debit', 'credit', 'balance'),
+        'filters': {'as_of': None, 'account': None},
+    },
+}
+# برچسب چاپگرهای حرارتی (ZPL/EPL): اندازه برچسب به نقطه (پیش‌فرض ۵۰×۲۵ میلی‌متر در ۲۰۳dpi)
+# و فونت TrueType ZPL روی چاپگر (مسیر E: یا R:، مثلاً E:ARIAL.TTF)؛ بدون آن فونت داخلی 0 فقط حروف لاتین
+# دارد و نام و رنگ غیرلاتین چاپ نمی‌شوند (فقط بارکد)
+LABEL_FORMATS = ('zpl', 'epl')
+LABEL_WIDTH_DOTS = int(os.environ.get('LABEL_WIDTH_DOTS', 406))
+LABEL_HEIGHT_DOTS = int(os.environ.get('LABEL_HEIGHT_DOTS', 203))
+LABEL_ZPL_FONT = os.environ.get('LABEL_ZPL_FONT', '')
+LABEL_MAX_COPIES = 9999
+
+API_V1_PAGE_SIZE = 500
+API_V1_MAX_PAGE_SIZE = 5000
+
+FIFO_LOTS_QUERY = "SELECT id, remaining, buy_price FROM inflows WHERE product_id = ? AND remaining > 0 ORDER BY inflow_date ASC"
+
+
+class MaintainedConnection(sqlite3.Connection):
+    """اتصال با PRAGMA optimize هنگام بستن (حداکثر یک بار در هر OPTIMIZE_ON_CLOSE_INTERVAL در هر پروسه)"""
+    
+    last_optimize = 0.0
+    
+    def close(self):
+        now = time.monotonic()
+        if now - MaintainedConnection.last_optimize > OPTIMIZE_ON_CLOSE_INTERVAL:
+            MaintainedConnection.last_optimize = now
+            try:
+                # اگر قفل نوشتن آزاد نباشد منتظر نمی‌ماند؛ دفعه بعد اجرا می‌شود
+                self.execute("PRAGMA busy_timeout = 50")
+                self.execute("PRAGMA analysis_limit = 400")
+                self.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                MaintainedConnection.last_optimize = 0.0
+        super().close()
+
+
+def is_write_query(query):
+    return query.lstrip()[:7].upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'REPLACE'))
+
+def is_read_query(query):
+    return query.lstrip()[:6].upper().startswith(('SELECT', 'WITH'))
+
+
+class GroupCommitWriter:
+    """نویسنده واحد هر پروسه: تغییرات صف‌شده در یک پنجره کوتاه در یک تراکنش و یک commit ثبت می‌شوند"""
+    
+    def __init__(self, manager, window_ms=WRITE_BATCH_WINDOW_MS, max_batch=100):
+        self.manager = manager
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+        self.largest_batch = 0
+    
+    def _ensure_started(self):
+        if self.thread and self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            # بعد از fork، thread و صف پروسه والد قابل استفاده نیستند
+            self.queue = queue.Queue()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+            self.thread.start()
+    
+    def submit(self, op, quiet=False):
+        """op(cursor) در تراکنش نویسنده اجرا و نتیجه آن برگردانده می‌شود
+        
+        quiet: تغییر فقط جدول‌های دفتری/مشتق را عوض می‌کند (لاگ نگهداری، پیش‌بینی، نقاط کنترل) و
+        write_generation را بالا نمی‌برد تا کش صفحات، FIFO، ستون‌ها و ETagها بی‌دلیل باطل نشوند.
+        """
+        self._ensure_started()
+        future = Future()
+        self.queue.put((op, future, 'quiet' if quiet else 'write'))
+        return future.result()
+    
+    def submit_exclusive(self, op):
+        """op(conn) بیرون از هر تراکنش روی اتصال نویسنده اجرا می‌شود (بین دو دسته، مثلا برای backup)"""
+        self._ensure_started()
+        future = Future()
+        self.queue.put((op, future, 'exclusive'))
+        return future.result()
+    
+    def submit_many(self, ops):
+        """ارسال چند تغییر با هم تا در یک commit ثبت شوند؛ خطای هر کدام به جای نتیجه‌اش برمی‌گردد"""
+        self._ensure_started()
+        futures = []
+        for op in ops:
+            future = Future()
+            self.queue.put((op, future, 'write'))
+            futures.append(future)
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+    
+    def stop(self):
+        if self.thread and self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+    
+    def _run(self):
+        conn = self.manager.get_connection()
+        conn.isolation_level = None
+        try:
+            stopping = False
+            pending = None
+            while not stopping:
+                item, pending = pending or self.queue.get(), None
+                if item is None:
+                    break
+                if item[2] == 'exclusive':
+                    self._run_exclusive(conn, item)
+                    continue
+                batch = [item]
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    if item[2] == 'exclusive':
+                        # تغییرات قبلی اول commit می‌شوند
+                        pending = item
+                        break
+                    batch.append(item)
+                self._commit_batch(conn, batch)
+        finally:
+            conn.close()
+    
+    def _run_exclusive(self, conn, item):
+        op, future, _ = item
+        try:
+            result = op(conn)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            future.set_exception(e)
+            return
+        future.set_result(result)
+    
+    def _commit_batch(self, conn, batch):
+        results = []
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            changed = False
+            for op, future, mode in batch:
+                # هر تغییر در savepoint خودش تا خطای یکی بقیه را باطل نکند
+                cursor.execute("SAVEPOINT op")
+                changes_before = conn.total_changes
+                try:
+                    results.append((future, op(cursor), None))
+                    cursor.execute("RELEASE op")
+                    changed = changed or (mode != 'quiet' and conn.total_changes != changes_before)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO op")
+                    cursor.execute("RELEASE op")
+                    results.append((future, None, e))
+            if changed:
+                self.manager._bump_generation(cursor)
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        self.batches += 1
+        self.operations += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'largest_batch': self.largest_batch,
+            'avg_batch': round(self.operations / self.batches, 2) if self.batches else 0
+        }
+
+
+class ReadPool:
+    """اتصال‌های فقط خواندنی (mode=ro و query_only) جدا از مسیر نوشتن
+    
+    read_snapshot() یک تراکنش خواندن روی یک اتصال باز می‌کند و همه خواندن‌های همان thread
+    تا پایان بلوک از همان snapshot انجام می‌شوند؛ در حالت WAL این خواندن‌ها هیچ‌وقت commit
+    نویسنده را معطل نمی‌کنند.
+    """
+    
+    def __init__(self, manager, size=READ_POOL_SIZE):
+        self.manager = manager
+        self.size = size
+        self.idle = []
+        self.pid = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.opened = 0
+        self.snapshots = 0
+    
+    def _open(self):
+        path = os.path.abspath(self.manager.db_path)
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = 1")
+        self.opened += 1
+        return conn
+    
+    def acquire(self):
+        with self.lock:
+            # اتصال‌های پروسه والد بعد از fork قابل استفاده نیستند
+            if self.pid != os.getpid():
+                self.idle = []
+                self.pid = os.getpid()
+            if self.idle:
+                return self.idle.pop()
+        return self._open()
+    
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+    
+    def current(self):
+        """اتصال snapshot فعال همین thread (یا None)"""
+        return getattr(self.local, 'conn', None)
+    
+    @contextlib.contextmanager
+    def snapshot(self):
+        """with db.read_snapshot(): ... — بلوک‌های تو در تو از همان snapshot بیرونی استفاده می‌کنند"""
+        conn = self.current()
+        if conn is not None:
+            yield conn
+            return
+        conn = self.acquire()
+        try:
+            conn.execute("BEGIN")
+            # snapshot در اولین خواندن ثابت می‌شود
+            conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            self.local.conn = conn
+            self.snapshots += 1
+            yield conn
+        finally:
+            self.local.conn = None
+            self.release(conn)
+    
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+    
+    def stats(self):
+        return {'idle': len(self.idle), 'opened': self.opened, 'snapshots': self.snapshots}
+
+
 class DBManager:
     def __init__(self, db_path=None):
         self.db_path = db_path or DB_PATH
         os.makedirs(os.path.dirname(self.db_path) if os.path.dirname(self.db_path) else '.', exist_ok=True)
+        self.writer = GroupCommitWriter(self)
+        self.readers = ReadPool(self)
+        self.analytics = ColumnarAnalytics(self)
+        self.fifo = FifoLotCache(self)
+        self.maintenance = MaintenanceScheduler(self)
         self.create_tables()
     
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
+    def close(self):
+        self.maintenance.stop()
+        self.writer.stop()
+        self.readers.close()
+    
+    def restore_backup(self, path):
+        """کپی صفحه به صفحه فایل بکاپ روی دیتابیس زنده از طریق نویسنده
+        
+        فایل دیتابیس و WAL جابه‌جا نمی‌شوند؛ backup با قفل عادی SQLite نوشته می‌شود و اتصال‌های باز
+        workerهای دیگر در تراکنش بعدی خود داده بازیابی شده را می‌بینند.
+        """
+        def op(conn):
+            source = sqlite3.connect(path)
+            try:
+                if not source.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products'").fetchone():
+                    raise ValueError('فایل بکاپ دیتابیس انبار نیست')
+                before = dict(conn.execute("SELECT key, value FROM app_meta").fetchall())
+                source.backup(conn)
+            finally:
+                source.close()
+            # نسخه نوشتن از هر نسخه دیده شده بیشتر می‌شود تا کش صفحات همه workerها باطل شود؛
+            # restore_epoch به کش‌های افزایشی (FIFO و ستونی) می‌گوید از صفر بارگذاری کنند
+            conn.execute("CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value INTEGER DEFAULT 0)")
+            restored = dict(conn.execute("SELECT key, value FROM app_meta").fetchall())
+            for key, value in (('write_generation', max(before.get('write_generation', 0),
+                                                        restored.get('write_generation', 0)) + 1),
+                               ('restore_epoch', max(before.get('restore_epoch', 0),
+                                                     restored.get('restore_epoch', 0)) + 1)):
+                conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)", (key, value))
+        
+        try:
+            self.write_exclusive(op)
+        except (sqlite3.Error, ValueError) as e:
+            return False, f'خطا در بازیابی: {e}'
+        # مهاجرت‌های schema روی داده بازیابی شده؛ کش‌های حافظه با restore_epoch از نو بارگذاری می‌شوند
+        self.create_tables()
+        return True, 'دیتابیس بازیابی شد'
+    
+    def backup_to(self, path):
+        """کپی کامل دیتابیس (شامل تغییرات هنوز داخل WAL) در فایل path از طریق نویسنده"""
+        def op(conn):
+            target = sqlite3.connect(path)
+            try:
+                conn.backup(target)
+            finally:
+                target.close()
+        
+        try:
+            self.write_exclusive(op)
+        except sqlite3.Error as e:
+            if os.path.exists(path):
+                os.remove(path)
+            return False, f'خطا در تهیه بکاپ: {e}'
+        return True, 'بکاپ تهیه شد'
+    
+    def get_connection(self, attach=()):
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT, factory=MaintainedConnection)
         conn.row_factory = sqlite3.Row
+        for year in attach:
+            conn.execute(f"ATTACH DATABASE ? AS arch_{int(year)}", (self.get_archive_path(year),))
         return conn
     
     def create_tables(self):
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # دیتابیس جدید با auto_vacuum افزایشی ساخته می‌شود (برای دیتابیس موجود VACUUM کامل لازم است)
+        if not cursor.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        
+        # WAL: خواندن‌ها پشت نوشتن نمی‌مانند و هر commit فقط یک fsync روی WAL دارد
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # 1. جدول محصولات
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS products (
@@ -202,6 +803,215 @@ class DBManager:
             )
         ''')
         
+        # 10. جدول بستن سال مالی (خلاصه سال‌های آرشیو شده)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fiscal_closings (
+                year INTEGER PRIMARY KEY,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                revenue REAL DEFAULT 0,
+                cogs REAL DEFAULT 0,
+                commission REAL DEFAULT 0,
+                shipping REAL DEFAULT 0,
+                cash_deposits REAL DEFAULT 0,
+                cash_withdraws REAL DEFAULT 0,
+                inflow_count INTEGER DEFAULT 0,
+                outflow_count INTEGER DEFAULT 0,
+                cash_count INTEGER DEFAULT 0,
+                closed_at TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fiscal_closing_centers (
+                year INTEGER,
+                center_id INTEGER,
+                count INTEGER DEFAULT 0,
+                qty REAL DEFAULT 0,
+                sales REAL DEFAULT 0,
+                profit REAL DEFAULT 0,
+                PRIMARY KEY (year, center_id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fiscal_closing_products (
+                year INTEGER,
+                product_id INTEGER,
+                inflow_qty REAL DEFAULT 0,
+                outflow_qty REAL DEFAULT 0,
+                returned_qty REAL DEFAULT 0,
+                PRIMARY KEY (year, product_id)
+            )
+        ''')
+        
+        # 11. جدول متادیتا (نسخه نوشتن برای کش)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('write_generation', 0)")
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('restore_epoch', 0)")
+        
+        # 12. جدول تخصیص تسویه به خروجی‌ها
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settlement_allocations (
+                settlement_id INTEGER,
+                outflow_id INTEGER,
+                amount REAL NOT NULL,
+                PRIMARY KEY (settlement_id, outflow_id),
+                FOREIGN KEY (settlement_id) REFERENCES settlements(id),
+                FOREIGN KEY (outflow_id) REFERENCES outflows(id)
+            )
+        ''')
+        
+        # 14. محصولات تغییر کرده از آخرین بررسی موجودی
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_dirty (
+                product_id INTEGER PRIMARY KEY
+            )
+        ''')
+        
+        # 15. پیش‌بینی فروش و نقطه سفارش هر محصول
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_forecasts (
+                product_id INTEGER PRIMARY KEY,
+                velocity_7 REAL DEFAULT 0,
+                velocity_30 REAL DEFAULT 0,
+                velocity_90 REAL DEFAULT 0,
+                daily_std REAL DEFAULT 0,
+                lead_time_days REAL DEFAULT 0,
+                days_of_cover REAL,
+                reorder_point REAL DEFAULT 0,
+                computed_on TEXT,
+                FOREIGN KEY (product_id) REFERENCES products(id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS forecast_dirty (
+                product_id INTEGER PRIMARY KEY
+            )
+        ''')
+        
+        # 16. نرخ روزانه دلار
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS exchange_rates (
+                rate_date TEXT PRIMARY KEY,
+                rate REAL NOT NULL
+            )
+        ''')
+        
+        # 17. ژورنال تغییرات (برای پشتیبان افزایشی و نسخه آماده)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS change_journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                tbl TEXT NOT NULL,
+                op TEXT NOT NULL,
+                pk TEXT NOT NULL,
+                data TEXT,
+                changed_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # 18. خلاصه سودآوری و کلاس ABC هر محصول
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_profitability (
+                product_id INTEGER PRIMARY KEY,
+                qty REAL DEFAULT 0,
+                revenue REAL DEFAULT 0,
+                cogs REAL DEFAULT 0,
+                commission REAL DEFAULT 0,
+                shipping REAL DEFAULT 0,
+                profit REAL DEFAULT 0,
+                margin REAL DEFAULT 0,
+                returned_qty REAL DEFAULT 0,
+                return_rate REAL DEFAULT 0,
+                revenue_rank INTEGER,
+                abc_revenue TEXT DEFAULT 'C',
+                abc_profit TEXT DEFAULT 'C',
+                FOREIGN KEY (product_id) REFERENCES products(id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_profitability_revenue ON product_profitability(revenue)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_profitability_profit ON product_profitability(profit)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS profit_dirty (
+                product_id INTEGER PRIMARY KEY
+            )
+        ''')
+        
+        # 19. گزارش کارهای نگهداری دیتابیس
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_log (
+                id INTEGER PRIMARY KEY,
+                task TEXT NOT NULL,
+                started_at TEXT NOT NULL,
+                duration_ms REAL DEFAULT 0,
+                result TEXT
+            )
+        ''')
+        
+        # 20. محصولاتی که لات‌هایشان تغییر کرده (همگام‌سازی کش FIFO بین workerها)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fifo_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER
+            )
+        ''')
+        
+        # 21. لات‌های مصرف شده هر خروجی (برای برگرداندن همان لات‌ها هنگام برگشت)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outflow_lots (
+                outflow_id INTEGER NOT NULL,
+                inflow_id INTEGER NOT NULL,
+                quantity REAL NOT NULL,
+                PRIMARY KEY (outflow_id, inflow_id)
+            )
+        ''')
+        
+        # 22. نقاط کنترل دفتر حساب‌ها: جمع ردیف‌های جدول‌های اصلی هر حساب تا پایان روز as_of
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+                account TEXT NOT NULL,
+                as_of TEXT NOT NULL,
+                debit REAL DEFAULT 0,
+                credit REAL DEFAULT 0,
+                created_at TEXT,
+                PRIMARY KEY (account, as_of)
+            )
+        ''')
+        
+        # 23. رول‌آپ روزانه قیمت خرید/فروش هر محصول و مرکز (با تریگرها به‌روز می‌شود)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS price_daily (
+                kind TEXT NOT NULL,
+                product_id INTEGER NOT NULL,
+                center_id INTEGER NOT NULL DEFAULT 0,
+                day TEXT NOT NULL,
+                count INTEGER DEFAULT 0,
+                qty REAL DEFAULT 0,
+                amount REAL DEFAULT 0,
+                cost REAL DEFAULT 0,
+                usd_qty REAL DEFAULT 0,
+                usd_amount REAL DEFAULT 0,
+                PRIMARY KEY (kind, product_id, center_id, day)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_daily_center ON price_daily(kind, center_id, day)")
+        
+        # 13. کلیدهای یکتایی اسکن (پاسخ اسکن‌های تکراری از این جدول داده می‌شود)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scan_requests (
+                idempotency_key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_scan_requests_created ON scan_requests(created_at)")
+        cursor.execute("DELETE FROM scan_requests WHERE created_at < ?",
+                       ((datetime.datetime.now() - datetime.timedelta(days=SCAN_KEY_RETENTION_DAYS)).isoformat(),))
+        
         # مراکز پیش‌فرض
         default_centers = [
             ('نایتو', 'manual', 0, 0, 0, 0),
@@ -227,6 +1037,7 @@ class DBManager:
             ("ALTER TABLE outflows ADD COLUMN order_number TEXT DEFAULT ''", None),
             ("ALTER TABLE outflows ADD COLUMN is_returned INTEGER DEFAULT 0", None),
             ("ALTER TABLE outflows ADD COLUMN is_paid INTEGER DEFAULT 0", None),
+            ("ALTER TABLE fiscal_closing_centers ADD COLUMN net REAL DEFAULT 0", None),
         ]
         
         for alter_query, update_query in migrations:
@@ -237,16 +1048,326 @@ class DBManager:
             except:
                 pass
         
+        # ایندکس‌ها (بعد از migration تا ستون‌ها در دیتابیس‌های قدیمی هم وجود داشته باشند)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outflows_center_unpaid ON outflows(center_id, is_paid, outflow_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outflows_product ON outflows(product_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_inflows_product ON inflows(product_id, inflow_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outflows_order ON outflows(order_number)")
+        # جمع باقیمانده دفتر حساب‌ها بعد از آخرین نقطه کنترل
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outflows_center_date ON outflows(center_id, outflow_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_settlements_center ON settlements(center_id, settlement_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cash_date ON cash_transactions(transaction_date)")
+        # لات‌های خروجی‌های ثبت شده قبل از جدول outflow_lots معلوم نیست
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) SELECT 'outflow_lots_from', COALESCE(MAX(id), 0) FROM outflows")
+        
+        # تریگرهای ثبت محصولات تغییر کرده برای بررسی افزایشی موجودی
+        self._create_dirty_triggers(cursor, 'stock_dirty', 'dirty', 'inflows', 'product_id, quantity, remaining')
+        self._create_dirty_triggers(cursor, 'stock_dirty', 'dirty', 'outflows', 'product_id, quantity, is_returned')
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_products_dirty_upd AFTER UPDATE OF stock ON products
+            BEGIN
+                INSERT OR IGNORE INTO stock_dirty (product_id) VALUES (NEW.id);
+                INSERT OR IGNORE INTO forecast_dirty (product_id) VALUES (NEW.id);
+            END
+        """)
+        # محصولاتی که پیش‌بینی‌شان باید دوباره محاسبه شود (فروش، برگشت یا لات جدید)
+        self._create_dirty_triggers(cursor, 'forecast_dirty', 'forecast', 'inflows',
+                                    'product_id, quantity, inflow_date')
+        self._create_dirty_triggers(cursor, 'forecast_dirty', 'forecast', 'outflows',
+                                    'product_id, quantity, is_returned, outflow_date')
+        # محصولاتی که سودآوری‌شان باید دوباره محاسبه شود
+        self._create_dirty_triggers(cursor, 'profit_dirty', 'profit', 'outflows',
+                                    'product_id, quantity, sell_price, cogs_unit, commission_amount, '
+                                    'shipping_cost, is_returned')
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('forecast_day', 0)")
+        # حذف یا ویرایش ردیف‌های قبلی (به جز وضعیت برگشت) نسخه ستونی را مجبور به بارگذاری کامل می‌کند
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('analytics_rewrites', 0)")
+        self._create_analytics_triggers(cursor, 'outflows', 'product_id, center_id, quantity, sell_price, cogs_unit, '
+                                                            'commission_amount, shipping_cost, outflow_date')
+        self._create_analytics_triggers(cursor, 'inflows', 'product_id, quantity, buy_price, inflow_date, dollar_rate')
+        # لات‌های تغییر کرده برای باطل کردن کش FIFO
+        self._create_dirty_triggers(cursor, 'fifo_changes', 'fifo', 'inflows',
+                                    'product_id, remaining, buy_price, inflow_date')
+        # تغییر ردیف‌های یک حساب نقاط کنترل از تاریخ آن ردیف به بعد را باطل می‌کند
+        self._create_ledger_triggers(cursor, 'cash_transactions', 'transaction_date', "'cash'",
+                                     'transaction_type, amount, transaction_date')
+        self._create_ledger_triggers(cursor, 'outflows', 'outflow_date', "'center:' || {row}.center_id",
+                                     'center_id, quantity, sell_price, commission_amount, shipping_cost, '
+                                     'is_returned, outflow_date')
+        self._create_ledger_triggers(cursor, 'settlements', 'settlement_date', "'center:' || {row}.center_id",
+                                     'center_id, amount, settlement_date')
+        for kind in PRICE_ROLLUPS:
+            self._create_rollup_triggers(cursor, kind)
+        
+        self._create_journal_triggers(cursor)
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('journal_epoch', ?)",
+                       (int.from_bytes(os.urandom(6), 'big'),))
+        
+        # اولین بار همه محصولات باید بررسی شوند
+        if cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('stock_dirty_seeded', 1)").rowcount:
+            cursor.execute("INSERT OR IGNORE INTO stock_dirty (product_id) SELECT id FROM products")
+        if cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('profit_dirty_seeded', 1)").rowcount:
+            cursor.execute("INSERT OR IGNORE INTO profit_dirty (product_id) SELECT id FROM products")
+        
         conn.commit()
+        self._fill_closing_net(conn)
+        self._seed_price_rollups(conn)
         conn.close()
     
-    def execute_query(self, query, params=()):
-        conn = self.get_connection()
+    def _fill_closing_net(self, conn):
+        """مانده خالص مراکز سال‌هایی که قبل از ستون net بسته شده‌اند از فایل آرشیو (یک بار)"""
+        if conn.execute("SELECT 1 FROM app_meta WHERE key = 'closing_net_filled'").fetchone():
+            return
+        for (year,) in conn.execute("SELECT year FROM fiscal_closings").fetchall():
+            if not os.path.exists(self.get_archive_path(year)):
+                continue
+            conn.execute("ATTACH DATABASE ? AS arch", (self.get_archive_path(year),))
+            try:
+                conn.execute("""
+                    UPDATE fiscal_closing_centers SET net = (
+                        SELECT COALESCE(SUM(quantity * sell_price - commission_amount - shipping_cost), 0)
+                        FROM arch.outflows o WHERE o.center_id = fiscal_closing_centers.center_id AND o.is_returned = 0
+                    ) WHERE year = ?
+                """, (year,))
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                print(f"Database Error: {e}")
+            finally:
+                conn.execute("DETACH DATABASE arch")
+        conn.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('closing_net_filled', 1)")
+        conn.commit()
+    
+    def _seed_price_rollups(self, conn):
+        """ساخت اولیه رول‌آپ قیمت از ردیف‌های فعلی و فایل‌های آرشیو (یک بار)"""
+        if conn.execute("SELECT 1 FROM app_meta WHERE key = 'price_rollup_seeded'").fetchone():
+            return
+        conn.execute("DELETE FROM price_daily")
+        for kind in PRICE_ROLLUPS:
+            conn.execute(self._rollup_aggregate_sql(kind, 'main'))
+        for (year,) in conn.execute("SELECT year FROM fiscal_closings").fetchall():
+            if not os.path.exists(self.get_archive_path(year)):
+                continue
+            conn.commit()
+            conn.execute("ATTACH DATABASE ? AS arch", (self.get_archive_path(year),))
+            try:
+                tables = {row[0] for row in conn.execute("SELECT name FROM arch.sqlite_master WHERE type = 'table'")}
+                for kind, spec in PRICE_ROLLUPS.items():
+                    if spec['table'] in tables:
+                        conn.execute(self._rollup_aggregate_sql(kind, 'arch'))
+                conn.commit()
+            finally:
+                conn.execute("DETACH DATABASE arch")
+        conn.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('price_rollup_seeded', 1)")
+        conn.commit()
+    
+    @staticmethod
+    def _rollup_upsert(kind, columns_sql, tail=''):
+        measures = ', '.join(PRICE_ROLLUP_MEASURES)
+        updates = ', '.join(f"{name} = {name} + excluded.{name}" for name in ('count',) + PRICE_ROLLUP_MEASURES)
+        return (f"INSERT INTO price_daily (kind, product_id, center_id, day, count, {measures}) "
+                f"SELECT '{kind}', {columns_sql} {tail} "
+                f"ON CONFLICT(kind, product_id, center_id, day) DO UPDATE SET {updates}")
+    
+    def _rollup_aggregate_sql(self, kind, schema, where=None):
+        """جمع ردیف‌های جدول منبع (schema.table) به تفکیک روز؛ where اختیاری با ستون‌های بدون پیشوند"""
+        spec = PRICE_ROLLUPS[kind]
+        table = spec['table']
+        center = spec['center'].format(row=table)
+        columns = ', '.join([f"{table}.product_id", center, f"{table}.{spec['date']}", "COUNT(*)"] +
+                            [f"SUM({spec[name].format(row=table)})" for name in PRICE_ROLLUP_MEASURES])
+        return self._rollup_upsert(kind, columns, (
+            f"FROM {schema}.{table} WHERE {spec['where'].format(row=table)} AND ({where or '1'}) "
+            f"GROUP BY 2, 3, 4"
+        ))
+    
+    def _create_rollup_triggers(self, cursor, kind):
+        """افزودن ردیف جدید و کم کردن ردیف قبلی از رول‌آپ روزانه قیمت"""
+        spec = PRICE_ROLLUPS[kind]
+        
+        def apply(row, sign):
+            columns = ', '.join([f"{row}.product_id", spec['center'].format(row=row), f"{row}.{spec['date']}", str(sign)] +
+                                [f"{sign} * ({spec[name].format(row=row)})" for name in PRICE_ROLLUP_MEASURES])
+            return self._rollup_upsert(kind, columns, f"WHERE {spec['where'].format(row=row)}") + ";"
+        
+        table = spec['table']
+        # تعریف تریگرها ممکن است تغییر کرده باشد؛ همیشه از نو ساخته می‌شوند
+        for event in ('ins', 'del', 'upd'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_price_{event}")
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_price_ins AFTER INSERT ON {table}
+            BEGIN {apply('NEW', 1)} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_price_del AFTER DELETE ON {table}
+            BEGIN {apply('OLD', -1)} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_price_upd AFTER UPDATE OF {spec['columns']} ON {table}
+            BEGIN {apply('OLD', -1)} {apply('NEW', 1)} END
+        """)
+    
+    def _create_ledger_triggers(self, cursor, table, date_column, account, columns):
+        """حذف نقاط کنترل حساب ردیف درج/حذف/ویرایش شده از تاریخ آن ردیف به بعد"""
+        def invalidate(row):
+            return (f"DELETE FROM ledger_checkpoints WHERE account = {account.format(row=row)} "
+                    f"AND as_of >= {row}.{date_column};")
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_ledger_ins AFTER INSERT ON {table}
+            BEGIN {invalidate('NEW')} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_ledger_del AFTER DELETE ON {table}
+            BEGIN {invalidate('OLD')} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_ledger_upd AFTER UPDATE OF {columns} ON {table}
+            BEGIN {invalidate('OLD')} {invalidate('NEW')} END
+        """)
+    
+    def _create_dirty_triggers(self, cursor, dirty_table, name, table, columns):
+        """ثبت product_id ردیف‌های درج/حذف/ویرایش شده table در dirty_table"""
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{name}_ins AFTER INSERT ON {table}
+            BEGIN INSERT OR IGNORE INTO {dirty_table} (product_id) VALUES (NEW.product_id); END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{name}_del AFTER DELETE ON {table}
+            BEGIN INSERT OR IGNORE INTO {dirty_table} (product_id) VALUES (OLD.product_id); END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{name}_upd AFTER UPDATE OF {columns} ON {table}
+            BEGIN
+                INSERT OR IGNORE INTO {dirty_table} (product_id) VALUES (OLD.product_id);
+                INSERT OR IGNORE INTO {dirty_table} (product_id) VALUES (NEW.product_id);
+            END
+        """)
+    
+    def _create_analytics_triggers(self, cursor, table, columns):
+        """شمارش حذف‌ها و ویرایش‌های table در app_meta (شناسه ردیف حذف شده ممکن است دوباره استفاده شود)"""
+        bump = "UPDATE app_meta SET value = value + 1 WHERE key = 'analytics_rewrites';"
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_analytics_del AFTER DELETE ON {table}
+            BEGIN {bump} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_analytics_upd AFTER UPDATE OF {columns} ON {table}
+            BEGIN {bump} END
+        """)
+    
+    def _create_journal_triggers(self, cursor):
+        """تریگرهای ژورنال بر اساس ستون‌های فعلی هر جدول؛ بعد از migration فقط تریگرهای تغییرکرده بازسازی می‌شوند"""
+        existing = dict(cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall())
+        for table in JOURNAL_TABLES:
+            info = cursor.execute(f"PRAGMA table_info({table})").fetchall()
+            columns = [row[1] for row in info]
+            pk_columns = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+            # json_object اعداد اعشاری را با ۱۵ رقم می‌نویسد؛ با ۱۷ رقم به صورت متن مقدار دقیقاً برمی‌گردد
+            real_columns = {row[1] for row in info if 'REAL' in (row[2] or '').upper()}
+            
+            def json_of(prefix, names):
+                return "json_object(" + ", ".join(
+                    f"'{name}', CASE typeof({prefix}.{name}) WHEN 'real' THEN printf('%!.17g', {prefix}.{name}) "
+                    f"ELSE {prefix}.{name} END" if name in real_columns else f"'{name}', {prefix}.{name}"
+                    for name in names
+                ) + ")"
+            
+            triggers = {
+                f"trg_journal_{table}_ins": (
+                    f"CREATE TRIGGER trg_journal_{table}_ins AFTER INSERT ON {table} BEGIN "
+                    f"INSERT INTO change_journal (tbl, op, pk, data) VALUES "
+                    f"('{table}', 'I', {json_of('NEW', pk_columns)}, {json_of('NEW', columns)}); END"),
+                f"trg_journal_{table}_upd": (
+                    f"CREATE TRIGGER trg_journal_{table}_upd AFTER UPDATE ON {table} BEGIN "
+                    f"INSERT INTO change_journal (tbl, op, pk, data) VALUES "
+                    f"('{table}', 'U', {json_of('OLD', pk_columns)}, {json_of('NEW', columns)}); END"),
+                f"trg_journal_{table}_del": (
+                    f"CREATE TRIGGER trg_journal_{table}_del AFTER DELETE ON {table} BEGIN "
+                    f"INSERT INTO change_journal (tbl, op, pk, data) VALUES "
+                    f"('{table}', 'D', {json_of('OLD', pk_columns)}, NULL); END"),
+            }
+            for name, sql in triggers.items():
+                if existing.get(name) == sql:
+                    continue
+                if name in existing:
+                    cursor.execute(f"DROP TRIGGER {name}")
+                cursor.execute(sql)
+    
+    def _bump_generation(self, cursor):
+        """افزایش نسخه نوشتن؛ بین همه workerها از طریق خود دیتابیس هماهنگ است"""
+        cursor.execute("UPDATE app_meta SET value = value + 1 WHERE key = 'write_generation'")
+    
+    def get_write_generation(self):
+        result = self.execute_query("SELECT value FROM app_meta WHERE key = 'write_generation'")
+        return result[0]['value'] if result else 0
+    
+    def write(self, op, quiet=False):
+        """اجرای یک تغییر (تابعی از cursor) از طریق نویسنده واحد؛ quiet برای جدول‌های دفتری (GroupCommitWriter.submit)"""
+        profile = active_profile()
+        if profile is None:
+            return self._write(op, quiet)
+        started = time.perf_counter()
+        result = self._write(op, quiet)
+        profile.record('write', getattr(op, '__qualname__', repr(op)), time.perf_counter() - started)
+        return result
+    
+    def write_exclusive(self, op):
+        """اجرای op(conn) روی اتصال نویسنده بیرون از تراکنش دسته‌ها (ATTACH، backup)؛ خطاها به فراخواننده می‌رسند"""
+        profile = active_profile()
+        started = time.perf_counter()
+        try:
+            return self.writer.submit_exclusive(op)
+        finally:
+            if profile is not None:
+                profile.record('write', getattr(op, '__qualname__', repr(op)), time.perf_counter() - started)
+    
+    def _write(self, op, quiet=False):
+        try:
+            return self.writer.submit(op, quiet)
+        except sqlite3.Error as e:
+            print(f"Database Error: {e}")
+            return None
+    
+    def read_snapshot(self):
+        """همه خواندن‌های داخل بلوک (در همین thread) از یک snapshot ثابت دیتابیس"""
+        return self.readers.snapshot()
+    
+    def _read(self, query, params):
+        conn = self.readers.current()
+        if conn is not None:
+            return conn.execute(query, params).fetchall()
+        conn = self.readers.acquire()
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            self.readers.release(conn)
+    
+    def execute_query(self, query, params=(), attach=()):
+        profile = active_profile()
+        if profile is None:
+            return self._execute_query(query, params, attach)
+        started = time.perf_counter()
+        result = self._execute_query(query, params, attach)
+        profile.record('query', query, time.perf_counter() - started, len(result) if result is not None else None)
+        return result
+    
+    def _execute_query(self, query, params=(), attach=()):
+        if is_write_query(query) and not attach:
+            return self._write(lambda cursor: cursor.execute(query, params).fetchall())
+        if is_read_query(query) and not attach:
+            try:
+                return self._read(query, params)
+            except sqlite3.Error as e:
+                print(f"Database Error: {e}")
+                return None
+        conn = self.get_connection(attach)
         cursor = conn.cursor()
         try:
             cursor.execute(query, params)
-            conn.commit()
             result = cursor.fetchall()
+            if conn.total_changes:
+                self._bump_generation(cursor)
+            conn.commit()
             return result
         except sqlite3.Error as e:
             print(f"Database Error: {e}")
@@ -254,13 +1375,50 @@ class DBManager:
         finally:
             conn.close()
     
+    def iter_query(self, query, params=(), attach=(), chunk_size=500):
+        """خواندن ردیف‌ها به صورت تدریجی (برای صفحات stream شده)؛ اتصال بعد از آخرین ردیف آزاد می‌شود"""
+        profile = active_profile()
+        started = time.perf_counter()
+        count = 0
+        if attach:
+            conn, release = self.get_connection(attach), None
+        else:
+            conn = self.readers.acquire()
+            release = self.readers.release
+        cursor = None
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                count += len(rows)
+                yield from rows
+        except sqlite3.Error as e:
+            print(f"Database Error: {e}")
+        finally:
+            if profile is not None:
+                # زمان کل شامل رندر ردیف‌ها بین خواندن هر دسته است
+                profile.record('stream', query, time.perf_counter() - started, count)
+            if cursor is not None:
+                cursor.close()
+            if release:
+                release(conn)
+            else:
+                conn.close()
+    
     def execute_insert(self, query, params=()):
+        if is_write_query(query):
+            return self.write(lambda cursor: cursor.execute(query, params).lastrowid)
         conn = self.get_connection()
         cursor = conn.cursor()
         try:
             cursor.execute(query, params)
+            lastrowid = cursor.lastrowid
+            if conn.total_changes:
+                self._bump_generation(cursor)
             conn.commit()
-            return cursor.lastrowid
+            return lastrowid
         except sqlite3.Error as e:
             print(f"Database Error: {e}")
             return None
@@ -268,7 +1426,7 @@ class DBManager:
             conn.close()
     
     # ==================== محصولات ====================
-    def get_products(self, stock_filter="all", search=""):
+    def get_products(self, stock_filter="all", search="", stream=False):
         query = "SELECT id, name, color, barcode, stock FROM products WHERE 1=1"
         params = []
         
@@ -282,6 +1440,8 @@ class DBManager:
             params.extend([f"%{search}%", f"%{search}%"])
         
         query += " ORDER BY name"
+        if stream:
+            return self.iter_query(query, params)
         return self.execute_query(query, params)
     
     def get_product(self, product_id):
@@ -289,14 +1449,16 @@ class DBManager:
         return result[0] if result else None
     
     def add_product(self, name, color="", barcode=""):
-        product_id = self.execute_insert(
-            "INSERT INTO products (name, color, barcode, stock) VALUES (?, ?, ?, 0)",
-            (name, color, barcode)
-        )
-        if not barcode and product_id:
-            auto_barcode = f"200{product_id:010d}"
-            self.execute_query("UPDATE products SET barcode = ? WHERE id = ?", (auto_barcode, product_id))
-        return product_id
+        def op(cursor):
+            product_id = cursor.execute(
+                "INSERT INTO products (name, color, barcode, stock) VALUES (?, ?, ?, 0)",
+                (name, color, barcode)
+            ).lastrowid
+            if not barcode and product_id:
+                auto_barcode = f"200{product_id:010d}"
+                cursor.execute("UPDATE products SET barcode = ? WHERE id = ?", (auto_barcode, product_id))
+            return product_id
+        return self.write(op)
     
     def update_product(self, product_id, name, color, barcode):
         self.execute_query(
@@ -308,7 +1470,9 @@ class DBManager:
         inflows = self.execute_query("SELECT COUNT(*) as cnt FROM inflows WHERE product_id = ?", (product_id,))
         outflows = self.execute_query("SELECT COUNT(*) as cnt FROM outflows WHERE product_id = ?", (product_id,))
         
-        if (inflows and inflows[0]['cnt'] > 0) or (outflows and outflows[0]['cnt'] > 0):
+        archived = self.execute_query("SELECT COUNT(*) as cnt FROM fiscal_closing_products WHERE product_id = ?", (product_id,))
+        
+        if (inflows and inflows[0]['cnt'] > 0) or (outflows and outflows[0]['cnt'] > 0) or (archived and archived[0]['cnt'] > 0):
             return False, "این کالا دارای ورودی یا خروجی است"
         
         self.execute_query("DELETE FROM products WHERE id=?", (product_id,))
@@ -316,20 +1480,25 @@ class DBManager:
     
     # ==================== ورودی‌ها ====================
     def add_inflow(self, product_id, quantity, buy_price, inflow_date, dollar_rate=0):
-        self.execute_insert(
+        return self.write(lambda cursor: self._insert_inflow(cursor, product_id, quantity, buy_price, inflow_date, dollar_rate))
+    
+    def _insert_inflow(self, cursor, product_id, quantity, buy_price, inflow_date, dollar_rate=0):
+        inflow_id = cursor.execute(
             "INSERT INTO inflows (product_id, quantity, remaining, buy_price, inflow_date, dollar_rate) VALUES (?, ?, ?, ?, ?, ?)",
             (product_id, quantity, quantity, buy_price, inflow_date, dollar_rate)
-        )
-        self.execute_query(
+        ).lastrowid
+        cursor.execute(
             "UPDATE products SET stock = stock + ? WHERE id = ?",
             (quantity, product_id)
         )
+        return inflow_id
     
-    def get_inflows(self, start_date=None, end_date=None, product_id=None):
-        query = """
+    def get_inflows(self, start_date=None, end_date=None, product_id=None, stream=False):
+        years = self.get_archive_years_for_range(start_date, end_date)
+        query = f"""
             SELECT i.id, i.product_id, p.name, p.color, i.quantity, i.buy_price, 
                    i.inflow_date, i.remaining, i.dollar_rate
-            FROM inflows i 
+            FROM {self._archive_source('inflows', INFLOW_COLUMNS, years)} i 
             JOIN products p ON i.product_id = p.id
             WHERE 1=1
         """
@@ -344,29 +1513,32 @@ class DBManager:
             query += " AND i.product_id = ?"
             params.append(product_id)
         query += " ORDER BY i.inflow_date DESC"
-        return self.execute_query(query, params)
+        if stream:
+            return self.iter_query(query, params, attach=years)
+        return self.execute_query(query, params, attach=years)
     
     def delete_inflow(self, inflow_id):
-        inflow = self.execute_query("SELECT product_id, quantity, remaining FROM inflows WHERE id = ?", (inflow_id,))
-        if not inflow:
-            return False, "ورودی یافت نشد"
-        
-        product_id, quantity, remaining = inflow[0]['product_id'], inflow[0]['quantity'], inflow[0]['remaining']
-        
-        if remaining < quantity:
-            return False, "از این ورودی استفاده شده"
-        
-        self.execute_query("DELETE FROM inflows WHERE id = ?", (inflow_id,))
-        self.execute_query("UPDATE products SET stock = stock - ? WHERE id = ?", (quantity, product_id))
-        return True, "ورودی حذف شد"
+        def op(cursor):
+            inflow = cursor.execute("SELECT product_id, quantity, remaining FROM inflows WHERE id = ?", (inflow_id,)).fetchall()
+            if not inflow:
+                return False, "ورودی یافت نشد"
+            
+            product_id, quantity, remaining = inflow[0]['product_id'], inflow[0]['quantity'], inflow[0]['remaining']
+            
+            if remaining < quantity:
+                return False, "از این ورودی استفاده شده"
+            
+            cursor.execute("DELETE FROM inflows WHERE id = ?", (inflow_id,))
+            cursor.execute("UPDATE products SET stock = stock - ? WHERE id = ?", (quantity, product_id))
+            return True, "ورودی حذف شد"
+        return self.write(op) or (False, "خطا در حذف ورودی")
     
     # ==================== خروجی‌ها ====================
     def calculate_fifo_cost(self, product_id, quantity):
-        inflows = self.execute_query(
-            "SELECT id, remaining, buy_price FROM inflows WHERE product_id = ? AND remaining > 0 ORDER BY inflow_date ASC",
-            (product_id,)
-        )
-        
+        """پیش‌نمایش بهای تمام شده از کش لات‌ها (ثبت خروجی لات‌ها را داخل تراکنش نوشتن دوباره می‌خواند)"""
+        return self.fifo.quote(product_id, quantity)
+    
+    def _walk_fifo(self, inflows, quantity):
         if not inflows:
             return 0, []
         
@@ -388,31 +1560,30 @@ class DBManager:
         return total_cost / quantity, used_inflows
     
     def add_outflow(self, product_id, center_id, quantity, sell_price, cogs_unit, commission, shipping, outflow_date, order_number=""):
-        _, used_inflows = self.calculate_fifo_cost(product_id, quantity)
+        return self.write(lambda cursor: self._insert_outflow(
+            cursor, product_id, center_id, quantity, sell_price, cogs_unit, commission, shipping, outflow_date, order_number))
+    
+    def _insert_outflow(self, cursor, product_id, center_id, quantity, sell_price, cogs_unit, commission, shipping, outflow_date, order_number=""):
+        outflow_id = cursor.execute(
+            """INSERT INTO outflows 
+               (product_id, center_id, quantity, sell_price, cogs_unit, commission_amount, shipping_cost, outflow_date, order_number)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (product_id, center_id, quantity, sell_price, cogs_unit, commission, shipping, outflow_date, order_number)
+        ).lastrowid
+        self._consume_lots(cursor, outflow_id, product_id, quantity)
         
-        for inflow_id, use_qty in used_inflows:
-            self.execute_query(
-                "UPDATE inflows SET remaining = remaining - ? WHERE id = ?",
-                (use_qty, inflow_id)
-            )
-        
-        self.execute_insert(
-            """INSERT INTO outflows 
-               (product_id, center_id, quantity, sell_price, cogs_unit, commission_amount, shipping_cost, outflow_date, order_number)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (product_id, center_id, quantity, sell_price, cogs_unit, commission, shipping, outflow_date, order_number)
-        )
-        
-        self.execute_query(
+        cursor.execute(
             "UPDATE products SET stock = stock - ? WHERE id = ?",
             (quantity, product_id)
         )
+        return outflow_id
     
-    def get_outflows(self, start_date=None, end_date=None, center_id=None, is_returned=None, is_paid=None):
-        query = """
+    def get_outflows(self, start_date=None, end_date=None, center_id=None, is_returned=None, is_paid=None, stream=False):
+        years = self.get_archive_years_for_range(start_date, end_date)
+        query = f"""
             SELECT o.id, o.product_id, p.name, p.color, sc.name as center_name, o.quantity, o.sell_price, o.cogs_unit, 
                    o.commission_amount, o.shipping_cost, o.outflow_date, o.order_number, o.is_returned, o.is_paid, o.center_id
-            FROM outflows o
+            FROM {self._archive_source('outflows', OUTFLOW_COLUMNS, years)} o
             JOIN products p ON o.product_id = p.id
             JOIN sales_centers sc ON o.center_id = sc.id
             WHERE 1=1
@@ -434,38 +1605,581 @@ class DBManager:
             query += " AND o.is_paid = ?"
             params.append(1 if is_paid else 0)
         query += " ORDER BY o.outflow_date DESC"
-        return self.execute_query(query, params)
+        if stream:
+            return self.iter_query(query, params, attach=years)
+        return self.execute_query(query, params, attach=years)
+    
+    def _consume_lots(self, cursor, outflow_id, product_id, quantity):
+        """مصرف لات‌های FIFO برای یک خروجی و ثبت مقدار برداشته شده از هر لات"""
+        # لات‌های FIFO داخل همان تراکنش نوشتن خوانده می‌شوند
+        _, used_inflows = self._walk_fifo(cursor.execute(FIFO_LOTS_QUERY, (product_id,)).fetchall(), quantity)
+        for inflow_id, use_qty in used_inflows:
+            cursor.execute("UPDATE inflows SET remaining = remaining - ? WHERE id = ?", (use_qty, inflow_id))
+            cursor.execute(
+                """INSERT INTO outflow_lots (outflow_id, inflow_id, quantity) VALUES (?, ?, ?)
+                   ON CONFLICT(outflow_id, inflow_id) DO UPDATE SET quantity = quantity + excluded.quantity""",
+                (outflow_id, inflow_id, use_qty)
+            )
+    
+    def _restore_lots(self, cursor, outflow_id, product_id, quantity):
+        """برگرداندن مقدار خروجی به همان لات‌هایی که مصرف کرده بود
+        
+        خروجی‌های قدیمی‌تر از جدول outflow_lots و لات‌هایی که آرشیو شده‌اند به جدیدترین لات‌های دارای جا برمی‌گردند.
+        """
+        lots = cursor.execute("""
+            SELECT ol.inflow_id, ol.quantity, i.quantity - i.remaining as room
+            FROM outflow_lots ol LEFT JOIN inflows i ON i.id = ol.inflow_id
+            WHERE ol.outflow_id = ?
+        """, (outflow_id,)).fetchall()
+        if lots:
+            unplaced = 0
+            for lot in lots:
+                use_qty = min(lot['quantity'], max(lot['room'] or 0, 0))
+                if use_qty > 0:
+                    cursor.execute("UPDATE inflows SET remaining = remaining + ? WHERE id = ?", (use_qty, lot['inflow_id']))
+                unplaced += lot['quantity'] - use_qty
+            cursor.execute("DELETE FROM outflow_lots WHERE outflow_id = ?", (outflow_id,))
+        else:
+            tracked_from = cursor.execute("SELECT value FROM app_meta WHERE key = 'outflow_lots_from'").fetchone()
+            # خروجی جدید بدون لات یعنی هنگام فروش لاتی نبوده (موجودی منفی)
+            unplaced = quantity if tracked_from and outflow_id <= tracked_from[0] else 0
+        if unplaced > 1e-9:
+            self._repair_lots(cursor, product_id, unplaced)
+    
+    def _set_outflow_returned(self, cursor, outflow, returned):
+        """تغییر وضعیت برگشت یک خروجی همراه با موجودی کالا و لات‌های FIFO"""
+        if bool(outflow['is_returned']) == returned:
+            return False
+        cursor.execute("UPDATE outflows SET is_returned = ? WHERE id = ?", (1 if returned else 0, outflow['id']))
+        if returned:
+            cursor.execute("UPDATE products SET stock = stock + ? WHERE id = ?", (outflow['quantity'], outflow['product_id']))
+            self._restore_lots(cursor, outflow['id'], outflow['product_id'], outflow['quantity'])
+        else:
+            cursor.execute("UPDATE products SET stock = stock - ? WHERE id = ?", (outflow['quantity'], outflow['product_id']))
+            self._consume_lots(cursor, outflow['id'], outflow['product_id'], outflow['quantity'])
+        return True
     
     def toggle_outflow_return(self, outflow_id):
-        outflow = self.execute_query("SELECT is_returned, product_id, quantity FROM outflows WHERE id = ?", (outflow_id,))
-        if outflow:
-            is_returned = outflow[0]['is_returned']
-            product_id = outflow[0]['product_id']
-            quantity = outflow[0]['quantity']
-            new_status = 0 if is_returned else 1
-            self.execute_query("UPDATE outflows SET is_returned = ? WHERE id = ?", (new_status, outflow_id))
-            if new_status == 1:
-                self.execute_query("UPDATE products SET stock = stock + ? WHERE id = ?", (quantity, product_id))
-            else:
-                self.execute_query("UPDATE products SET stock = stock - ? WHERE id = ?", (quantity, product_id))
+        def op(cursor):
+            outflow = cursor.execute("SELECT id, is_returned, product_id, quantity FROM outflows WHERE id = ?", (outflow_id,)).fetchone()
+            if outflow:
+                self._set_outflow_returned(cursor, outflow, not outflow['is_returned'])
+        self.write(op)
     
     def toggle_outflow_paid(self, outflow_id):
-        outflow = self.execute_query("SELECT is_paid FROM outflows WHERE id = ?", (outflow_id,))
-        if outflow:
-            new_status = 0 if outflow[0]['is_paid'] else 1
-            self.execute_query("UPDATE outflows SET is_paid = ? WHERE id = ?", (new_status, outflow_id))
+        def op(cursor):
+            outflow = cursor.execute("SELECT is_paid FROM outflows WHERE id = ?", (outflow_id,)).fetchone()
+            if not outflow:
+                return
+            if outflow['is_paid']:
+                # مبلغ تسویه‌ای که این خروجی را پرداخت کرده بود دوباره آزاد می‌شود
+                cursor.execute("DELETE FROM settlement_allocations WHERE outflow_id = ?", (outflow_id,))
+            cursor.execute("UPDATE outflows SET is_paid = CASE WHEN is_paid THEN 0 ELSE 1 END WHERE id = ?", (outflow_id,))
+        self.write(op)
     
     def delete_outflow(self, outflow_id):
-        outflow = self.execute_query("SELECT product_id, quantity, is_returned FROM outflows WHERE id = ?", (outflow_id,))
-        if not outflow:
-            return False, "خروجی یافت نشد"
+        def op(cursor):
+            outflow = cursor.execute("SELECT product_id, quantity, is_returned FROM outflows WHERE id = ?", (outflow_id,)).fetchall()
+            if not outflow:
+                return False, "خروجی یافت نشد"
+            
+            if not outflow[0]['is_returned']:
+                cursor.execute("UPDATE products SET stock = stock + ? WHERE id = ?", 
+                               (outflow[0]['quantity'], outflow[0]['product_id']))
+                self._restore_lots(cursor, outflow_id, outflow[0]['product_id'], outflow[0]['quantity'])
+            
+            cursor.execute("DELETE FROM outflows WHERE id = ?", (outflow_id,))
+            cursor.execute("DELETE FROM outflow_lots WHERE outflow_id = ?", (outflow_id,))
+            cursor.execute("DELETE FROM settlement_allocations WHERE outflow_id = ?", (outflow_id,))
+            return True, "خروجی حذف شد"
+        return self.write(op) or (False, "خطا در حذف خروجی")
+    
+    # ==================== عملیات گروهی خروجی‌ها ====================
+    def _outflow_selection(self, ids=None, order_numbers=None, start_date=None, end_date=None, center_id=None):
+        """شرط WHERE انتخاب خروجی‌ها؛ لیست‌ها به صورت یک پارامتر JSON ارسال می‌شوند"""
+        clauses = []
+        params = []
+        if ids:
+            clauses.append("id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps([int(i) for i in ids]))
+        if order_numbers:
+            clauses.append("order_number IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps([str(n) for n in order_numbers]))
+        if start_date:
+            clauses.append("outflow_date >= ?")
+            params.append(start_date)
+        if end_date:
+            clauses.append("outflow_date <= ?")
+            params.append(end_date)
+        if center_id:
+            clauses.append("center_id = ?")
+            params.append(center_id)
+        if not clauses:
+            return None, []
+        return " AND ".join(clauses), params
+    
+    def bulk_set_outflows_paid(self, paid=True, **selection):
+        where, params = self._outflow_selection(**selection)
+        if not where:
+            return 0
+        status = 1 if paid else 0
         
-        if not outflow[0]['is_returned']:
-            self.execute_query("UPDATE products SET stock = stock + ? WHERE id = ?", 
-                             (outflow[0]['quantity'], outflow[0]['product_id']))
+        def op(cursor):
+            if not paid:
+                cursor.execute(f"""
+                    DELETE FROM settlement_allocations
+                    WHERE outflow_id IN (SELECT id FROM outflows WHERE {where} AND is_paid = 1)
+                """, params)
+            return cursor.execute(
+                f"UPDATE outflows SET is_paid = ? WHERE {where} AND is_paid != ?",
+                [status] + params + [status]
+            ).rowcount
+        return self.write(op) or 0
+    
+    def bulk_set_outflows_returned(self, returned=True, **selection):
+        where, params = self._outflow_selection(**selection)
+        if not where:
+            return 0
         
-        self.execute_query("DELETE FROM outflows WHERE id = ?", (outflow_id,))
-        return True, "خروجی حذف شد"
+        def op(cursor):
+            # هر ردیف لات‌های خودش را برمی‌گرداند (یا دوباره مصرف می‌کند)؛ همه در یک تراکنش
+            rows = cursor.execute(
+                f"SELECT id, product_id, quantity, is_returned FROM outflows WHERE {where} AND is_returned = ? ORDER BY id",
+                params + [0 if returned else 1]
+            ).fetchall()
+            return sum(self._set_outflow_returned(cursor, row, returned) for row in rows)
+        return self.write(op) or 0
+    
+    # ==================== برگشت سفارش ====================
+    def get_order_lines(self, order_number):
+        return self.execute_query("""
+            SELECT o.id, o.product_id, p.name, p.color, p.barcode, o.quantity, o.sell_price, o.cogs_unit,
+                   o.outflow_date, o.is_returned, o.is_paid, sc.name as center_name
+            FROM outflows o
+            LEFT JOIN products p ON o.product_id = p.id
+            LEFT JOIN sales_centers sc ON o.center_id = sc.id
+            WHERE o.order_number = ?
+            ORDER BY o.id
+        """, (order_number,)) or []
+    
+    def return_orders(self, order_numbers, outflow_ids=None):
+        """برگشت کامل سفارش‌ها (یا فقط ردیف‌های outflow_ids از آن‌ها) در یک تراکنش
+        
+        موجودی کالا و همان لات‌های FIFO مصرف شده برمی‌گردند؛ خلاصه‌ها (سودآوری، پیش‌بینی، کش‌ها)
+        از طریق تریگرهای dirty و نسخه نوشتن فقط برای محصولات تغییر کرده به‌روز می‌شوند.
+        """
+        order_numbers = [str(n) for n in order_numbers]
+        outflow_ids = [int(i) for i in outflow_ids or []]
+        
+        def op(cursor):
+            query = """SELECT id, product_id, quantity, is_returned, order_number FROM outflows
+                       WHERE order_number IN (SELECT value FROM json_each(?))"""
+            params = [json.dumps(order_numbers)]
+            if outflow_ids:
+                query += " AND id IN (SELECT value FROM json_each(?))"
+                params.append(json.dumps(outflow_ids))
+            rows = cursor.execute(query + " ORDER BY id", params).fetchall()
+            
+            found = set()
+            returned = []
+            quantity = 0
+            for row in rows:
+                found.add(row['order_number'])
+                if self._set_outflow_returned(cursor, row, True):
+                    returned.append(row['id'])
+                    quantity += row['quantity']
+            return {
+                'returned': len(returned),
+                'quantity': quantity,
+                'outflow_ids': returned,
+                'already_returned': len(rows) - len(returned),
+                'not_found': [n for n in dict.fromkeys(order_numbers) if n not in found]
+            }
+        return self.write(op)
+    
+    # ==================== بررسی صحت موجودی ====================
+    def verify_stock(self, full=False, repair=False, chunk_size=500):
+        """مقایسه products.stock با گردش ورودی/خروجی و جمع remaining لات‌ها
+        
+        فقط محصولات تغییر کرده از آخرین اجرا بررسی می‌شوند (مگر full=True).
+        هر دسته در یک تراکنش کوتاه اجرا می‌شود تا قفل نوشتن طولانی نگه داشته نشود.
+        """
+        source = "SELECT id FROM products" if full else "SELECT product_id FROM stock_dirty"
+        ids = [row[0] for row in self.execute_query(source + " ORDER BY 1") or []]
+        mismatches = []
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            result = self.write(functools.partial(self._verify_stock_chunk, product_ids=chunk, repair=repair))
+            if result is None:
+                break
+            mismatches.extend(result)
+        return len(ids), mismatches
+    
+    def _verify_stock_chunk(self, cursor, product_ids, repair):
+        rows = cursor.execute("""
+            SELECT p.id, p.name, p.color, p.stock,
+                   COALESCE((SELECT SUM(quantity) FROM inflows WHERE product_id = p.id), 0)
+                     - COALESCE((SELECT SUM(quantity) FROM outflows WHERE product_id = p.id AND is_returned = 0), 0)
+                     + COALESCE((SELECT SUM(inflow_qty - outflow_qty + returned_qty)
+                                 FROM fiscal_closing_products WHERE product_id = p.id), 0) as expected_stock,
+                   COALESCE((SELECT SUM(remaining) FROM inflows WHERE product_id = p.id), 0) as lot_remaining
+            FROM products p WHERE p.id IN (SELECT value FROM json_each(?))
+        """, (json.dumps(product_ids),)).fetchall()
+        
+        mismatches = []
+        for row in rows:
+            stock_diff = row['expected_stock'] - row['stock']
+            # موجودی منفی (فروش بدون ورودی) لات مصرف‌نشده‌ای ندارد
+            lot_diff = max(row['expected_stock'], 0) - row['lot_remaining']
+            if abs(stock_diff) < 1e-6 and abs(lot_diff) < 1e-6:
+                continue
+            mismatches.append({
+                'product_id': row['id'],
+                'name': row['name'],
+                'color': row['color'],
+                'stock': row['stock'],
+                'expected_stock': row['expected_stock'],
+                'lot_remaining': row['lot_remaining']
+            })
+            if repair:
+                cursor.execute("UPDATE products SET stock = ? WHERE id = ?", (row['expected_stock'], row['id']))
+                self._repair_lots(cursor, row['id'], lot_diff)
+        
+        cursor.execute("DELETE FROM stock_dirty WHERE product_id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(product_ids),))
+        return mismatches
+    
+    def _repair_lots(self, cursor, product_id, diff):
+        """اصلاح remaining لات‌ها: کسری به جدیدترین لات‌ها برمی‌گردد، مازاد از قدیمی‌ترین‌ها کم می‌شود"""
+        if diff > 0:
+            lots = cursor.execute(
+                "SELECT id, quantity - remaining as room FROM inflows WHERE product_id = ? AND remaining < quantity ORDER BY inflow_date DESC, id DESC",
+                (product_id,)
+            ).fetchall()
+            for lot in lots:
+                if diff <= 1e-9:
+                    break
+                use_qty = min(lot['room'], diff)
+                cursor.execute("UPDATE inflows SET remaining = remaining + ? WHERE id = ?", (use_qty, lot['id']))
+                diff -= use_qty
+        elif diff < 0:
+            _, used_inflows = self._walk_fifo(cursor.execute(FIFO_LOTS_QUERY, (product_id,)).fetchall(), -diff)
+            for inflow_id, use_qty in used_inflows:
+                cursor.execute("UPDATE inflows SET remaining = remaining - ? WHERE id = ?", (use_qty, inflow_id))
+    
+    # ==================== اسکن ====================
+    def _scan_inflow_op(self, cursor, barcode_text, quantity, buy_price, dollar_rate, inflow_date):
+        product = cursor.execute("SELECT id FROM products WHERE barcode = ?", (barcode_text,)).fetchone()
+        if not product:
+            return {'success': False, 'message': 'محصول یافت نشد'}
+        
+        self._insert_inflow(cursor, product['id'], quantity, buy_price, inflow_date, dollar_rate)
+        product = cursor.execute("SELECT id, name, stock FROM products WHERE id = ?", (product['id'],)).fetchone()
+        return {
+            'success': True,
+            'message': f'{quantity} عدد اضافه شد',
+            'product': {'id': product['id'], 'name': product['name'], 'stock': product['stock']}
+        }
+    
+    def _scan_outflow_op(self, cursor, barcode_text, quantity, sell_price, center_id, commission, shipping, order_number, outflow_date):
+        if not center_id:
+            return {'success': False, 'message': 'مرکز فروش مشخص نشده است'}
+        
+        product = cursor.execute("SELECT id, stock FROM products WHERE barcode = ?", (barcode_text,)).fetchone()
+        if not product:
+            return {'success': False, 'message': 'محصول یافت نشد'}
+        
+        if product['stock'] < quantity:
+            return {'success': False, 'message': f"موجودی کافی نیست ({product['stock']} موجود)"}
+        
+        cogs_unit, _ = self._walk_fifo(cursor.execute(FIFO_LOTS_QUERY, (product['id'],)).fetchall(), quantity)
+        if cogs_unit is None:
+            return {'success': False, 'message': 'خطا در محاسبه بهای تمام شده'}
+        
+        self._insert_outflow(cursor, product['id'], center_id, quantity, sell_price, cogs_unit,
+                             commission, shipping, outflow_date, order_number)
+        product = cursor.execute("SELECT id, name, stock FROM products WHERE id = ?", (product['id'],)).fetchone()
+        return {
+            'success': True,
+            'message': f'{quantity} عدد خارج شد',
+            'product': {'id': product['id'], 'name': product['name'], 'stock': product['stock']}
+        }
+    
+    def get_scan_response(self, idempotency_key):
+        result = self.execute_query("SELECT response FROM scan_requests WHERE idempotency_key = ?", (idempotency_key,))
+        return json.loads(result[0]['response']) if result else None
+    
+    def _idempotent(self, idempotency_key, kind, op):
+        """op فقط یک بار برای هر کلید اجرا می‌شود؛ بررسی و ثبت کلید در همان تراکنش تغییر است"""
+        def wrapped(cursor):
+            if idempotency_key:
+                row = cursor.execute("SELECT response FROM scan_requests WHERE idempotency_key = ?",
+                                     (idempotency_key,)).fetchone()
+                if row:
+                    return dict(json.loads(row['response']), replayed=True)
+            response = op(cursor)
+            if idempotency_key and response.get('success'):
+                cursor.execute(
+                    "INSERT INTO scan_requests (idempotency_key, kind, response, created_at) VALUES (?, ?, ?, ?)",
+                    (idempotency_key, kind, json.dumps(response), datetime.datetime.now().isoformat(timespec='seconds'))
+                )
+            return response
+        return wrapped
+    
+    def _scan_ops(self, scans):
+        """تبدیل اسکن‌های دریافتی به opهای نویسنده (پاسخ‌های ذخیره‌شده بدون رفتن به نویسنده برمی‌گردند)"""
+        today = datetime.date.today().isoformat()
+        ops = []
+        for scan in scans:
+            key = scan.get('idempotency_key')
+            stored = self.get_scan_response(key) if key else None
+            if stored:
+                ops.append(dict(stored, replayed=True))
+                continue
+            if scan.get('kind') == 'inflow':
+                op = functools.partial(self._scan_inflow_op, barcode_text=scan.get('barcode'),
+                                       quantity=scan.get('quantity', 1), buy_price=scan.get('buy_price', 0),
+                                       dollar_rate=scan.get('dollar_rate', 0), inflow_date=today)
+            elif scan.get('kind') == 'outflow':
+                op = functools.partial(self._scan_outflow_op, barcode_text=scan.get('barcode'),
+                                       quantity=scan.get('quantity', 1), sell_price=scan.get('sell_price', 0),
+                                       center_id=scan.get('center_id'), commission=scan.get('commission', 0),
+                                       shipping=scan.get('shipping', 0), order_number=scan.get('order_number', ''),
+                                       outflow_date=today)
+            else:
+                ops.append({'success': False, 'message': 'نوع اسکن نامعتبر است'})
+                continue
+            ops.append(self._idempotent(key, scan['kind'], op))
+        return ops
+    
+    def process_scans(self, scans):
+        """ثبت چند اسکن در یک commit گروهی؛ ترتیب پاسخ‌ها با ترتیب ورودی یکسان است"""
+        ops = self._scan_ops(scans)
+        pending = [op for op in ops if callable(op)]
+        results = iter(self.writer.submit_many(pending))
+        responses = []
+        for op in ops:
+            if not callable(op):
+                responses.append(op)
+                continue
+            result = next(results)
+            if isinstance(result, Exception):
+                print(f"Database Error: {result}")
+                result = {'success': False, 'message': 'خطای دیتابیس'}
+            responses.append(result)
+        return responses
+    
+    # ==================== پیش‌بینی فروش و نقطه سفارش ====================
+    def compute_forecasts(self, today=None):
+        """سرعت فروش، انحراف معیار فروش روزانه، زمان تأمین و نقطه سفارش برای همه محصولات
+        
+        محاسبه به صورت برداری روی نسخه ستونی خروجی/ورودی‌ها انجام می‌شود.
+        خروجی: دیکشنری product_id -> مقادیر پیش‌بینی
+        """
+        today = (today or datetime.date.today()).toordinal()
+        outflows, inflows, products, _ = self.analytics.snapshot()
+        size = len(products)
+        
+        # سرعت فروش در هر پنجره (خروجی‌های برگشتی حساب نمی‌شوند)
+        age = today - outflows['date']
+        sold = ~outflows['returned'] & (age >= 0)
+        velocity = {}
+        for window in FORECAST_WINDOWS:
+            in_window = sold & (age < window)
+            velocity[window] = np.bincount(outflows['product'], weights=np.where(in_window, outflows['qty'], 0),
+                                           minlength=size) / window
+        
+        # انحراف معیار فروش روزانه در پنجره ۳۰ روزه (ماتریس محصول × روز)
+        std_window = 30
+        in_std = sold & (age < std_window)
+        daily = np.bincount(outflows['product'][in_std] * std_window + age[in_std],
+                            weights=outflows['qty'][in_std], minlength=size * std_window)
+        daily_std = daily.reshape(size, std_window).std(axis=1) if size else np.zeros(0)
+        
+        # زمان تأمین: میانگین فاصله بین روزهای ورود متوالی هر محصول
+        # (هر اسکن یک ردیف ورودی است؛ ردیف‌های یک روز یک بار تأمین حساب می‌شوند)
+        arrivals = np.unique(np.stack([inflows['product'], inflows['date']], axis=1).astype(np.int64), axis=0)
+        lot_product = arrivals[:, 0]
+        lot_date = arrivals[:, 1]
+        consecutive = lot_product[1:] == lot_product[:-1]
+        gaps = (lot_date[1:] - lot_date[:-1])[consecutive]
+        gap_product = lot_product[1:][consecutive]
+        gap_count = np.bincount(gap_product, minlength=size)
+        gap_total = np.bincount(gap_product, weights=gaps, minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lead_time = np.where(gap_count > 0, gap_total / gap_count, DEFAULT_LEAD_TIME_DAYS)
+        lead_time = np.maximum(lead_time, 1)
+        
+        base_velocity = velocity[30]
+        reorder_point = base_velocity * lead_time + SAFETY_STOCK_Z * daily_std * np.sqrt(lead_time)
+        
+        codes = list(products.items())
+        return {
+            product_id: {
+                'velocity_7': velocity[7][code].item(),
+                'velocity_30': velocity[30][code].item(),
+                'velocity_90': velocity[90][code].item(),
+                'daily_std': daily_std[code].item(),
+                'lead_time_days': lead_time[code].item(),
+                'reorder_point': reorder_point[code].item(),
+            }
+            for product_id, code in codes
+        }
+    
+    def refresh_forecasts(self, full=False):
+        """به‌روزرسانی جدول پیش‌بینی؛ با تغییر روز همه محصولات، در غیر این صورت فقط محصولات تغییر کرده"""
+        today = datetime.date.today()
+        day = self.execute_query("SELECT value FROM app_meta WHERE key = 'forecast_day'")
+        full = full or not day or day[0]['value'] != today.toordinal()
+        if not full and not self.execute_query("SELECT 1 FROM forecast_dirty LIMIT 1"):
+            return 0
+        
+        forecasts = self.compute_forecasts(today)
+        empty = {'velocity_7': 0, 'velocity_30': 0, 'velocity_90': 0, 'daily_std': 0,
+                 'lead_time_days': DEFAULT_LEAD_TIME_DAYS, 'reorder_point': 0}
+        
+        def op(cursor):
+            if full:
+                rows = cursor.execute("SELECT id, stock FROM products").fetchall()
+            else:
+                rows = cursor.execute(
+                    "SELECT id, stock FROM products WHERE id IN (SELECT product_id FROM forecast_dirty)"
+                ).fetchall()
+            values = []
+            for row in rows:
+                f = forecasts.get(row['id'], empty)
+                cover = max(row['stock'], 0) / f['velocity_30'] if f['velocity_30'] > 0 else None
+                values.append((row['id'], f['velocity_7'], f['velocity_30'], f['velocity_90'], f['daily_std'],
+                               f['lead_time_days'], cover, f['reorder_point'], today.isoformat()))
+            cursor.executemany("""
+                INSERT OR REPLACE INTO product_forecasts
+                (product_id, velocity_7, velocity_30, velocity_90, daily_std, lead_time_days,
+                 days_of_cover, reorder_point, computed_on)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, values)
+            if full:
+                cursor.execute("DELETE FROM product_forecasts WHERE product_id NOT IN (SELECT id FROM products)")
+                cursor.execute("UPDATE app_meta SET value = ? WHERE key = 'forecast_day'", (today.toordinal(),))
+            cursor.execute("DELETE FROM forecast_dirty")
+            return len(values)
+        return self.write(op, quiet=True) or 0
+    
+    def get_forecasts(self):
+        """پیش‌بینی هر محصول به صورت دیکشنری product_id -> ردیف"""
+        result = self.execute_query("SELECT * FROM product_forecasts")
+        return {row['product_id']: row for row in result} if result else {}
+    
+    def get_reorder_report(self, only_due=True):
+        query = """
+            SELECT p.id, p.name, p.color, p.stock, f.velocity_7, f.velocity_30, f.velocity_90,
+                   f.lead_time_days, f.days_of_cover, f.reorder_point,
+                   MAX(f.reorder_point + f.velocity_30 * f.lead_time_days - p.stock, 0) as suggested_qty
+            FROM products p
+            JOIN product_forecasts f ON f.product_id = p.id
+        """
+        if only_due:
+            query += " WHERE f.velocity_30 > 0 AND p.stock <= f.reorder_point"
+        query += " ORDER BY COALESCE(f.days_of_cover, 1e18), f.velocity_30 DESC"
+        return self.execute_query(query)
+    
+    # ==================== سودآوری و کلاس‌بندی ABC ====================
+    def refresh_profitability(self):
+        """به‌روزرسانی خلاصه سودآوری محصولات تغییر کرده و بازکلاس‌بندی ABC"""
+        if not self.execute_query("SELECT 1 FROM profit_dirty LIMIT 1"):
+            return 0
+        metrics = {row['key']: row for row in self.analytics.group_by('product')}
+        a_limit, b_limit = ABC_THRESHOLDS
+        
+        def op(cursor):
+            dirty = [row[0] for row in cursor.execute(
+                "SELECT product_id FROM profit_dirty WHERE product_id IN (SELECT id FROM products)")]
+            values = []
+            for product_id in dirty:
+                m = metrics.get(product_id)
+                values.append((product_id,) + ((m['qty'], m['revenue'], m['cogs'], m['commission'], m['shipping'],
+                                                m['profit'], m['margin'], m['returned_qty'], m['return_rate'])
+                                               if m else (0,) * 9))
+            cursor.executemany("""
+                INSERT INTO product_profitability
+                (product_id, qty, revenue, cogs, commission, shipping, profit, margin, returned_qty, return_rate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(product_id) DO UPDATE SET
+                    qty = excluded.qty, revenue = excluded.revenue, cogs = excluded.cogs,
+                    commission = excluded.commission, shipping = excluded.shipping, profit = excluded.profit,
+                    margin = excluded.margin, returned_qty = excluded.returned_qty, return_rate = excluded.return_rate
+            """, values)
+            cursor.execute("DELETE FROM product_profitability WHERE product_id NOT IN (SELECT id FROM products)")
+            
+            # رتبه و کلاس ABC با سهم تجمعی قبل از هر محصول (پارتو)؛ فقط ردیف‌های تغییر کرده نوشته می‌شوند
+            cursor.execute("""
+                WITH ranked AS (
+                    SELECT product_id,
+                           ROW_NUMBER() OVER (ORDER BY revenue DESC, product_id) as revenue_rank,
+                           SUM(revenue) OVER (ORDER BY revenue DESC, product_id ROWS UNBOUNDED PRECEDING) - revenue
+                               as revenue_before,
+                           SUM(revenue) OVER () as revenue_total,
+                           SUM(MAX(profit, 0)) OVER (ORDER BY profit DESC, product_id ROWS UNBOUNDED PRECEDING)
+                               - MAX(profit, 0) as profit_before,
+                           SUM(MAX(profit, 0)) OVER () as profit_total
+                    FROM product_profitability
+                ),
+                classified AS (
+                    SELECT ranked.product_id, ranked.revenue_rank,
+                           CASE WHEN pp.revenue <= 0 THEN 'C'
+                                WHEN revenue_before < :a * revenue_total THEN 'A'
+                                WHEN revenue_before < :b * revenue_total THEN 'B'
+                                ELSE 'C' END as abc_revenue,
+                           CASE WHEN pp.profit <= 0 THEN 'C'
+                                WHEN profit_before < :a * profit_total THEN 'A'
+                                WHEN profit_before < :b * profit_total THEN 'B'
+                                ELSE 'C' END as abc_profit
+                    FROM ranked JOIN product_profitability pp ON pp.product_id = ranked.product_id
+                )
+                UPDATE product_profitability
+                SET revenue_rank = c.revenue_rank, abc_revenue = c.abc_revenue, abc_profit = c.abc_profit
+                FROM classified c
+                WHERE c.product_id = product_profitability.product_id
+                  AND (product_profitability.revenue_rank IS NOT c.revenue_rank
+                       OR product_profitability.abc_revenue IS NOT c.abc_revenue
+                       OR product_profitability.abc_profit IS NOT c.abc_profit)
+            """, {'a': a_limit, 'b': b_limit})
+            cursor.execute("DELETE FROM profit_dirty")
+            return len(values)
+        return self.write(op) or 0
+    
+    def get_profitability(self, sort='revenue', descending=True, page=1, per_page=50, abc_revenue=None, abc_profit=None):
+        """یک صفحه از گزارش سودآوری: (ردیف‌ها، تعداد کل، جمع‌ها)"""
+        where, params = [], []
+        if abc_revenue:
+            where.append("pp.abc_revenue = ?")
+            params.append(abc_revenue)
+        if abc_profit:
+            where.append("pp.abc_profit = ?")
+            params.append(abc_profit)
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+        
+        order = 'p.name' if sort == 'name' else f"pp.{sort if sort in PROFITABILITY_SORTS else 'revenue'}"
+        order += " DESC" if descending else " ASC"
+        totals = self.execute_query(f"""
+            SELECT COUNT(*) as count, COALESCE(SUM(revenue), 0) as revenue, COALESCE(SUM(profit), 0) as profit
+            FROM product_profitability pp {where_sql}
+        """, params)[0]
+        all_totals = self.execute_query("""
+            SELECT COALESCE(SUM(revenue), 0) as revenue, COALESCE(SUM(MAX(profit, 0)), 0) as profit
+            FROM product_profitability
+        """)[0]
+        rows = self.execute_query(f"""
+            SELECT pp.*, p.name, p.color,
+                   CASE WHEN ? > 0 THEN pp.revenue * 100.0 / ? ELSE 0 END as revenue_share,
+                   CASE WHEN ? > 0 THEN MAX(pp.profit, 0) * 100.0 / ? ELSE 0 END as profit_share
+            FROM product_profitability pp
+            JOIN products p ON p.id = pp.product_id
+            {where_sql}
+            ORDER BY {order}, pp.product_id
+            LIMIT ? OFFSET ?
+        """, [all_totals['revenue'], all_totals['revenue'], all_totals['profit'], all_totals['profit']]
+             + params + [per_page, (max(page, 1) - 1) * per_page])
+        return rows or [], totals['count'], dict(totals)
     
     # ==================== مراکز فروش ====================
     def get_centers(self):
@@ -531,28 +2245,168 @@ class DBManager:
         )
     
     # ==================== تسویه ====================
-    def add_settlement(self, center_id, amount, settlement_date, description=""):
-        self.execute_insert(
-            "INSERT INTO settlements (center_id, amount, settlement_date, description) VALUES (?, ?, ?, ?)",
-            (center_id, amount, settlement_date, description)
-        )
+    def add_settlement(self, center_id, amount, settlement_date, description="", allocate=False):
+        def op(cursor):
+            settlement_id = cursor.execute(
+                "INSERT INTO settlements (center_id, amount, settlement_date, description) VALUES (?, ?, ?, ?)",
+                (center_id, amount, settlement_date, description)
+            ).lastrowid
+            allocation = self._allocate_settlement(cursor, settlement_id, center_id, amount) if allocate else None
+            return settlement_id, allocation
+        return self.write(op) or (None, None)
+    
+    def _allocate_settlement(self, cursor, settlement_id, center_id, amount):
+        """تخصیص مبلغ تسویه به قدیمی‌ترین خروجی‌های پرداخت‌نشده مرکز (خالص کمیسیون و ارسال)
+        
+        تخصیص در اولین خروجی که جمع را از مبلغ بیشتر کند متوقف می‌شود (با خالص منفی هم فقط پیشوند انتخاب می‌شود)
+        """
+        cursor.execute("""
+            INSERT INTO settlement_allocations (settlement_id, outflow_id, amount)
+            SELECT ?, id, net FROM (
+                SELECT id, net, MAX(running > ?) OVER (ORDER BY outflow_date, id) as overflowed
+                FROM (
+                    SELECT id, outflow_date, (quantity * sell_price) - commission_amount - shipping_cost as net,
+                           SUM((quantity * sell_price) - commission_amount - shipping_cost)
+                               OVER (ORDER BY outflow_date, id) as running
+                    FROM outflows
+                    WHERE center_id = ? AND is_paid = 0 AND is_returned = 0
+                )
+            ) WHERE overflowed = 0
+        """, (settlement_id, amount, center_id))
+        cursor.execute("""
+            UPDATE outflows SET is_paid = 1
+            WHERE id IN (SELECT outflow_id FROM settlement_allocations WHERE settlement_id = ?)
+        """, (settlement_id,))
+        count = cursor.rowcount
+        allocated = cursor.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM settlement_allocations WHERE settlement_id = ?", (settlement_id,)
+        ).fetchone()[0]
+        return {'count': count, 'allocated': allocated, 'unallocated': amount - allocated}
     
     def get_settlements(self, center_id=None):
-        if center_id:
-            return self.execute_query("""
-                SELECT s.id, sc.name as center_name, s.amount, s.settlement_date, s.description
-                FROM settlements s JOIN sales_centers sc ON s.center_id = sc.id
-                WHERE s.center_id = ?
-                ORDER BY s.settlement_date DESC
-            """, (center_id,))
-        return self.execute_query("""
-            SELECT s.id, sc.name as center_name, s.amount, s.settlement_date, s.description
+        query = """
+            SELECT s.id, sc.name as center_name, s.amount, s.settlement_date, s.description,
+                   COALESCE((SELECT SUM(amount) FROM settlement_allocations WHERE settlement_id = s.id), 0) as allocated,
+                   (SELECT COUNT(*) FROM settlement_allocations WHERE settlement_id = s.id) as allocated_count
             FROM settlements s JOIN sales_centers sc ON s.center_id = sc.id
-            ORDER BY s.settlement_date DESC
-        """)
+        """
+        if center_id:
+            return self.execute_query(query + " WHERE s.center_id = ? ORDER BY s.settlement_date DESC", (center_id,))
+        return self.execute_query(query + " ORDER BY s.settlement_date DESC")
     
     def delete_settlement(self, settlement_id):
-        self.execute_query("DELETE FROM settlements WHERE id = ?", (settlement_id,))
+        def op(cursor):
+            # خروجی‌هایی که با این تسویه پرداخت شده بودند دوباره باز می‌شوند
+            cursor.execute("""
+                UPDATE outflows SET is_paid = 0
+                WHERE id IN (SELECT outflow_id FROM settlement_allocations WHERE settlement_id = ?)
+            """, (settlement_id,))
+            cursor.execute("DELETE FROM settlement_allocations WHERE settlement_id = ?", (settlement_id,))
+            cursor.execute("DELETE FROM settlements WHERE id = ?", (settlement_id,))
+        self.write(op)
+    
+    # ==================== نرخ دلار و ارزش‌گذاری ارزی ====================
+    def get_exchange_rates(self, limit=60):
+        return self.execute_query("SELECT rate_date, rate FROM exchange_rates ORDER BY rate_date DESC LIMIT ?", (limit,))
+    
+    def set_exchange_rate(self, rate_date, rate):
+        self.execute_query("INSERT OR REPLACE INTO exchange_rates (rate_date, rate) VALUES (?, ?)", (rate_date, rate))
+    
+    def delete_exchange_rate(self, rate_date):
+        self.execute_query("DELETE FROM exchange_rates WHERE rate_date = ?", (rate_date,))
+    
+    def get_rate_on(self, date=None):
+        """آخرین نرخ ثبت‌شده تا تاریخ داده‌شده (پیش‌فرض امروز): (تاریخ، نرخ) یا (None, None)"""
+        date = date or datetime.date.today().isoformat()
+        result = self.execute_query(
+            "SELECT rate_date, rate FROM exchange_rates WHERE rate_date <= ? ORDER BY rate_date DESC LIMIT 1", (date,)
+        )
+        return (result[0]['rate_date'], result[0]['rate']) if result else (None, None)
+    
+    def _effective_rates(self, rates, dates):
+        """نرخ خرید هر لات: dollar_rate خود لات، وگرنه نرخ جدول در تاریخ ورود (۰ یعنی نامعلوم)"""
+        table = self.execute_query("SELECT rate_date, rate FROM exchange_rates ORDER BY rate_date") or []
+        if not table:
+            return rates
+        table_dates = np.array([datetime.date.fromisoformat(row['rate_date']).toordinal() for row in table])
+        table_rates = np.array([row['rate'] for row in table], dtype=np.float64)
+        index = np.searchsorted(table_dates, dates, side='right') - 1
+        looked_up = np.where(index >= 0, table_rates[np.maximum(index, 0)], 0.0)
+        return np.where(rates > 0, rates, looked_up)
+    
+    def get_revaluation(self):
+        """ارزش لات‌های باز و بهای تمام شده تاریخی به دلار (نرخ خرید) و به تومان با نرخ امروز
+        
+        خروجی‌ها به لات مشخصی وصل نیستند، پس دلار بهای تمام شده با میانگین وزنی نرخ خرید
+        همه ورودی‌های همان محصول تبدیل می‌شود.
+        """
+        rate_date, today_rate = self.get_rate_on()
+        
+        # لات‌های باز
+        lots = self.execute_query(
+            "SELECT product_id, remaining, buy_price, inflow_date, dollar_rate FROM inflows WHERE remaining > 0"
+        ) or []
+        lot_product = np.array([row['product_id'] or 0 for row in lots], dtype=np.int64)
+        remaining = np.array([row['remaining'] for row in lots], dtype=np.float64)
+        book = remaining * np.array([row['buy_price'] for row in lots], dtype=np.float64)
+        lot_dates = np.array([datetime.date.fromisoformat(row['inflow_date'][:10]).toordinal() for row in lots],
+                             dtype=np.int64)
+        lot_rates = self._effective_rates(np.array([row['dollar_rate'] or 0 for row in lots], dtype=np.float64),
+                                          lot_dates)
+        rated = lot_rates > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lot_usd = np.where(rated, book / lot_rates, 0.0)
+        lot_ids, lot_codes = np.unique(lot_product, return_inverse=True)
+        per_lot = {
+            'remaining_qty': np.bincount(lot_codes, weights=remaining, minlength=len(lot_ids)),
+            'inventory_book': np.bincount(lot_codes, weights=book, minlength=len(lot_ids)),
+            'inventory_usd': np.bincount(lot_codes, weights=lot_usd, minlength=len(lot_ids)),
+            'unrated_qty': np.bincount(lot_codes, weights=np.where(rated, 0, remaining), minlength=len(lot_ids)),
+        }
+        
+        # بهای تمام شده فروش‌ها (بدون برگشتی) و میانگین نرخ خرید هر محصول
+        outflows, inflows, products, _ = self.analytics.snapshot()
+        size = len(products)
+        sold = ~outflows['returned']
+        cogs_book = np.bincount(outflows['product'], weights=np.where(sold, outflows['qty'] * outflows['cogs_unit'], 0),
+                                minlength=size)
+        inflow_book = inflows['qty'] * inflows['price']
+        inflow_rates = self._effective_rates(inflows['rate'], inflows['date'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inflow_usd = np.where(inflow_rates > 0, inflow_book / inflow_rates, 0.0)
+            rated_book = np.bincount(inflows['product'], weights=np.where(inflow_rates > 0, inflow_book, 0), minlength=size)
+            usd_per_rial = np.where(rated_book > 0,
+                                    np.bincount(inflows['product'], weights=inflow_usd, minlength=size) / rated_book, 0.0)
+        cogs_usd = cogs_book * usd_per_rial
+        
+        rows = {}
+        for index, product_id in enumerate(lot_ids.tolist()):
+            rows[product_id] = {name: values[index].item() for name, values in per_lot.items()}
+        for product_id, code in products.items():
+            if cogs_book[code]:
+                row = rows.setdefault(product_id, {name: 0.0 for name in per_lot})
+                row['cogs_book'] = cogs_book[code].item()
+                row['cogs_usd'] = cogs_usd[code].item()
+        
+        names = {p['id']: p for p in self.get_products() or []}
+        products_list = []
+        for product_id, row in rows.items():
+            row.setdefault('cogs_book', 0.0)
+            row.setdefault('cogs_usd', 0.0)
+            row['inventory_today'] = row['inventory_usd'] * today_rate if today_rate else None
+            row['cogs_today'] = row['cogs_usd'] * today_rate if today_rate else None
+            product = names.get(product_id)
+            row.update(product_id=product_id,
+                       name=product['name'] if product else f"#{product_id}",
+                       color=product['color'] if product else '')
+            products_list.append(row)
+        products_list.sort(key=lambda row: row['inventory_usd'], reverse=True)
+        
+        totals = {name: sum(row[name] for row in products_list)
+                  for name in ('remaining_qty', 'inventory_book', 'inventory_usd', 'unrated_qty', 'cogs_book', 'cogs_usd')}
+        totals['inventory_today'] = totals['inventory_usd'] * today_rate if today_rate else None
+        totals['cogs_today'] = totals['cogs_usd'] * today_rate if today_rate else None
+        return {'rate_date': rate_date, 'today_rate': today_rate, 'totals': totals, 'products': products_list}
     
     # ==================== حساب نقدی ====================
     def add_cash_transaction(self, trans_type, amount, source, description, trans_date):
@@ -574,15 +2428,58 @@ class DBManager:
     def delete_cash_transaction(self, trans_id):
         self.execute_query("DELETE FROM cash_transactions WHERE id = ?", (trans_id,))
     
-    def get_cash_summary(self):
-        deposits = self.execute_query("SELECT COALESCE(SUM(amount), 0) as total FROM cash_transactions WHERE transaction_type = 'deposit'")
-        withdraws = self.execute_query("SELECT COALESCE(SUM(amount), 0) as total FROM cash_transactions WHERE transaction_type = 'withdraw'")
-        total_deposits = deposits[0]['total'] if deposits else 0
-        total_withdraws = withdraws[0]['total'] if withdraws else 0
-        return total_deposits, total_withdraws, total_deposits - total_withdraws
+    def get_cash_page(self, page=1, per_page=CASH_PAGE_SIZE):
+        """یک صفحه تراکنش (جدیدترین اول) با مانده بعد از هر ردیف
+        
+        جمع پنجره‌ای فقط روی ردیف‌های همین صفحه؛ مانده اولین ردیف هر بخش از دفتر (نقطه کنترل + باقیمانده).
+        ردیف‌های آرشیو شده بین ردیف‌های صفحه نیستند، پس صفحه در مرز سال‌های بسته شده به چند بخش تقسیم می‌شود
+        (ردیفی که تاریخش داخل یک سال بسته شده است خودش یک بخش است).
+        """
+        offset = (max(page, 1) - 1) * per_page
+        with self.read_snapshot():
+            result = self.execute_query("SELECT COUNT(*) as cnt FROM cash_transactions")
+            total = result[0]['cnt'] if result else 0
+            rows = self.execute_query("""
+                SELECT *, COALESCE(SUM(CASE transaction_type WHEN 'deposit' THEN amount WHEN 'withdraw' THEN -amount ELSE 0 END)
+                              OVER (PARTITION BY segment ORDER BY transaction_date DESC, id DESC
+                                    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) as newer_in_segment
+                FROM (
+                    SELECT id, transaction_type, amount, source, description, transaction_date,
+                           CASE WHEN EXISTS (SELECT 1 FROM fiscal_closings
+                                             WHERE start_date <= transaction_date AND end_date > transaction_date) THEN -id
+                                ELSE (SELECT COUNT(*) FROM fiscal_closings WHERE start_date > transaction_date) END as segment
+                    FROM (
+                        SELECT id, transaction_type, amount, source, description, transaction_date FROM cash_transactions
+                        ORDER BY transaction_date DESC, id DESC LIMIT ? OFFSET ?
+                    )
+                )
+                ORDER BY transaction_date DESC, id DESC
+            """, (per_page, offset)) or []
+            anchors = {}
+            transactions = []
+            for row in rows:
+                if row['segment'] not in anchors:
+                    anchors[row['segment']] = self.get_ledger_balance(
+                        'cash', row['transaction_date'], row['id'])['balance']
+                transaction = dict(row)
+                transaction['running_balance'] = anchors[row['segment']] - row['newer_in_segment']
+                transactions.append(transaction)
+        return transactions, total
+    
+    def get_cash_summary(self, as_of=None):
+        balance = self.get_ledger_balance('cash', as_of)
+        return balance['debit'], balance['credit'], balance['balance']
+    
+    def get_cash_opening_balance(self):
+        result = self.execute_query("SELECT COALESCE(SUM(cash_deposits - cash_withdraws), 0) as total FROM fiscal_closings")
+        return result[0]['total'] if result else 0
     
     # ==================== داشبورد ====================
     def get_dashboard_stats(self):
+        with self.read_snapshot():
+            return self._dashboard_stats()
+    
+    def _dashboard_stats(self):
         stats = {}
         
         result = self.execute_query("""
@@ -593,11 +2490,16 @@ class DBManager:
                 COALESCE(SUM(shipping_cost), 0) as shipping
             FROM outflows WHERE is_returned = 0
         """)
+        archived = self.execute_query("""
+            SELECT COALESCE(SUM(revenue), 0) as revenue, COALESCE(SUM(cogs), 0) as cogs,
+                   COALESCE(SUM(commission), 0) as commission, COALESCE(SUM(shipping), 0) as shipping
+            FROM fiscal_closings
+        """)
         if result:
-            stats['revenue'] = result[0]['revenue']
-            stats['cogs'] = result[0]['cogs']
-            stats['commission'] = result[0]['commission']
-            stats['shipping'] = result[0]['shipping']
+            stats['revenue'] = result[0]['revenue'] + (archived[0]['revenue'] if archived else 0)
+            stats['cogs'] = result[0]['cogs'] + (archived[0]['cogs'] if archived else 0)
+            stats['commission'] = result[0]['commission'] + (archived[0]['commission'] if archived else 0)
+            stats['shipping'] = result[0]['shipping'] + (archived[0]['shipping'] if archived else 0)
             stats['profit'] = stats['revenue'] - stats['cogs'] - stats['commission'] - stats['shipping']
         else:
             stats['revenue'] = stats['cogs'] = stats['commission'] = stats['shipping'] = stats['profit'] = 0
@@ -626,15 +2528,1574 @@ class DBManager:
                 COALESCE(SUM(CASE WHEN o.is_returned = 0 THEN o.quantity * o.sell_price ELSE 0 END), 0) as total_sales,
                 COALESCE(SUM(CASE WHEN o.is_returned = 0 THEN o.commission_amount ELSE 0 END), 0) as total_commission,
                 COALESCE(SUM(CASE WHEN o.is_returned = 0 THEN o.shipping_cost ELSE 0 END), 0) as total_shipping,
-                COALESCE((SELECT SUM(amount) FROM settlements WHERE center_id = sc.id), 0) as settled
+                COALESCE((SELECT SUM(amount) FROM settlements WHERE center_id = sc.id), 0)
+                  - COALESCE((SELECT SUM(sa.amount) FROM settlement_allocations sa
+                              JOIN settlements s ON sa.settlement_id = s.id WHERE s.center_id = sc.id), 0) as settled
             FROM sales_centers sc
             LEFT JOIN outflows o ON sc.id = o.center_id AND o.is_paid = 0
             GROUP BY sc.id
         """)
+    
+    # ==================== دفتر حساب‌ها ====================
+    def _ledger_sources(self, account):
+        """ردیف‌های هر حساب: (جدول، ستون تاریخ، مبلغ بدهکار، مبلغ بستانکار، شرط، پارامترها، آرشیو می‌شود)"""
+        if account == 'cash':
+            return [('cash_transactions', 'transaction_date',
+                     "CASE WHEN transaction_type = 'deposit' THEN amount ELSE 0 END",
+                     "CASE WHEN transaction_type = 'withdraw' THEN amount ELSE 0 END", "1", [], True)]
+        kind, _, center_id = account.partition(':')
+        if kind != 'center' or not center_id.isdigit():
+            raise ValueError(f"unknown ledger account: {account}")
+        return [('outflows', 'outflow_date',
+                 "CASE WHEN is_returned = 0 THEN quantity * sell_price - commission_amount - shipping_cost ELSE 0 END",
+                 "0", "center_id = ?", [int(center_id)], True),
+                ('settlements', 'settlement_date', "0", "amount", "center_id = ?", [int(center_id)], False)]
+    
+    def _ledger_sum(self, fetch, account, after=None, through=None, through_id=None, schema='main'):
+        """جمع بدهکار/بستانکار ردیف‌های حساب با تاریخ بعد از after تا through (با through_id: تا همان ردیف)"""
+        debit = credit = 0
+        for table, date_column, debit_sql, credit_sql, where, params, archived in self._ledger_sources(account):
+            if schema != 'main' and not archived:
+                continue
+            clauses, args = [where], list(params)
+            if after:
+                clauses.append(f"{date_column} > ?")
+                args.append(after)
+            if through and through_id is not None:
+                clauses.append(f"({date_column} < ? OR ({date_column} = ? AND id <= ?))")
+                args += [through, through, through_id]
+            elif through:
+                clauses.append(f"{date_column} <= ?")
+                args.append(through)
+            row = fetch(f"""
+                SELECT COALESCE(SUM({debit_sql}), 0), COALESCE(SUM({credit_sql}), 0)
+                FROM {schema}.{table} WHERE {' AND '.join(clauses)}
+            """, args) or (0, 0)
+            debit += row[0]
+            credit += row[1]
+        return debit, credit
+    
+    def _ledger_main(self, fetch, account, through=None, through_id=None):
+        """مانده ردیف‌های جدول‌های اصلی: آخرین نقطه کنترل قبل از through + جمع ردیف‌های بعد از آن"""
+        query = "SELECT as_of, debit, credit FROM ledger_checkpoints WHERE account = ?"
+        params = [account]
+        if through:
+            # با through_id ردیف‌های همان روز بعد از through_id نباید در مانده باشند
+            query += " AND as_of < ?" if through_id is not None else " AND as_of <= ?"
+            params.append(through)
+        checkpoint = fetch(query + " ORDER BY as_of DESC LIMIT 1", params)
+        debit, credit = self._ledger_sum(fetch, account, checkpoint[0] if checkpoint else None, through, through_id)
+        if checkpoint:
+            debit += checkpoint[1]
+            credit += checkpoint[2]
+        return debit, credit
+    
+    def _ledger_closed(self, account, through=None):
+        """سهم سال‌های مالی بسته شده؛ سالی که through وسط آن است از فایل آرشیو تا همان روز جمع زده می‌شود"""
+        if account == 'cash':
+            query = "SELECT COALESCE(SUM(cash_deposits), 0), COALESCE(SUM(cash_withdraws), 0) FROM fiscal_closings fc WHERE 1"
+            params = []
+        else:
+            query = """
+                SELECT COALESCE(SUM(fcc.net), 0), 0 FROM fiscal_closing_centers fcc
+                JOIN fiscal_closings fc ON fc.year = fcc.year WHERE fcc.center_id = ?
+            """
+            params = [int(account.partition(':')[2])]
+        if through:
+            query += " AND fc.end_date <= date(?, '+1 day')"
+            params.append(through)
+        result = self.execute_query(query, params)
+        debit, credit = (result[0][0], result[0][1]) if result else (0, 0)
+        if not through:
+            return debit, credit
+        years = self.execute_query(
+            "SELECT year FROM fiscal_closings WHERE start_date <= ? AND end_date > date(?, '+1 day')", (through, through)
+        ) or []
+        for row in years:
+            if not os.path.exists(self.get_archive_path(row['year'])):
+                continue
+            conn = self.get_connection(attach=(row['year'],))
+            try:
+                year_debit, year_credit = self._ledger_sum(lambda query, params: conn.execute(query, params).fetchone(),
+                                                           account, through=through, schema=f"arch_{int(row['year'])}")
+            finally:
+                conn.close()
+            debit += year_debit
+            credit += year_credit
+        return debit, credit
+    
+    def _fetch_one(self, query, params=()):
+        result = self.execute_query(query, params)
+        return result[0] if result else None
+    
+    def get_ledger_balance(self, account, as_of=None, through_id=None):
+        """مانده حساب (cash یا center:<id>) تا پایان روز as_of؛ بدون as_of مانده فعلی"""
+        self._ledger_sources(account)  # حساب نامعتبر ValueError می‌دهد
+        with self.read_snapshot():
+            debit, credit = self._ledger_closed(account, as_of)
+            main_debit, main_credit = self._ledger_main(self._fetch_one, account, as_of, through_id)
+        debit += main_debit
+        credit += main_credit
+        return {'account': account, 'as_of': as_of, 'debit': debit, 'credit': credit, 'balance': debit - credit}
+    
+    def get_center_balances(self, as_of=None):
+        """مانده حساب هر مرکز: فروش خالص برگشت نخورده منهای تسویه‌ها"""
+        with self.read_snapshot():
+            return [dict(self.get_ledger_balance(f"center:{center['id']}", as_of), id=center['id'], name=center['name'])
+                    for center in self.get_centers() or []]
+    
+    def get_ledger_accounts(self):
+        return ['cash'] + [f"center:{center['id']}" for center in self.get_centers() or []]
+    
+    def create_ledger_checkpoints(self, dates=None):
+        """ثبت نقاط کنترل نبود هر حساب؛ هر نقطه از نقطه قبلی + ردیف‌های بین آن دو، در یک تراکنش نوشتن"""
+        dates = sorted(dates or ledger_checkpoint_dates())
+        accounts = self.get_ledger_accounts()
+        
+        def op(cursor):
+            fetch = lambda query, params: cursor.execute(query, params).fetchone()
+            created_at = datetime.datetime.now().isoformat(timespec='seconds')
+            created = 0
+            for account in accounts:
+                existing = {row[0] for row in cursor.execute(
+                    "SELECT as_of FROM ledger_checkpoints WHERE account = ? AND as_of >= ?", (account, dates[0]))}
+                for as_of in dates:
+                    if as_of in existing:
+                        continue
+                    debit, credit = self._ledger_main(fetch, account, as_of)
+                    cursor.execute(
+                        "INSERT INTO ledger_checkpoints (account, as_of, debit, credit, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (account, as_of, debit, credit, created_at)
+                    )
+                    created += 1
+            return created
+        return self.write(op, quiet=True) or 0
+    
+    # ==================== API نسخه ۱ ====================
+    def get_api_rows(self, resource, fields, filters=None, after_id=0, limit=API_V1_PAGE_SIZE):
+        """ردیف‌های یک منبع به صورت مدل tuple فقط با ستون‌های fields، صفحه‌بندی بر اساس id (بعد از after_id)"""
+        spec = API_V1_RESOURCES[resource]
+        model = api_model(resource, fields)
+        filters = filters or {}
+        if resource == 'ledgers':
+            accounts = [filters['account']] if filters.get('account') else self.get_ledger_accounts()
+            with self.read_snapshot():
+                balances = [self.get_ledger_balance(account, filters.get('as_of')) for account in accounts]
+            return [model._make(balance[name] for name in fields) for balance in balances]
+        
+        clauses, params = ["id > ?"], [after_id]
+        for name, value in filters.items():
+            clauses.append(spec['filters'][name])
+            params += [value] * spec['filters'][name].count('?')
+        years = self.get_archive_years_for_range(filters.get('start'), filters.get('end')) if spec.get('archived') else []
+        source = self._archive_source(spec['table'], spec['archived'], years) if years else spec['table']
+        query = (f"SELECT {', '.join(fields)} FROM {source} WHERE {' AND '.join(clauses)} "
+                 f"ORDER BY id LIMIT ?")
+        rows = self.execute_query(query, params + [limit], attach=years)
+        return [model._make(row) for row in rows or []]
+    
+    # ==================== سری زمانی قیمت ====================
+    def get_price_series(self, product_id=None, center_id=None, bucket='week', points=PRICE_SERIES_POINTS,
+                         start=None, end=None):
+        """سری قیمت خرید و فروش، بها و حجم از رول‌آپ روزانه؛ جمع در بازه‌های شمسی و کاهش نمونه با LTTB
+        
+        بدون محصول همه محصولات و بدون مرکز همه مراکز جمع زده می‌شوند؛ با مرکز فقط سری فروش برمی‌گردد.
+        """
+        series = {}
+        with self.read_snapshot():
+            for kind in (('sell',) if center_id else ('buy', 'sell')):
+                clauses, params = ["kind = ?"], [kind]
+                for column, value in (('product_id', product_id), ('center_id', center_id)):
+                    if value:
+                        clauses.append(f"{column} = ?")
+                        params.append(value)
+                if start:
+                    clauses.append("day >= ?")
+                    params.append(start)
+                if end:
+                    clauses.append("day <= ?")
+                    params.append(end)
+                rows = self.execute_query(f"""
+                    SELECT day, SUM(count) as count, {', '.join(f'SUM({name}) as {name}' for name in PRICE_ROLLUP_MEASURES)}
+                    FROM price_daily WHERE {' AND '.join(clauses)}
+                    GROUP BY day HAVING SUM(count) > 0 ORDER BY day
+                """, params) or []
+                series[kind] = self._bucket_price_rows(kind, rows, bucket, points)
+        return series
+    
+    @staticmethod
+    def _bucket_price_rows(kind, rows, bucket, points):
+        buckets = OrderedDict()
+        for row in rows:
+            key = persian_bucket(row['day'], bucket)
+            totals = buckets.setdefault(key, dict.fromkeys(('count',) + PRICE_ROLLUP_MEASURES, 0))
+            for name in totals:
+                totals[name] += row[name]
+        result = []
+        for (date, label), totals in buckets.items():
+            qty = totals['qty']
+            if qty <= 0:
+                continue
+            point = {'date': date, 'label': label, 'count': totals['count'], 'qty': qty,
+                     'avg_price': totals['amount'] / qty}
+            if kind == 'sell':
+                point['avg_cost'] = totals['cost'] / qty
+                point['margin'] = (totals['amount'] - totals['cost']) / totals['amount'] if totals['amount'] else None
+            else:
+                point['avg_price_usd'] = totals['usd_amount'] / totals['usd_qty'] if totals['usd_qty'] else None
+            result.append(point)
+        # نقاط بر اساس میانگین قیمت انتخاب می‌شوند؛ بقیه مقادیر همان بازه‌ها همراهشان می‌آید
+        keep = lttb_indices([datetime.date.fromisoformat(point['date']).toordinal() for point in result],
+                            [point['avg_price'] for point in result], points)
+        return [result[i] for i in keep]
+    
+    # ==================== سال مالی و آرشیو ====================
+    def get_archive_path(self, year):
+        base, _ = os.path.splitext(self.db_path)
+        return f"{base}_archive_{int(year)}.db"
+    
+    def get_fiscal_closings(self):
+        return self.execute_query("SELECT * FROM fiscal_closings ORDER BY year DESC")
+    
+    def get_archive_years_for_range(self, start_date=None, end_date=None):
+        """سال‌های آرشیوی که با بازه تاریخ تداخل دارند (بدون تاریخ شروع فقط داده‌های جاری خوانده می‌شود)"""
+        if not start_date:
+            return []
+        query = "SELECT year FROM fiscal_closings WHERE end_date > ?"
+        params = [start_date]
+        if end_date:
+            query += " AND start_date <= ?"
+            params.append(end_date)
+        result = self.execute_query(query + " ORDER BY year", params)
+        return [row['year'] for row in result] if result else []
+    
+    def _archive_source(self, table, columns, years):
+        if not years:
+            return table
+        parts = [f"SELECT {columns} FROM main.{table}"]
+        parts += [f"SELECT {columns} FROM arch_{int(year)}.{table}" for year in years]
+        return "(" + " UNION ALL ".join(parts) + ")"
+    
+    def close_fiscal_year(self, year):
+        """انتقال ورودی‌های مصرف‌شده، خروجی‌های پرداخت/برگشت‌شده و تراکنش‌های نقدی یک سال گذشته به فایل آرشیو"""
+        year = int(year)
+        if year >= get_persian_today().year:
+            return False, "فقط سال‌های گذشته قابل بستن هستند"
+        
+        start_date, end_date = get_fiscal_year_range(year)
+        date_range = (start_date, end_date)
+        inflow_where = "inflow_date >= ? AND inflow_date < ? AND remaining <= 0"
+        outflow_where = "outflow_date >= ? AND outflow_date < ? AND (is_paid = 1 OR is_returned = 1)"
+        cash_where = "transaction_date >= ? AND transaction_date < ?"
+        
+        def op(conn):
+            # ATTACH بیرون از تراکنش لازم است؛ برای همین op انحصاری نویسنده است نه یک تغییر معمولی دسته
+            cursor = conn.cursor()
+            cursor.execute("ATTACH DATABASE ? AS arch", (self.get_archive_path(year),))
+            try:
+                return self._archive_year(cursor, year, date_range, inflow_where, outflow_where, cash_where)
+            finally:
+                cursor.execute("DETACH DATABASE arch")
+        
+        try:
+            return self.write_exclusive(op)
+        except sqlite3.Error as e:
+            print(f"Database Error: {e}")
+            return False, "خطا در بستن سال مالی"
+    
+    def _archive_year(self, cursor, year, date_range, inflow_where, outflow_where, cash_where):
+        """خلاصه سال و انتقال ردیف‌ها به arch در یک تراکنش روی اتصال نویسنده"""
+        start_date, end_date = date_range
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for table, columns in (('inflows', INFLOW_COLUMNS), ('outflows', OUTFLOW_COLUMNS),
+                                   ('cash_transactions', CASH_COLUMNS)):
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS arch.{table} AS SELECT {columns} FROM main.{table} WHERE 0")
+            
+            cursor.execute(f"""
+                SELECT COUNT(*) as cnt,
+                       COALESCE(SUM(CASE WHEN is_returned = 0 THEN quantity * sell_price END), 0) as revenue,
+                       COALESCE(SUM(CASE WHEN is_returned = 0 THEN quantity * cogs_unit END), 0) as cogs,
+                       COALESCE(SUM(CASE WHEN is_returned = 0 THEN commission_amount END), 0) as commission,
+                       COALESCE(SUM(CASE WHEN is_returned = 0 THEN shipping_cost END), 0) as shipping
+                FROM main.outflows WHERE {outflow_where}
+            """, date_range)
+            out = cursor.fetchone()
+            cursor.execute(f"SELECT COUNT(*) as cnt FROM main.inflows WHERE {inflow_where}", date_range)
+            inflow_count = cursor.fetchone()['cnt']
+            cursor.execute(f"""
+                SELECT COUNT(*) as cnt,
+                       COALESCE(SUM(CASE WHEN transaction_type = 'deposit' THEN amount END), 0) as deposits,
+                       COALESCE(SUM(CASE WHEN transaction_type = 'withdraw' THEN amount END), 0) as withdraws
+                FROM main.cash_transactions WHERE {cash_where}
+            """, date_range)
+            cash = cursor.fetchone()
+            
+            if out['cnt'] + inflow_count + cash['cnt'] == 0:
+                cursor.execute("ROLLBACK")
+                return False, "موردی برای آرشیو در این سال وجود ندارد"
+            
+            # ردیف‌های خلاصه (مانده‌های منتقل شده به سال بعد)
+            cursor.execute("""
+                INSERT INTO fiscal_closings
+                (year, start_date, end_date, revenue, cogs, commission, shipping,
+                 cash_deposits, cash_withdraws, inflow_count, outflow_count, cash_count, closed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(year) DO UPDATE SET
+                    revenue = revenue + excluded.revenue,
+                    cogs = cogs + excluded.cogs,
+                    commission = commission + excluded.commission,
+                    shipping = shipping + excluded.shipping,
+                    cash_deposits = cash_deposits + excluded.cash_deposits,
+                    cash_withdraws = cash_withdraws + excluded.cash_withdraws,
+                    inflow_count = inflow_count + excluded.inflow_count,
+                    outflow_count = outflow_count + excluded.outflow_count,
+                    cash_count = cash_count + excluded.cash_count,
+                    closed_at = excluded.closed_at
+            """, (year, start_date, end_date, out['revenue'], out['cogs'], out['commission'], out['shipping'],
+                  cash['deposits'], cash['withdraws'], inflow_count, out['cnt'], cash['cnt'],
+                  datetime.datetime.now().isoformat(timespec='seconds')))
+            cursor.execute(f"""
+                INSERT INTO fiscal_closing_centers (year, center_id, count, qty, sales, profit, net)
+                SELECT ?, center_id, COUNT(*), SUM(quantity), SUM(quantity * sell_price),
+                       SUM((quantity * sell_price) - (quantity * cogs_unit) - commission_amount - shipping_cost),
+                       SUM((quantity * sell_price) - commission_amount - shipping_cost)
+                FROM main.outflows WHERE {outflow_where} AND is_returned = 0
+                GROUP BY center_id
+                ON CONFLICT(year, center_id) DO UPDATE SET
+                    count = count + excluded.count, qty = qty + excluded.qty,
+                    sales = sales + excluded.sales, profit = profit + excluded.profit,
+                    net = net + excluded.net
+            """, (year,) + date_range)
+            cursor.execute(f"""
+                INSERT INTO fiscal_closing_products (year, product_id, inflow_qty, outflow_qty, returned_qty)
+                SELECT ?, product_id, SUM(inflow_qty), SUM(outflow_qty), SUM(returned_qty) FROM (
+                    SELECT product_id, quantity as inflow_qty, 0 as outflow_qty, 0 as returned_qty
+                    FROM main.inflows WHERE {inflow_where}
+                    UNION ALL
+                    SELECT product_id, 0, quantity, CASE WHEN is_returned = 1 THEN quantity ELSE 0 END
+                    FROM main.outflows WHERE {outflow_where}
+                ) WHERE 1 GROUP BY product_id
+                ON CONFLICT(year, product_id) DO UPDATE SET
+                    inflow_qty = inflow_qty + excluded.inflow_qty,
+                    outflow_qty = outflow_qty + excluded.outflow_qty,
+                    returned_qty = returned_qty + excluded.returned_qty
+            """, (year,) + date_range + date_range)
+            
+            # تاریخچه قیمت سال‌های بسته شده در رول‌آپ می‌ماند: اثر تریگرهای حذف از قبل جبران می‌شود
+            cursor.execute(self._rollup_aggregate_sql('buy', 'main', inflow_where), date_range)
+            cursor.execute(self._rollup_aggregate_sql('sell', 'main', outflow_where), date_range)
+            for table, columns, where in (('inflows', INFLOW_COLUMNS, inflow_where),
+                                          ('outflows', OUTFLOW_COLUMNS, outflow_where),
+                                          ('cash_transactions', CASH_COLUMNS, cash_where)):
+                cursor.execute(f"INSERT INTO arch.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE {where}", date_range)
+                cursor.execute(f"DELETE FROM main.{table} WHERE {where}", date_range)
+            cursor.execute("DELETE FROM main.outflow_lots WHERE outflow_id NOT IN (SELECT id FROM main.outflows)")
+            
+            self._bump_generation(cursor)
+            cursor.execute("COMMIT")
+            return True, f"سال {year} بسته شد ({inflow_count} ورودی، {out['cnt']} خروجی، {cash['cnt']} تراکنش آرشیو شد)"
+        except sqlite3.Error:
+            if cursor.connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+
+
+# ==================== تحلیل ستونی گزارشات ====================
+ANALYTICS_DIMENSIONS = ('product', 'center', 'category', 'month')
+ANALYTICS_METRICS = ('count', 'qty', 'revenue', 'cogs', 'commission', 'shipping', 'profit',
+                     'margin', 'returned_qty', 'return_rate')
+
+
+class FifoLotCache:
+    """لات‌های باز هر محصول در حافظه worker: آرایه‌های مقدار و قیمت به ترتیب FIFO با جمع تجمعی
+    
+    بهای هر مقدار با جستجوی دودویی روی جمع تجمعی مقدار به دست می‌آید. تریگرهای inflows محصولات
+    تغییر کرده را در fifo_changes ثبت می‌کنند؛ با تغییر نسخه نوشتن فقط همان محصولات از کش حذف می‌شوند.
+    """
+    
+    def __init__(self, manager, max_products=FIFO_CACHE_PRODUCTS):
+        self.manager = manager
+        self.max_products = max_products
+        self.lots = OrderedDict()
+        self.generation = None
+        self.last_seq = None
+        self.epoch = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def _sync(self):
+        generation = self.manager.get_write_generation()
+        if generation == self.generation:
+            return
+        result = self.manager.execute_query("""
+            SELECT COALESCE(MIN(seq), 0) as oldest, COALESCE(MAX(seq), 0) as newest,
+                   (SELECT value FROM app_meta WHERE key = 'restore_epoch') as epoch
+            FROM fifo_changes
+        """)
+        if not result:
+            return
+        oldest, newest, epoch = result[0]['oldest'], result[0]['newest'], result[0]['epoch']
+        if epoch != self.epoch:
+            # دیتابیس از بکاپ بازیابی شده؛ شماره‌های fifo_changes قبلی معنی ندارند
+            self.last_seq = None
+        changed = []
+        if self.last_seq is not None and newest > self.last_seq and oldest <= self.last_seq + 1:
+            changed = self.manager.execute_query(
+                "SELECT DISTINCT product_id FROM fifo_changes WHERE seq > ?", (self.last_seq,)
+            ) or []
+        with self.lock:
+            if self.last_seq is None or oldest > self.last_seq + 1:
+                # اولین همگام‌سازی یا تغییراتی که قبل از خواندن پاک شده‌اند
+                self.invalidations += len(self.lots)
+                self.lots.clear()
+            else:
+                for row in changed:
+                    if self.lots.pop(row['product_id'], None) is not None:
+                        self.invalidations += 1
+            self.last_seq = newest
+            self.generation = generation
+            self.epoch = epoch
+        if newest - oldest > 2 * FIFO_CHANGES_KEEP:
+            self.manager.write(lambda cursor: cursor.execute(
+                "DELETE FROM fifo_changes WHERE seq <= ?", (newest - FIFO_CHANGES_KEEP,)), quiet=True)
+    
+    def _load(self, product_id):
+        rows = self.manager.execute_query(FIFO_LOTS_QUERY, (product_id,)) or []
+        remaining = np.array([row['remaining'] for row in rows], dtype=np.float64)
+        prices = np.array([row['buy_price'] for row in rows], dtype=np.float64)
+        return {
+            'ids': np.array([row['id'] for row in rows], dtype=np.int64),
+            'remaining': remaining,
+            'prices': prices,
+            'cum_qty': np.cumsum(remaining),
+            'cum_cost': np.cumsum(remaining * prices),
+        }
+    
+    def get(self, product_id):
+        self._sync()
+        with self.lock:
+            lots = self.lots.get(product_id)
+            if lots is not None:
+                self.lots.move_to_end(product_id)
+                self.hits += 1
+                return lots
+            self.misses += 1
+            seq = self.last_seq
+        lots = self._load(product_id)
+        with self.lock:
+            # اگر حین خواندن تغییری همگام شده، ممکن است لات‌ها قدیمی باشند
+            if self.last_seq == seq:
+                self.lots[product_id] = lots
+                while len(self.lots) > self.max_products:
+                    self.lots.popitem(last=False)
+        return lots
+    
+    @staticmethod
+    def _cost_upto(lots, quantity):
+        """بهای quantity واحد اول صف"""
+        if quantity <= 0:
+            return 0.0
+        index = int(np.searchsorted(lots['cum_qty'], quantity, side='left'))
+        before_qty = lots['cum_qty'][index - 1] if index else 0.0
+        before_cost = lots['cum_cost'][index - 1] if index else 0.0
+        return float(before_cost + (quantity - before_qty) * lots['prices'][index])
+    
+    def available(self, product_id):
+        lots = self.get(product_id)
+        return float(lots['cum_qty'][-1]) if len(lots['cum_qty']) else 0.0
+    
+    def quote(self, product_id, quantity, offset=0):
+        """(بهای واحد، [(inflow_id, مقدار)]) برای quantity واحد بعد از offset واحد اول صف؛ کمبود موجودی: (None, [])"""
+        lots = self.get(product_id)
+        if not len(lots['ids']):
+            return 0, []
+        if quantity <= 0 or offset + quantity > lots['cum_qty'][-1]:
+            return None, []
+        total = self._cost_upto(lots, offset + quantity) - self._cost_upto(lots, offset)
+        
+        cum_qty = lots['cum_qty']
+        first = int(np.searchsorted(cum_qty, offset, side='right'))
+        last = int(np.searchsorted(cum_qty, offset + quantity, side='left'))
+        used = []
+        for index in range(first, last + 1):
+            start = max(offset, cum_qty[index - 1] if index else 0.0)
+            end = min(offset + quantity, cum_qty[index])
+            if end > start:
+                used.append((int(lots['ids'][index]), float(end - start)))
+        return total / quantity, used
+    
+    def quote_many(self, items):
+        """قیمت چند ردیف (product_id, quantity)؛ ردیف‌های یک محصول پشت سر هم از صف مصرف می‌کنند"""
+        consumed = {}
+        results = []
+        for product_id, quantity in items:
+            offset = consumed.get(product_id, 0.0)
+            cogs_unit, _ = self.quote(product_id, quantity, offset)
+            if cogs_unit is not None:
+                consumed[product_id] = offset + quantity
+            results.append(cogs_unit)
+        return results
+    
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'products': len(self.lots),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0,
+                'invalidations': self.invalidations,
+                'last_seq': self.last_seq
+            }
+
+
+class ColumnarAnalytics:
+    """نسخه ستونی (آرایه‌های NumPy) از خروجی‌ها و ورودی‌ها برای گزارش‌های تجمیعی
+    
+    ستون‌ها یک بار بارگذاری می‌شوند و بعد از هر نوشتن فقط ردیف‌های جدید (id بزرگ‌تر از
+    آخرین id خوانده‌شده) اضافه می‌شوند. حذف یا آرشیو ردیف‌ها باعث بارگذاری کامل می‌شود.
+    """
+    
+    OUTFLOW_FIELDS = ("id, product_id, center_id, quantity, sell_price, cogs_unit, "
+                      "commission_amount, shipping_cost, outflow_date, is_returned")
+    INFLOW_FIELDS = "id, product_id, quantity, buy_price, inflow_date, dollar_rate"
+    
+    def __init__(self, manager):
+        self.manager = manager
+        self.lock = threading.Lock()
+        self.generation = None
+        self.epoch = None
+        self.outflows = None
+        self.inflows = None
+        self.products = {}
+        self.centers = {}
+        self.loads = {'full': 0, 'incremental': 0}
+        self._date_cache = {}
+        self._month_cache = {}
+    
+    # ---------- بارگذاری ----------
+    def _encode(self, mapping, ids):
+        """کد کردن id ها به اندیس‌های پشت سر هم (dictionary encoding)"""
+        return np.fromiter((mapping.setdefault(i or 0, len(mapping)) for i in ids), dtype=np.int32, count=len(ids))
+    
+    def _ordinals(self, dates):
+        cache = self._date_cache
+        result = np.empty(len(dates), dtype=np.int32)
+        for i, value in enumerate(dates):
+            ordinal = cache.get(value)
+            if ordinal is None:
+                try:
+                    ordinal = datetime.date.fromisoformat(value[:10]).toordinal()
+                except (TypeError, ValueError):
+                    ordinal = 0
+                cache[value] = ordinal
+            result[i] = ordinal
+        return result
+    
+    def _outflow_columns(self, rows):
+        return {
+            'id': np.array([r[0] for r in rows], dtype=np.int64),
+            'product': self._encode(self.products, [r[1] for r in rows]),
+            'center': self._encode(self.centers, [r[2] for r in rows]),
+            'qty': np.array([r[3] or 0 for r in rows], dtype=np.float64),
+            'price': np.array([r[4] or 0 for r in rows], dtype=np.float64),
+            'cogs_unit': np.array([r[5] or 0 for r in rows], dtype=np.float64),
+            'commission': np.array([r[6] or 0 for r in rows], dtype=np.float64),
+            'shipping': np.array([r[7] or 0 for r in rows], dtype=np.float64),
+            'date': self._ordinals([r[8] for r in rows]),
+            'returned': np.array([bool(r[9]) for r in rows], dtype=bool),
+        }
+    
+    def _inflow_columns(self, rows):
+        return {
+            'id': np.array([r[0] for r in rows], dtype=np.int64),
+            'product': self._encode(self.products, [r[1] for r in rows]),
+            'qty': np.array([r[2] or 0 for r in rows], dtype=np.float64),
+            'price': np.array([r[3] or 0 for r in rows], dtype=np.float64),
+            'date': self._ordinals([r[4] for r in rows]),
+            'rate': np.array([r[5] or 0 for r in rows], dtype=np.float64),
+        }
+    
+    def _load_archives(self, conn, table, fields):
+        rows = []
+        for year in conn.execute("SELECT year FROM fiscal_closings ORDER BY year"):
+            path = self.manager.get_archive_path(year[0])
+            if not os.path.exists(path):
+                continue
+            arch = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                rows += arch.execute(f"SELECT {fields} FROM {table}").fetchall()
+            except sqlite3.OperationalError:
+                pass
+            finally:
+                arch.close()
+        return rows
+    
+    def _load_table(self, conn, table, fields, snapshot, to_columns):
+        """برگرداندن snapshot به‌روز شده؛ None یعنی نیاز به بارگذاری کامل"""
+        if snapshot is None:
+            return None
+        live_count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE id <= ?", (snapshot['hwm'],)).fetchone()[0]
+        if live_count != snapshot['live_count']:
+            return None
+        rows = conn.execute(f"SELECT {fields} FROM {table} WHERE id > ? ORDER BY id", (snapshot['hwm'],)).fetchall()
+        if not rows:
+            return snapshot
+        # snapshot جدید ساخته می‌شود تا خواننده‌های هم‌زمان ستون‌های نیمه‌کاره نبینند
+        new_columns = to_columns(rows)
+        return dict(snapshot,
+                    columns={key: np.concatenate([values, new_columns[key]]) for key, values in snapshot['columns'].items()},
+                    hwm=rows[-1][0],
+                    live_count=snapshot['live_count'] + len(rows))
+    
+    def _full_load(self, conn, table, fields, to_columns):
+        archived = self._load_archives(conn, table, fields)
+        live = conn.execute(f"SELECT {fields} FROM {table} ORDER BY id").fetchall()
+        return {
+            'columns': to_columns(archived + live),
+            'archived_count': len(archived),
+            'hwm': live[-1][0] if live else 0,
+            'live_count': len(live),
+        }
+    
+    def snapshot(self):
+        """(ستون‌های خروجی، ستون‌های ورودی، کدگذاری محصولات و مراکز) به‌روز و سازگار با هم"""
+        self.refresh()
+        with self.lock:
+            return self.outflows['columns'], self.inflows['columns'], self.products, self.centers
+    
+    def refresh(self):
+        """به‌روزرسانی ستون‌ها اگر از آخرین بارگذاری نوشتنی انجام شده باشد
+        
+        داخل db.read_snapshot() ستون‌ها از همان snapshot خوانده می‌شوند تا با بقیه ارقام صفحه یکی باشند.
+        استثنا: اگر نسخه حافظه از snapshot جدیدتر باشد (worker دیگری زودتر به‌روز کرده) همان نسخه
+        جدیدتر برمی‌گردد؛ ستون‌ها به عقب برگردانده نمی‌شوند.
+        """
+        pinned = self.manager.readers.current()
+        if pinned is None:
+            # مقایسه با نسخه زنده دیتابیس؛ اتصال جدا فقط وقتی باز می‌شود که واقعا تغییری باشد
+            generation = self.manager.get_write_generation()
+        else:
+            generation = pinned.execute("SELECT value FROM app_meta WHERE key = 'write_generation'").fetchone()[0]
+        with self.lock:
+            if generation == self.generation or (
+                    pinned is not None and self.generation is not None and generation < self.generation):
+                return
+            # کدگذاری‌ها هم مثل ستون‌ها کپی می‌شوند؛ دیکشنری‌هایی که snapshot() قبلا داده دیگر تغییر نمی‌کنند
+            self.products, self.centers = dict(self.products), dict(self.centers)
+            conn = pinned or sqlite3.connect(self.manager.db_path, timeout=DB_BUSY_TIMEOUT)
+            try:
+                if pinned is None:
+                    conn.execute("BEGIN")
+                    generation = conn.execute("SELECT value FROM app_meta WHERE key = 'write_generation'").fetchone()[0]
+                
+                # بعد از بازیابی بکاپ یا حذف/ویرایش ردیف‌های قبلی، ستون‌ها قابل ادامه دادن نیستند
+                meta = dict(conn.execute(
+                    "SELECT key, value FROM app_meta WHERE key IN ('restore_epoch', 'analytics_rewrites')").fetchall())
+                epoch = (meta.get('restore_epoch', 0), meta.get('analytics_rewrites', 0))
+                previous = (self.outflows, self.inflows) if epoch == self.epoch else (None, None)
+                outflows = self._load_table(conn, 'outflows', self.OUTFLOW_FIELDS, previous[0], self._outflow_columns)
+                inflows = self._load_table(conn, 'inflows', self.INFLOW_FIELDS, previous[1], self._inflow_columns)
+                if outflows is None or inflows is None:
+                    self.products, self.centers = {}, {}
+                    outflows = self._full_load(conn, 'outflows', self.OUTFLOW_FIELDS, self._outflow_columns)
+                    inflows = self._full_load(conn, 'inflows', self.INFLOW_FIELDS, self._inflow_columns)
+                    self.loads['full'] += 1
+                else:
+                    # وضعیت برگشت تنها ستون قابل تغییر ردیف‌های قبلی است
+                    returned_ids = np.array([r[0] for r in conn.execute(
+                        "SELECT id FROM outflows WHERE is_returned = 1")], dtype=np.int64)
+                    columns = dict(outflows['columns'])
+                    returned = columns['returned'].copy()
+                    live = slice(outflows['archived_count'], None)
+                    returned[live] = np.isin(columns['id'][live], returned_ids)
+                    columns['returned'] = returned
+                    outflows = dict(outflows, columns=columns)
+                    self.loads['incremental'] += 1
+                
+                self.outflows, self.inflows = outflows, inflows
+                self.generation = generation
+                self.epoch = epoch
+            finally:
+                if pinned is None:
+                    conn.close()
+    
+    # ---------- ابعاد ----------
+    def _month_codes(self, ordinals):
+        """کد ماه شمسی (سال*100+ماه) برای هر ردیف؛ تبدیل فقط روی روزهای یکتا انجام می‌شود"""
+        days, inverse = np.unique(ordinals, return_inverse=True)
+        cache = self._month_cache
+        months = np.empty(len(days), dtype=np.int32)
+        for i, ordinal in enumerate(days):
+            month = cache.get(ordinal)
+            if month is None:
+                month = 0
+                if ordinal > 0:
+                    jdate = jdatetime.date.fromgregorian(date=datetime.date.fromordinal(int(ordinal)))
+                    month = jdate.year * 100 + jdate.month
+                cache[ordinal] = month
+            months[i] = month
+        return np.unique(months[inverse], return_inverse=True)
+    
+    def _dimension(self, name, columns, products, centers):
+        """(برچسب‌ها، کد هر ردیف) برای یک بعد گروه‌بندی"""
+        if name == 'product':
+            return np.array(list(products), dtype=np.int64), columns['product']
+        if name == 'center':
+            return np.array(list(centers), dtype=np.int64), columns['center']
+        if name == 'category':
+            category_of = {row['product_id']: row['category_id'] for row in
+                           self.manager.execute_query("SELECT product_id, category_id FROM product_categories") or []}
+            product_to_category = np.array([category_of.get(pid, 0) or 0 for pid in products], dtype=np.int64)
+            return np.unique(product_to_category[columns['product']], return_inverse=True)
+        if name == 'month':
+            return self._month_codes(columns['date'])
+        raise ValueError(f"unknown dimension: {name}")
+    
+    # ---------- محاسبات ----------
+    def _metrics(self, cols, codes, size, mask=None):
+        sold = ~cols['returned']
+        if mask is not None:
+            sold = sold & mask
+        
+        def total(values, where):
+            return np.bincount(codes, weights=np.where(where, values, 0), minlength=size)
+        
+        revenue = total(cols['qty'] * cols['price'], sold)
+        cogs = total(cols['qty'] * cols['cogs_unit'], sold)
+        commission = total(cols['commission'], sold)
+        shipping = total(cols['shipping'], sold)
+        qty = total(cols['qty'], sold)
+        every = np.ones(len(codes), dtype=bool) if mask is None else mask
+        all_qty = total(cols['qty'], every)
+        returned_qty = all_qty - qty
+        profit = revenue - cogs - commission - shipping
+        with np.errstate(divide='ignore', invalid='ignore'):
+            margin = np.where(revenue != 0, profit / revenue * 100, 0.0)
+            return_rate = np.where(all_qty != 0, returned_qty / all_qty * 100, 0.0)
+        return {
+            'count': np.bincount(codes, weights=sold, minlength=size),
+            'qty': qty,
+            'revenue': revenue,
+            'cogs': cogs,
+            'commission': commission,
+            'shipping': shipping,
+            'profit': profit,
+            'margin': margin,
+            'returned_qty': returned_qty,
+            'return_rate': return_rate,
+        }
+    
+    def _date_mask(self, ordinals, start_date=None, end_date=None):
+        mask = np.ones(len(ordinals), dtype=bool)
+        if start_date:
+            mask &= ordinals >= datetime.date.fromisoformat(start_date).toordinal()
+        if end_date:
+            mask &= ordinals <= datetime.date.fromisoformat(end_date).toordinal()
+        return mask
+    
+    def group_by(self, dimension, start_date=None, end_date=None):
+        """فروش، سود، حاشیه سود و نرخ برگشت به تفکیک یک بعد"""
+        cols, _, products, centers = self.snapshot()
+        labels, codes = self._dimension(dimension, cols, products, centers)
+        mask = self._date_mask(cols['date'], start_date, end_date) if (start_date or end_date) else None
+        metrics = self._metrics(cols, codes, len(labels), mask)
+        present = np.bincount(codes, weights=(mask if mask is not None else None), minlength=len(labels)) > 0
+        return [
+            dict({'key': labels[i].item()}, **{name: values[i].item() for name, values in metrics.items()})
+            for i in np.flatnonzero(present)
+        ]
+    
+    def pivot(self, rows, cols, metric='revenue', start_date=None, end_date=None):
+        """جدول متقاطع دو بعد برای یک شاخص"""
+        if metric not in ANALYTICS_METRICS:
+            raise ValueError(f"unknown metric: {metric}")
+        columns, _, products, centers = self.snapshot()
+        row_labels, row_codes = self._dimension(rows, columns, products, centers)
+        col_labels, col_codes = self._dimension(cols, columns, products, centers)
+        mask = self._date_mask(columns['date'], start_date, end_date) if (start_date or end_date) else None
+        size = len(row_labels) * len(col_labels)
+        values = self._metrics(columns, row_codes * len(col_labels) + col_codes, size, mask)[metric]
+        present = np.bincount(row_codes * len(col_labels) + col_codes,
+                              weights=(mask if mask is not None else None), minlength=size) > 0
+        matrix = values.reshape(len(row_labels), len(col_labels))
+        present = present.reshape(matrix.shape)
+        keep_rows, keep_cols = present.any(axis=1), present.any(axis=0)
+        return {
+            'rows': row_labels[keep_rows].tolist(),
+            'cols': col_labels[keep_cols].tolist(),
+            'values': matrix[keep_rows][:, keep_cols].tolist(),
+        }
+    
+    def inflow_totals(self, dimension='product'):
+        """مقدار و مبلغ خرید به تفکیک محصول یا ماه"""
+        _, cols, products, centers = self.snapshot()
+        labels, codes = self._dimension(dimension, cols, products, centers)
+        qty = np.bincount(codes, weights=cols['qty'], minlength=len(labels))
+        cost = np.bincount(codes, weights=cols['qty'] * cols['price'], minlength=len(labels))
+        return [{'key': labels[i].item(), 'qty': qty[i].item(), 'cost': cost[i].item()}
+                for i in np.flatnonzero(qty != 0)]
+    
+    def stats(self):
+        return {
+            'generation': self.generation,
+            'outflow_rows': len(self.outflows['columns']['id']) if self.outflows else 0,
+            'inflow_rows': len(self.inflows['columns']['id']) if self.inflows else 0,
+            'loads': dict(self.loads),
+        }
+
+
+# ==================== نگهداری دیتابیس ====================
+class MaintenanceScheduler:
+    """اجرای ANALYZE، incremental_vacuum و quick_check در پنجره‌های بیکاری
+    
+    بیکاری یعنی write_generation در MAINTENANCE_IDLE_SECONDS گذشته تغییر نکرده باشد.
+    هماهنگی بین workerها با ثبت زمان آخرین اجرای هر کار در app_meta است (فقط یک پروسه برنده می‌شود).
+    """
+    
+    def __init__(self, manager):
+        self.manager = manager
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.last_results = {}
+    
+    def ensure_started(self):
+        if not DB_MAINTENANCE or (self.thread and self.pid == os.getpid() and self.thread.is_alive()):
+            return
+        with self.lock:
+            if self.thread and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self._run, name='db-maintenance', daemon=True)
+            self.thread.start()
+    
+    def stop(self):
+        if self.thread and self.pid == os.getpid() and self.thread.is_alive():
+            self.stop_event.set()
+            self.thread.join()
+    
+    def _run(self):
+        last_generation = None
+        while not self.stop_event.wait(MAINTENANCE_IDLE_SECONDS):
+            try:
+                generation = self.manager.get_write_generation()
+                if generation == last_generation:
+                    self.run_due()
+                last_generation = self.manager.get_write_generation()
+            except Exception as e:
+                print(f"Maintenance error: {e}")
+    
+    def _claim(self, task, interval):
+        """ثبت اتمی زمان اجرا؛ اگر پروسه دیگری زودتر اجرا کرده باشد False"""
+        key = f"maintenance_{task}"
+        now = int(time.time())
+        
+        def op(cursor):
+            cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES (?, 0)", (key,))
+            return cursor.execute(
+                "UPDATE app_meta SET value = ? WHERE key = ? AND value <= ?", (now, key, now - interval)
+            ).rowcount == 1
+        return bool(self.manager.write(op, quiet=True))
+    
+    def run_due(self):
+        for task, interval in MAINTENANCE_INTERVALS.items():
+            if self.stop_event.is_set():
+                break
+            if self._claim(task, interval):
+                self.run(task)
+    
+    def run(self, task):
+        """اجرای یک کار و ثبت نتیجه در maintenance_log و خروجی لاگ"""
+        started_at = datetime.datetime.now().isoformat(timespec='seconds')
+        started = time.perf_counter()
+        try:
+            result = getattr(self, f"_task_{task}")()
+        except sqlite3.Error as e:
+            result = f"error: {e}"
+        duration = (time.perf_counter() - started) * 1000
+        self.last_results[task] = {'at': started_at, 'duration_ms': round(duration, 1), 'result': result}
+        print(f"[maintenance] {task}: {result} ({duration:.0f} ms)")
+        
+        def log(cursor):
+            cursor.execute("INSERT INTO maintenance_log (task, started_at, duration_ms, result) VALUES (?, ?, ?, ?)",
+                           (task, started_at, duration, str(result)))
+            cursor.execute("DELETE FROM maintenance_log WHERE id <= (SELECT MAX(id) FROM maintenance_log) - 500")
+        self.manager.write(log, quiet=True)
+        return result
+    
+    def _task_incremental_vacuum(self, max_steps=40):
+        """آزاد کردن صفحات خالی در گام‌های کوچک؛ هر گام یک تراکنش کوتاه جدا است"""
+        conn = self.manager.get_connection()
+        conn.isolation_level = None
+        freed = 0
+        try:
+            for _ in range(max_steps):
+                before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not before or self.stop_event.is_set():
+                    break
+                # execute فقط یک گام از pragma را اجرا می‌کند؛ executescript تا انتها پیش می‌رود
+                conn.executescript(f"BEGIN IMMEDIATE; PRAGMA incremental_vacuum({VACUUM_STEP_PAGES}); COMMIT;")
+                freed += before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            conn.close()
+        return f"{freed} page(s) freed"
+    
+    def _task_ledger_checkpoint(self):
+        return f"{self.manager.create_ledger_checkpoints()} checkpoint(s)"
+    
+    def _task_forecast(self):
+        return f"{self.manager.refresh_forecasts()} forecast(s)"
+    
+    def _task_analyze(self):
+        def op(cursor):
+            cursor.execute("PRAGMA analysis_limit = 1000")
+            cursor.execute("ANALYZE")
+            return "ok"
+        return self.manager.write(op, quiet=True)
+    
+    def _task_optimize(self):
+        def op(cursor):
+            cursor.execute("PRAGMA optimize")
+            return "ok"
+        return self.manager.write(op, quiet=True)
+    
+    def _task_quick_check(self, pragma='quick_check'):
+        # فقط خواندنی؛ در حالت WAL قفل نوشتن نمی‌گیرد
+        rows = self.manager.execute_query(f"PRAGMA {pragma}") or []
+        messages = [row[0] for row in rows]
+        return "ok" if messages == ['ok'] else "; ".join(messages[:20])
+    
+    def _task_integrity_check(self):
+        return self._task_quick_check('integrity_check')
+    
+    def _task_full_vacuum(self):
+        """VACUUM کامل (برای فعال کردن auto_vacuum افزایشی در دیتابیس‌های قدیمی)؛ قفل طولانی دارد"""
+        conn = self.manager.get_connection()
+        try:
+            conn.isolation_level = None
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            return f"auto_vacuum={conn.execute('PRAGMA auto_vacuum').fetchone()[0]}"
+        finally:
+            conn.close()
+    
+    def stats(self):
+        conn = self.manager.get_connection()
+        try:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            info = {
+                'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(conn.execute("PRAGMA auto_vacuum").fetchone()[0]),
+                'page_count': conn.execute("PRAGMA page_count").fetchone()[0],
+                'freelist_count': conn.execute("PRAGMA freelist_count").fetchone()[0],
+            }
+            info['size_bytes'] = info['page_count'] * page_size
+            info['last_runs'] = {
+                row['task']: {'at': row['started_at'], 'duration_ms': row['duration_ms'], 'result': row['result']}
+                for row in conn.execute("""
+                    SELECT task, started_at, duration_ms, result FROM maintenance_log
+                    WHERE id IN (SELECT MAX(id) FROM maintenance_log GROUP BY task)
+                """)
+            }
+            return info
+        finally:
+            conn.close()
+
+
+MAINTENANCE_TASKS = ('incremental_vacuum', 'analyze', 'optimize', 'quick_check', 'integrity_check', 'full_vacuum',
+                     'ledger_checkpoint', 'forecast')
+
+
+# ==================== کش صفحات ====================
+class ResponseCache:
+    """کش HTML صفحات پرخواندنی؛ با تغییر نسخه نوشتن دیتابیس کل کش باطل می‌شود"""
+    
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key, generation):
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key, generation, value):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation = None
+    
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0,
+                'entries': len(self.entries),
+                'generation': self.generation
+            }
+
+
+# ==================== چند مستأجری ====================
+TENANT_NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,39}$')
+
+
+def parse_tenants(spec):
+    """'brand1=shop1.example.com|brand1.local,brand2' -> (نام‌ها، {host: نام})"""
+    names, hosts = [], {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, host_list = item.partition('=')
+        name = name.strip().lower()
+        if not TENANT_NAME_PATTERN.match(name):
+            raise ValueError(f"invalid tenant name: {name!r}")
+        names.append(name)
+        for host in filter(None, (h.strip().lower() for h in host_list.split('|'))):
+            hosts[host] = name
+    return names, hosts
+
+
+class Tenant:
+    """دیتابیس، کش صفحات و شمارنده‌های یک مستأجر"""
+    
+    def __init__(self, name, db_path):
+        self.name = name
+        self.db = DBManager(db_path)
+        self.page_cache = ResponseCache(PAGE_CACHE_SIZE)
+        self.active = 0
+        self.requests = 0
+        self.opened_at = datetime.datetime.now().isoformat(timespec='seconds')
+    
+    def restore(self, file):
+        """بازیابی دیتابیس از فایل بکاپ آپلود شده (بدون بستن اتصال‌های باز)"""
+        upload_path = f"{self.db.db_path}.upload-{os.getpid()}"
+        file.save(upload_path)
+        try:
+            result = self.db.restore_backup(upload_path)
+        finally:
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                if os.path.exists(upload_path + suffix):
+                    os.remove(upload_path + suffix)
+        self.page_cache.clear()
+        return result
+    
+    def close(self):
+        self.db.close()
+    
+    def stats(self):
+        return {'name': self.name, 'requests': self.requests, 'active': self.active, 'opened_at': self.opened_at}
+
+
+class TenantRegistry:
+    """مستأجرهای باز هر پروسه با حداکثر max_open؛ مستأجری که مدتی درخواست نداشته (LRU) بسته می‌شود
+    
+    هر مستأجر با اولین درخواست باز می‌شود (نویسنده، اتصال‌های خواندنی، نسخه ستونی و کش صفحات
+    همه مخصوص همان دیتابیس هستند) و تا وقتی درخواست فعال دارد بسته نمی‌شود.
+    """
+    
+    def __init__(self, routing=TENANT_ROUTING, spec=TENANTS, directory=TENANTS_DIR, max_open=TENANT_POOL_SIZE):
+        if routing not in ('off', 'host', 'path'):
+            raise ValueError(f"invalid TENANT_ROUTING: {routing!r}")
+        self.routing = routing
+        self.names, self.hosts = parse_tenants(spec) if routing != 'off' else ([], {})
+        self.directory = directory
+        self.max_open = max(max_open, 1)
+        self.open = OrderedDict()
+        self.pinned = None
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def db_path(self, name):
+        if name == DEFAULT_TENANT:
+            return DB_PATH
+        return os.path.join(self.directory, name, 'warehouse.db')
+    
+    def resolve(self, environ):
+        """نام مستأجر درخواست (یا None)؛ در حالت path پیشوند /t/<name> به SCRIPT_NAME منتقل می‌شود"""
+        if self.routing == 'host':
+            host = (environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')).split(':')[0].lower()
+            name = self.hosts.get(host) or host.split('.')[0]
+            return name if name in self.names else None
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(TENANT_PATH_PREFIX):
+            return None
+        name, _, rest = path[len(TENANT_PATH_PREFIX):].partition('/')
+        if name not in self.names:
+            return None
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + TENANT_PATH_PREFIX + name
+        environ['PATH_INFO'] = '/' + rest
+        return name
+    
+    def acquire(self, name):
+        with self.lock:
+            tenant = self.open.get(name)
+            if tenant is None:
+                tenant = Tenant(name, self.db_path(name))
+                self.open[name] = tenant
+            self.open.move_to_end(name)
+            tenant.active += 1
+            tenant.requests += 1
+            evicted = self._evict_idle()
+        for old in evicted:
+            old.close()
+        return tenant
+    
+    def release(self, tenant):
+        with self.lock:
+            tenant.active -= 1
+            evicted = self._evict_idle()
+        for old in evicted:
+            old.close()
+    
+    def _evict_idle(self):
+        evicted = []
+        for name in list(self.open):
+            if len(self.open) <= self.max_open:
+                break
+            tenant = self.open[name]
+            if tenant.active == 0 and tenant is not self.pinned:
+                evicted.append(self.open.pop(name))
+        self.evictions += len(evicted)
+        return evicted
+    
+    def background(self):
+        """مستأجر خارج از درخواست (دستورات CLI و worker ها): متغیر محیطی TENANT، پیش‌فرض default"""
+        if self.pinned is None:
+            name = os.environ.get('TENANT', DEFAULT_TENANT)
+            if name != DEFAULT_TENANT and name not in self.names:
+                raise ValueError(f"unknown tenant: {name!r}")
+            self.pinned = self.acquire(name)
+        return self.pinned
+    
+    def close(self):
+        with self.lock:
+            tenants, self.open = list(self.open.values()), OrderedDict()
+            self.pinned = None
+        for tenant in tenants:
+            tenant.close()
+    
+    def stats(self):
+        with self.lock:
+            return {'routing': self.routing, 'open': len(self.open), 'max_open': self.max_open,
+                    'evictions': self.evictions}
+
+
+class TenantMiddleware:
+    """تعیین مستأجر هر درخواست قبل از Flask؛ مستأجر ناشناخته 404 می‌گیرد"""
+    
+    def __init__(self, wsgi_app, registry):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+    
+    def __call__(self, environ, start_response):
+        name = self.registry.resolve(environ)
+        if name is None:
+            return NotFound()(environ, start_response)
+        environ['warehouse.tenant'] = name
+        return self.wsgi_app(environ, start_response)
+
+
+def current_tenant():
+    if has_app_context() and 'tenant' in g:
+        return g.tenant
+    return tenants.background()
+
+
+tenants = TenantRegistry()
+if tenants.routing != 'off':
+    app.wsgi_app = TenantMiddleware(app.wsgi_app, tenants)
+
+# دیتابیس و کش صفحات مستأجر درخواست جاری
+db = LocalProxy(lambda: current_tenant().db)
+response_cache = LocalProxy(lambda: current_tenant().page_cache)
+
+
+@app.before_request
+def bind_tenant():
+    g.tenant = tenants.acquire(request.environ.get('warehouse.tenant', DEFAULT_TENANT))
+
+@app.teardown_request
+def release_tenant(exc):
+    tenant = g.pop('tenant', None)
+    if tenant is not None:
+        tenants.release(tenant)
+
+
+def cached_page(view):
+    """کش خروجی view بر اساس روت، پارامترها و نسخه نوشتن دیتابیس"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # صفحاتی که پیام flash دارند و درخواست‌های پروفایل شده کش نمی‌شوند
+        if '_flashes' in session or g.get('profile') is not None:
+            return view(*args, **kwargs)
+        
+        generation = db.get_write_generation()
+        key = (request.endpoint, tuple(sorted(kwargs.items())),
+               tuple(sorted(request.args.items(multi=True))), datetime.date.today().isoformat())
+        cached = response_cache.get(key, generation)
+        if cached is not None:
+            return cached
+        
+        result = view(*args, **kwargs)
+        if isinstance(result, str):
+            response_cache.set(key, generation, result)
+        return result
+    return wrapper
+
+
+# ==================== ارسال تدریجی و فشرده‌سازی ====================
+STREAM_BUFFER_EVENTS = 64
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript'}
+
+
+def render_list_page(template_name, **context):
+    """رندر صفحات لیست بزرگ به صورت تدریجی تا اولین بایت قبل از ساخت کل HTML ارسال شود"""
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    # چند رویداد قالب با هم ارسال می‌شوند تا تکه‌ها خیلی کوچک نباشند
+    stream.enable_buffering(STREAM_BUFFER_EVENTS)
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_stream(chunks, encoding):
+    """فشرده‌سازی تکه به تکه؛ هر تکه flush می‌شود تا مرورگر بدون انتظار برای کل صفحه رندر کند"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            data = compressor.process(chunk.encode('utf-8') if isinstance(chunk, str) else chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
 
 
-# ایجاد instance دیتابیس
-db = DBManager()
+@app.after_request
+def compress_response(response):
+    if (not app.config['COMPRESS_RESPONSES'] or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    encoding = choose_encoding()
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+    
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=5))
+        else:
+            response.set_data(gzip_compress(data))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app.before_request
+def start_maintenance():
+    # thread نگهداری در هر worker بعد از fork و با اولین درخواست شروع می‌شود
+    db.maintenance.ensure_started()
+
+
+# ==================== گرم کردن worker ====================
+# گزارش آخرین گرم کردن همین پروسه (در /metrics)
+startup_report = []
+
+
+def _warm_templates():
+    before = len(os.listdir(JINJA_CACHE_DIR)) if JINJA_CACHE_DIR else 0
+    names = app.jinja_env.list_templates(extensions=('html',))
+    for name in names:
+        app.jinja_env.get_template(name)
+    compiled = (len(os.listdir(JINJA_CACHE_DIR)) - before) if JINJA_CACHE_DIR else len(names)
+    return f"{len(names)} template(s), {compiled} compiled, {len(names) - compiled} from bytecode cache"
+
+
+def _warm_database():
+    # اتصال‌های خواندنی با schema بارگذاری شده در استخر می‌مانند
+    connections = [db.readers.acquire() for _ in range(min(READ_POOL_SIZE, 4))]
+    try:
+        for conn in connections:
+            conn.execute("SELECT COUNT(*) FROM sales_centers").fetchone()
+    finally:
+        for conn in connections:
+            db.readers.release(conn)
+    return f"{len(connections)} read connection(s), write generation {db.get_write_generation()}"
+
+
+def _warm_lookups():
+    # جدول‌هایی که تقریباً همه فرم‌ها می‌خوانند در page cache سیستم‌عامل و SQLite قرار می‌گیرند
+    centers = db.get_centers() or []
+    categories = db.get_categories() or []
+    db.execute_query("SELECT COUNT(*) FROM commissions")
+    return f"{len(centers)} center(s), {len(categories)} category(ies)"
+
+
+def _warm_step(report, name, step):
+    started = time.perf_counter()
+    try:
+        detail = step()
+    except Exception as e:
+        detail = f"error: {e}"
+    duration = (time.perf_counter() - started) * 1000
+    report.append({'step': name, 'duration_ms': round(duration, 1), 'detail': detail})
+    print(f"[startup] {name}: {detail} ({duration:.0f} ms)")
+
+
+def warm_up():
+    """کامپایل همه قالب‌ها و گرم کردن اتصال‌ها و جدول‌های پرخواندنی قبل از اولین درخواست worker
+    
+    در حالت چند مستأجری دیتابیس هر مستأجر تعریف شده گرم می‌شود، حداکثر به تعداد TENANT_POOL_SIZE
+    (بیشتر از آن مستأجرهای گرم شده قبلی را از استخر بیرون می‌کرد).
+    """
+    report = []
+    _warm_step(report, 'templates', _warm_templates)
+    names = tenants.names if tenants.routing != 'off' else [DEFAULT_TENANT]
+    for name in names[:tenants.max_open]:
+        tenant = tenants.acquire(name)
+        try:
+            with app.app_context():
+                g.tenant = tenant
+                suffix = f":{name}" if tenants.routing != 'off' else ''
+                _warm_step(report, f"database{suffix}", _warm_database)
+                _warm_step(report, f"lookups{suffix}", _warm_lookups)
+        finally:
+            tenants.release(tenant)
+    if len(names) > tenants.max_open:
+        skipped = len(names) - tenants.max_open
+        report.append({'step': 'tenants', 'duration_ms': 0,
+                       'detail': f"{skipped} tenant(s) not warmed (TENANT_POOL_SIZE={tenants.max_open})"})
+        print(f"[startup] tenants: {report[-1]['detail']}")
+    print(f"[startup] pid {os.getpid()} ready in {sum(item['duration_ms'] for item in report):.0f} ms")
+    startup_report[:] = report
+    return report
+
+
+# ==================== پروفایل درخواست‌ها ====================
+class RequestProfile:
+    """پروفایل یک درخواست: cProfile روی thread همان درخواست و زمان کوئری‌ها و نوشتن‌های DBManager"""
+    
+    # در هر پروسه فقط یک پروفایلر می‌تواند فعال باشد؛ درخواست هم‌زمان دوم پروفایل نمی‌شود
+    lock = threading.Lock()
+    
+    def __init__(self):
+        self.id = f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{os.urandom(2).hex()}"
+        self.profiler = cProfile.Profile()
+        self.queries = []
+        self.started = None
+        self.duration = 0
+    
+    def start(self):
+        if not RequestProfile.lock.acquire(blocking=False):
+            return False
+        self.started = time.perf_counter()
+        self.profiler.enable()
+        return True
+    
+    def stop(self):
+        self.profiler.disable()
+        self.duration = time.perf_counter() - self.started
+        RequestProfile.lock.release()
+    
+    def record(self, kind, sql, seconds, rows=None):
+        self.queries.append({'kind': kind, 'sql': ' '.join(sql.split()), 'ms': seconds * 1000, 'rows': rows})
+    
+    def hotspots(self, sort='tottime', limit=PROFILE_TOP):
+        stats = pstats.Stats(self.profiler).stats
+        index = 2 if sort == 'tottime' else 3
+        rows = sorted(stats.items(), key=lambda item: item[1][index], reverse=True)[:limit]
+        return [{
+            'function': f"{os.path.basename(filename)}:{line}({name})" if line else name,
+            'calls': calls,
+            'tottime_ms': round(tottime * 1000, 2),
+            'cumtime_ms': round(cumtime * 1000, 2),
+        } for (filename, line, name), (_, calls, tottime, cumtime, _) in rows]
+    
+    def query_summary(self):
+        """کوئری‌های تکراری یک‌جا: تعداد، زمان کل و بیشترین زمان"""
+        groups = {}
+        for query in self.queries:
+            group = groups.setdefault((query['kind'], query['sql']),
+                                      {'kind': query['kind'], 'sql': query['sql'], 'count': 0, 'total_ms': 0, 'max_ms': 0})
+            group['count'] += 1
+            group['total_ms'] += query['ms']
+            group['max_ms'] = max(group['max_ms'], query['ms'])
+        return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)
+    
+    def save(self, directory, **info):
+        os.makedirs(directory, exist_ok=True)
+        self.profiler.dump_stats(os.path.join(directory, f"{self.id}.prof"))
+        summary = dict(info, id=self.id, duration_ms=round(self.duration * 1000, 2),
+                       db_ms=round(sum(query['ms'] for query in self.queries), 2),
+                       query_count=len(self.queries), hotspots=self.hotspots(),
+                       cumulative=self.hotspots('cumtime'), queries=self.query_summary())
+        with open(os.path.join(directory, f"{self.id}.json"), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        # فقط آخرین PROFILE_KEEP پروفایل نگه داشته می‌شود
+        for old_id in list_profiles(directory)[PROFILE_KEEP:]:
+            for ext in ('json', 'prof'):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(directory, f"{old_id}.{ext}"))
+        return summary
+
+
+def list_profiles(directory=PROFILES_DIR):
+    """شناسه پروفایل‌های ذخیره شده (جدیدترین اول)"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name[:-5] for name in os.listdir(directory) if name.endswith('.json')), reverse=True)
+
+
+def load_profile(profile_id, directory=PROFILES_DIR):
+    if not re.fullmatch(r'[\w-]+', profile_id or ''):
+        return None
+    try:
+        with open(os.path.join(directory, f"{profile_id}.json"), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def active_profile():
+    """پروفایل درخواست جاری (در threadهای پس‌زمینه None)"""
+    return g.get('profile') if has_app_context() else None
+
+
+def profile_session_marker():
+    # کوکی session با secret_key داخل مخزن امضا می‌شود و قابل جعل است؛ نشانه بدون دانستن توکن ساخته نمی‌شود
+    return hmac.new(PROFILE_TOKEN.encode(), b'profile-admin', 'sha256').hexdigest()
+
+
+def profiler_authorized():
+    """توکن مدیر در هدر X-Profile-Token (هر درخواست) یا نشانه ورود از /profiles/login در session"""
+    if not PROFILE_TOKEN:
+        return False
+    token = request.headers.get('X-Profile-Token')
+    if token and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    return hmac.compare_digest(str(session.get('profile_admin', '')), profile_session_marker())
+
+
+@app.before_request
+def start_profile():
+    if not (request.headers.get('X-Profile') or request.args.get('_profile')) or not profiler_authorized():
+        return
+    profile = RequestProfile()
+    if profile.start():
+        g.profile = profile
+    else:
+        g.profile_busy = True
+
+@app.after_request
+def profile_headers(response):
+    if g.get('profile') is not None:
+        g.profile_status = response.status_code
+        response.headers['X-Profile-Id'] = g.profile.id
+    elif g.get('profile_busy'):
+        response.headers['X-Profile-Id'] = 'busy'
+    return response
+
+@app.teardown_request
+def save_profile(exc):
+    # بعد از ارسال کامل پاسخ (صفحات stream شده هم) اجرا می‌شود
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    profile.stop()
+    try:
+        profile.save(PROFILES_DIR, path=request.full_path.rstrip('?'), method=request.method,
+                     endpoint=request.endpoint, tenant=current_tenant().name, status=g.get('profile_status'),
+                     error=repr(exc) if exc else None,
+                     at=datetime.datetime.now().isoformat(timespec='seconds'))
+    except OSError as e:
+        print(f"Profile save error: {e}")
+
+
+@app.route('/profiles/login', methods=['GET', 'POST'])
+def profile_login():
+    if not PROFILE_TOKEN:
+        raise NotFound()
+    if request.method == 'POST':
+        if hmac.compare_digest(request.form.get('token', ''), PROFILE_TOKEN):
+            session['profile_admin'] = profile_session_marker()
+            return redirect(url_for('profiles'))
+        flash('توکن نامعتبر است', 'error')
+    return render_template('profile_login.html')
+
+@app.route('/profiles')
+def profiles():
+    if not profiler_authorized():
+        raise NotFound()
+    captures = [profile for profile in (load_profile(profile_id) for profile_id in list_profiles()[:50]) if profile]
+    return render_template('profiles.html', captures=captures)
+
+@app.route('/profiles/<profile_id>')
+def profile_detail(profile_id):
+    if not profiler_authorized():
+        raise NotFound()
+    profile = load_profile(profile_id)
+    if profile is None:
+        raise NotFound()
+    if request.args.get('format') == 'prof':
+        return send_file(os.path.abspath(os.path.join(PROFILES_DIR, f"{profile_id}.prof")), as_attachment=True,
+                         download_name=f"{profile_id}.prof")
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(profile)
+    return render_template('profile_detail.html', profile=profile)
 
 
 # ==================== Context Processors ====================
@@ -651,9 +4112,11 @@ def utility_processor():
 # ==================== روت‌های اصلی ====================
 @app.route('/')
 def dashboard():
-    stats = db.get_dashboard_stats()
-    debts = db.get_center_debts()
-    return render_template('dashboard.html', stats=stats, debts=debts)
+    with db.read_snapshot():
+        stats = db.get_dashboard_stats()
+        debts = db.get_center_debts()
+        revaluation = db.get_revaluation()
+    return render_template('dashboard.html', stats=stats, debts=debts, revaluation=revaluation)
 
 
 # ==================== محصولات ====================
@@ -661,8 +4124,9 @@ def dashboard():
 def products():
     stock_filter = request.args.get('filter', 'all')
     search = request.args.get('search', '')
-    products_list = db.get_products(stock_filter, search)
-    return render_template('products.html', products=products_list, filter=stock_filter, search=search)
+    products_list = db.get_products(stock_filter, search, stream=True)
+    return render_list_page('products.html', products=products_list, filter=stock_filter, search=search,
+                            forecasts=db.get_forecasts())
 
 @app.route('/products/add', methods=['POST'])
 def add_product():
@@ -702,8 +4166,8 @@ def delete_product(product_id):
 def inflows():
     products_list = db.get_products()
     categories = db.get_categories()
-    inflows_list = db.get_inflows()
-    return render_template('inflows.html', products=products_list, categories=categories, inflows=inflows_list)
+    inflows_list = db.get_inflows(stream=True)
+    return render_list_page('inflows.html', products=products_list, categories=categories, inflows=inflows_list)
 
 @app.route('/inflows/add', methods=['POST'])
 def add_inflow():
@@ -736,8 +4200,8 @@ def delete_inflow(inflow_id):
 def outflows():
     products_list = db.get_products(stock_filter="available")
     centers = db.get_centers()
-    outflows_list = db.get_outflows()
-    return render_template('outflows.html', products=products_list, centers=centers, outflows=outflows_list)
+    outflows_list = db.get_outflows(stream=True)
+    return render_list_page('outflows.html', products=products_list, centers=centers, outflows=outflows_list)
 
 @app.route('/outflows/add', methods=['POST'])
 def add_outflow():
@@ -783,9 +4247,41 @@ def delete_outflow(outflow_id):
     flash(msg, 'success' if success else 'error')
     return redirect(url_for('outflows'))
 
+def split_list(text):
+    """جدا کردن لیست وارد شده با کاما، فاصله یا خط جدید"""
+    return [item for item in text.replace(',', ' ').split() if item]
+
+def apply_bulk_outflow_action(action, selection):
+    actions = {
+        'paid': lambda: db.bulk_set_outflows_paid(True, **selection),
+        'unpaid': lambda: db.bulk_set_outflows_paid(False, **selection),
+        'returned': lambda: db.bulk_set_outflows_returned(True, **selection),
+        'unreturned': lambda: db.bulk_set_outflows_returned(False, **selection),
+    }
+    if action not in actions:
+        return None
+    return actions[action]()
+
+@app.route('/outflows/bulk', methods=['POST'])
+def bulk_outflows():
+    selection = {
+        'ids': request.form.getlist('ids', type=int),
+        'order_numbers': split_list(request.form.get('order_numbers', '')),
+        'start_date': request.form.get('start_date') or None,
+        'end_date': request.form.get('end_date') or None,
+        'center_id': request.form.get('center_id', type=int),
+    }
+    count = apply_bulk_outflow_action(request.form.get('action'), selection)
+    if count is None:
+        flash('عملیات نامعتبر است', 'error')
+    else:
+        flash(f'وضعیت {count} خروجی تغییر کرد', 'success')
+    return redirect(url_for('outflows'))
+
 
 # ==================== مراکز فروش ====================
 @app.route('/centers')
+@cached_page
 def centers():
     centers_list = db.get_centers()
     return render_template('centers.html', centers=centers_list)
@@ -823,6 +4319,7 @@ def edit_center(center_id):
 
 # ==================== کمیسیون ====================
 @app.route('/commissions')
+@cached_page
 def commissions():
     categories = db.get_categories()
     centers = db.get_centers()
@@ -869,10 +4366,13 @@ def set_product_category():
 # ==================== تسویه حساب ====================
 @app.route('/settlements')
 def settlements():
-    centers = db.get_centers()
-    settlements_list = db.get_settlements()
-    debts = db.get_center_debts()
-    return render_template('settlements.html', centers=centers, settlements=settlements_list, debts=debts)
+    with db.read_snapshot():
+        centers = db.get_centers()
+        settlements_list = db.get_settlements()
+        debts = db.get_center_debts()
+        balances = {row['id']: row['balance'] for row in db.get_center_balances()}
+    return render_template('settlements.html', centers=centers, settlements=settlements_list, debts=debts,
+                           balances=balances)
 
 @app.route('/settlements/add', methods=['POST'])
 def add_settlement():
@@ -883,10 +4383,16 @@ def add_settlement():
     month = request.form.get('month', type=int)
     day = request.form.get('day', type=int)
     
+    allocate = request.form.get('allocate') == '1'
+    
     if center_id and amount:
         settlement_date = persian_to_gregorian(year, month, day)
-        db.add_settlement(center_id, amount, settlement_date, description)
-        flash('تسویه ثبت شد', 'success')
+        _, allocation = db.add_settlement(center_id, amount, settlement_date, description, allocate)
+        if allocation:
+            flash(f"تسویه ثبت شد و {allocation['count']} خروجی پرداخت شد "
+                  f"(مانده تخصیص‌نیافته: {format_number(allocation['unallocated'])})", 'success')
+        else:
+            flash('تسویه ثبت شد', 'success')
     
     return redirect(url_for('settlements'))
 
@@ -897,13 +4403,70 @@ def delete_settlement(settlement_id):
     return redirect(url_for('settlements'))
 
 
+# ==================== نرخ دلار ====================
+@app.route('/exchange_rates')
+def exchange_rates():
+    rate_date, today_rate = db.get_rate_on()
+    return render_template('exchange_rates.html', rates=db.get_exchange_rates(),
+                           rate_date=rate_date, today_rate=today_rate)
+
+@app.route('/exchange_rates/add', methods=['POST'])
+def add_exchange_rate():
+    rate = request.form.get('rate', type=float)
+    year = request.form.get('year', type=int)
+    month = request.form.get('month', type=int)
+    day = request.form.get('day', type=int)
+    
+    if rate and rate > 0:
+        db.set_exchange_rate(persian_to_gregorian(year, month, day), rate)
+        flash('نرخ دلار ثبت شد', 'success')
+    else:
+        flash('نرخ نامعتبر است', 'error')
+    
+    return redirect(url_for('exchange_rates'))
+
+@app.route('/exchange_rates/delete/<rate_date>', methods=['POST'])
+def delete_exchange_rate(rate_date):
+    db.delete_exchange_rate(rate_date)
+    flash('نرخ حذف شد', 'success')
+    return redirect(url_for('exchange_rates'))
+
+@app.route('/api/revaluation')
+def api_revaluation():
+    """ارزش موجودی و بهای تمام شده به دلار و با نرخ امروز"""
+    return jsonify(db.get_revaluation())
+
+
 # ==================== حساب نقدی ====================
 @app.route('/cash')
 def cash():
-    transactions = db.get_cash_transactions()
-    deposits, withdraws, balance = db.get_cash_summary()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', CASH_PAGE_SIZE, type=int), 1), 500)
+    as_of = None
+    if request.args.get('as_of_year'):
+        as_of = persian_to_gregorian(request.args.get('as_of_year'), request.args.get('as_of_month', 12),
+                                     request.args.get('as_of_day', 29))
+    with db.read_snapshot():
+        transactions, total = db.get_cash_page(page, per_page)
+        deposits, withdraws, balance = db.get_cash_summary()
+        opening_balance = db.get_cash_opening_balance()
+        as_of_balance = db.get_ledger_balance('cash', as_of) if as_of else None
     return render_template('cash.html', transactions=transactions, 
-                          deposits=deposits, withdraws=withdraws, balance=balance)
+                          deposits=deposits, withdraws=withdraws, balance=balance,
+                          opening_balance=opening_balance, page=page, per_page=per_page,
+                          pages=max((total + per_page - 1) // per_page, 1), as_of_balance=as_of_balance)
+
+@app.route('/api/ledger')
+def api_ledger():
+    """مانده همه حساب‌ها (یا یک حساب با account) تا پایان روز as_of (YYYY-MM-DD)"""
+    as_of = request.args.get('as_of') or None
+    accounts = [request.args['account']] if request.args.get('account') else db.get_ledger_accounts()
+    try:
+        with db.read_snapshot():
+            balances = [db.get_ledger_balance(account, as_of) for account in accounts]
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'as_of': as_of, 'accounts': balances})
 
 @app.route('/cash/add', methods=['POST'])
 def add_cash_transaction():
@@ -929,40 +4492,312 @@ def delete_cash_transaction(trans_id):
     return redirect(url_for('cash'))
 
 
+# ==================== سال مالی ====================
+@app.route('/fiscal')
+def fiscal_years():
+    closings = db.get_fiscal_closings()
+    return render_template('fiscal_years.html', closings=closings)
+
+@app.route('/fiscal/close', methods=['POST'])
+def close_fiscal_year():
+    year = request.form.get('year', type=int)
+    
+    if year:
+        success, msg = db.close_fiscal_year(year)
+        flash(msg, 'success' if success else 'error')
+    
+    return redirect(url_for('fiscal_years'))
+
+
 # ==================== گزارشات ====================
-@app.route('/reports')
-def reports():
-    stats = db.get_dashboard_stats()
-    products_list = db.get_products()
-    centers = db.get_centers()
+def build_reports_context(manager):
+    """داده‌های صفحه گزارشات (مشترک بین روت و کار پس‌زمینه)؛ همه ارقام از یک snapshot خوانده می‌شوند
     
-    # آمار مراکز
-    center_stats = []
-    for center in centers:
-        result = db.execute_query("""
-            SELECT COUNT(*) as count, COALESCE(SUM(quantity), 0) as qty, 
-                   COALESCE(SUM(quantity * sell_price), 0) as sales,
-                   COALESCE(SUM((quantity * sell_price) - (quantity * cogs_unit) - commission_amount - shipping_cost), 0) as profit
-            FROM outflows WHERE center_id = ? AND is_returned = 0
-        """, (center['id'],))
-        if result:
-            center_stats.append({
-                'name': center['name'],
-                'count': result[0]['count'],
-                'qty': result[0]['qty'],
-                'sales': result[0]['sales'],
-                'profit': result[0]['profit']
-            })
+    (تجمیع‌های ستونی هم از همین snapshot، مگر نسخه حافظه جدیدتر باشد؛ ColumnarAnalytics.refresh)
+    """
+    with manager.read_snapshot():
+        return _reports_context(manager)
+
+def _reports_context(manager):
+    stats = manager.get_dashboard_stats()
+    products_list = manager.get_products()
+    centers = manager.get_centers()
+    
+    # تجمیع‌ها روی نسخه ستونی خروجی‌ها (شامل فایل‌های آرشیو سال‌های بسته شده)
+    analytics = manager.analytics
+    product_names = {p['id']: f"{p['name']} {p['color'] or ''}".strip() for p in products_list}
+    center_names = {c['id']: c['name'] for c in centers}
+    category_names = {c['id']: c['name'] for c in manager.get_categories() or []}
     
-    return render_template('reports.html', stats=stats, products=products_list, center_stats=center_stats)
+    center_stats = [
+        dict(row, name=center_names.get(row['key'], '-'))
+        for row in analytics.group_by('center') if row['key'] in center_names
+    ]
+    product_stats = sorted(
+        (dict(row, name=product_names.get(row['key'], f"#{row['key']}")) for row in analytics.group_by('product')),
+        key=lambda row: row['revenue'], reverse=True
+    )
+    category_stats = [
+        dict(row, name=category_names.get(row['key'], 'بدون دسته'))
+        for row in analytics.group_by('category')
+    ]
+    month_stats = [
+        dict(row, name=f"{row['key'] // 100}/{row['key'] % 100:02d}" if row['key'] else '-')
+        for row in analytics.group_by('month')
+    ]
+    
+    return {'stats': stats, 'products': products_list, 'center_stats': center_stats,
+            'product_stats': product_stats, 'category_stats': category_stats, 'month_stats': month_stats,
+            'revaluation': manager.get_revaluation()}
+
+@app.route('/reports')
+@cached_page
+def reports():
+    return render_template('reports.html', **build_reports_context(db))
+
+
+def profitability_args():
+    """پارامترهای مرتب‌سازی، صفحه و فیلتر گزارش سودآوری از query string"""
+    sort = request.args.get('sort', 'revenue')
+    return {
+        'sort': sort if sort in PROFITABILITY_SORTS else 'revenue',
+        'descending': request.args.get('dir', 'desc') != 'asc',
+        'page': max(request.args.get('page', 1, type=int), 1),
+        'per_page': min(max(request.args.get('per_page', 50, type=int), 1), 500),
+        'abc_revenue': request.args.get('abc_revenue') if request.args.get('abc_revenue') in ('A', 'B', 'C') else None,
+        'abc_profit': request.args.get('abc_profit') if request.args.get('abc_profit') in ('A', 'B', 'C') else None,
+    }
+
+@app.route('/reports/products')
+def product_profitability():
+    args = profitability_args()
+    db.refresh_profitability()
+    rows, total, totals = db.get_profitability(**args)
+    pages = max((total + args['per_page'] - 1) // args['per_page'], 1)
+    return render_template('product_profitability.html', rows=rows, total=total, totals=totals,
+                           pages=pages, args=args, sorts=PROFITABILITY_SORTS)
+
+@app.route('/api/reports/products')
+def api_product_profitability():
+    args = profitability_args()
+    db.refresh_profitability()
+    rows, total, totals = db.get_profitability(**args)
+    return jsonify({
+        'total': total,
+        'page': args['page'],
+        'per_page': args['per_page'],
+        'totals': totals,
+        'rows': [dict(row) for row in rows]
+    })
+
+def parse_series_date(value):
+    """تاریخ میلادی YYYY-MM-DD یا شمسی YYYY/MM/DD"""
+    if not value:
+        return None
+    if '/' in value:
+        return persian_to_gregorian(*value.split('/')[:3])
+    return value
+
+@app.route('/api/prices/series')
+def api_price_series():
+    bucket = request.args.get('bucket', 'week')
+    if bucket not in PRICE_SERIES_BUCKETS:
+        return jsonify({'success': False, 'message': f"bucket must be one of {', '.join(PRICE_SERIES_BUCKETS)}"}), 400
+    points = min(max(request.args.get('points', PRICE_SERIES_POINTS, type=int), 3), PRICE_SERIES_MAX_POINTS)
+    product_id = request.args.get('product_id', type=int)
+    center_id = request.args.get('center_id', type=int)
+    series = db.get_price_series(product_id, center_id, bucket, points,
+                                 parse_series_date(request.args.get('start')), parse_series_date(request.args.get('end')))
+    return jsonify({'product_id': product_id, 'center_id': center_id, 'bucket': bucket, 'points': points,
+                    'series': series})
+
+@app.route('/reports/reorder')
+def reorder_report():
+    show_all = request.args.get('all') == '1'
+    return render_template('reorder.html', rows=db.get_reorder_report(only_due=not show_all),
+                           show_all=show_all, windows=FORECAST_WINDOWS)
+
+@app.route('/api/forecasts')
+def api_forecasts():
+    return jsonify([dict(row) for row in db.get_reorder_report(only_due=request.args.get('all') != '1') or []])
+
+
+# ==================== متریک‌ها ====================
+@app.route('/metrics')
+def metrics():
+    return jsonify({
+        'write_generation': db.get_write_generation(),
+        'tenant': current_tenant().stats(),
+        'tenants': tenants.stats(),
+        'page_cache': response_cache.stats(),
+        'writer': db.writer.stats(),
+        'readers': db.readers.stats(),
+        'analytics': db.analytics.stats(),
+        'fifo_cache': db.fifo.stats(),
+        'maintenance': db.maintenance.stats(),
+        'startup': startup_report
+    })
 
 
 # ==================== API برای AJAX ====================
+@app.route('/api/analytics/<dimension>')
+def api_analytics(dimension):
+    """فروش، سود، حاشیه و نرخ برگشت به تفکیک product / center / category / month"""
+    if dimension not in ANALYTICS_DIMENSIONS:
+        return jsonify({'success': False, 'message': 'بعد نامعتبر'}), 400
+    try:
+        rows = db.analytics.group_by(dimension, request.args.get('start_date'), request.args.get('end_date'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'تاریخ نامعتبر'}), 400
+    return jsonify({'success': True, 'dimension': dimension, 'rows': rows})
+
+@app.route('/api/analytics/pivot')
+def api_analytics_pivot():
+    """جدول متقاطع: ?rows=product&cols=month&metric=profit"""
+    rows = request.args.get('rows', 'product')
+    cols = request.args.get('cols', 'month')
+    metric = request.args.get('metric', 'revenue')
+    if rows not in ANALYTICS_DIMENSIONS or cols not in ANALYTICS_DIMENSIONS or metric not in ANALYTICS_METRICS:
+        return jsonify({'success': False, 'message': 'پارامتر نامعتبر'}), 400
+    try:
+        result = db.analytics.pivot(rows, cols, metric, request.args.get('start_date'), request.args.get('end_date'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'تاریخ نامعتبر'}), 400
+    return jsonify(dict(result, success=True, metric=metric))
+
+@app.route('/api/outflows/bulk', methods=['POST'])
+def api_bulk_outflows():
+    """تغییر گروهی وضعیت خروجی‌ها با لیست کد، لیست شماره سفارش یا بازه تاریخ"""
+    data = request.json or {}
+    selection = {
+        'ids': data.get('ids'),
+        'order_numbers': data.get('order_numbers'),
+        'start_date': data.get('start_date'),
+        'end_date': data.get('end_date'),
+        'center_id': data.get('center_id'),
+    }
+    count = apply_bulk_outflow_action(data.get('action'), selection)
+    if count is None:
+        return jsonify({'success': False, 'message': 'عملیات نامعتبر است'}), 400
+    return jsonify({'success': True, 'count': count})
+
+@app.route('/api/settlements', methods=['POST'])
+def api_add_settlement():
+    """ثبت تسویه با تخصیص خودکار به خروجی‌های پرداخت‌نشده"""
+    data = request.json or {}
+    try:
+        center_id = int(data.get('center_id') or 0)
+        amount = float(data.get('amount') or 0)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'مرکز یا مبلغ نامعتبر است'}), 400
+    if not center_id or not amount:
+        return jsonify({'success': False, 'message': 'اطلاعات ناقص است'}), 400
+    settlement_date = data.get('settlement_date') or datetime.date.today().isoformat()
+    settlement_id, allocation = db.add_settlement(center_id, amount, settlement_date,
+                                                  data.get('description', ''), data.get('allocate', True))
+    if not settlement_id:
+        return jsonify({'success': False, 'message': 'خطا در ثبت تسویه'}), 500
+    return jsonify({'success': True, 'id': settlement_id, 'allocation': allocation})
+
 @app.route('/api/fifo_cost/<int:product_id>/<float:quantity>')
 def api_fifo_cost(product_id, quantity):
     cogs, _ = db.calculate_fifo_cost(product_id, quantity)
     return jsonify({'cogs': cogs})
 
+@app.route('/api/fifo_quote', methods=['POST'])
+def api_fifo_quote():
+    """پیش‌نمایش بهای تمام شده چند ردیف سفارش در یک درخواست: {"items": [{"product_id": 1, "quantity": 2}, ...]}"""
+    items = (request.json or {}).get('items') or []
+    if len(items) > SCAN_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'حداکثر {SCAN_BATCH_LIMIT} ردیف در هر درخواست'}), 413
+    try:
+        pairs = [(int(item['product_id']), float(item['quantity'])) for item in items]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'ردیف نامعتبر است'}), 400
+    quotes = db.fifo.quote_many(pairs)
+    results = [
+        {'product_id': product_id, 'quantity': quantity, 'cogs': cogs,
+         'cost': cogs * quantity if cogs is not None else None, 'available': db.fifo.available(product_id)}
+        for (product_id, quantity), cogs in zip(pairs, quotes)
+    ]
+    return jsonify({
+        'success': True,
+        'items': results,
+        'total_cost': sum(row['cost'] for row in results) if all(q is not None for q in quotes) else None
+    })
+
+# ==================== API نسخه ۱ ====================
+def fast_json(payload, status=200):
+    """پاسخ JSON فشرده با orjson (در صورت نصب)؛ مدل‌های tuple به صورت آرایه سریال می‌شوند"""
+    if orjson is not None:
+        body = orjson.dumps(payload, default=tuple)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return Response(body, status=status, mimetype='application/json')
+
+
+def api_v1_filters(spec):
+    filters = {}
+    for name in spec['filters']:
+        value = request.args.get(name)
+        if value in (None, ''):
+            continue
+        if name in ('start', 'end', 'as_of'):
+            value = parse_series_date(value)
+        elif name in ('is_returned', 'is_paid', 'in_stock'):
+            value = 1 if value.lower() in ('1', 'true', 'yes') else 0
+        filters[name] = value
+    return filters
+
+
+@app.route('/api/v1')
+def api_v1_index():
+    return fast_json({'version': 1, 'resources': {
+        name: {'fields': spec['fields'], 'filters': list(spec['filters'])} for name, spec in API_V1_RESOURCES.items()
+    }})
+
+@app.route('/api/v1/<resource>')
+def api_v1_list(resource):
+    """?fields=id,name (انتخاب ستون‌ها)، ?shape=rows (آرایه به جای شیء)، ?after=<id>&limit= و فیلترهای هر منبع
+    
+    ETag از نسخه نوشتن دیتابیس و پارامترها ساخته می‌شود؛ If-None-Match برابر بدون کوئری 304 برمی‌گرداند.
+    """
+    spec = API_V1_RESOURCES.get(resource)
+    if spec is None:
+        return fast_json({'success': False, 'message': f"unknown resource: {resource}"}, 404)
+    fields = tuple(name.strip() for name in request.args.get('fields', '').split(',') if name.strip()) or spec['fields']
+    unknown = [name for name in fields if name not in spec['fields']]
+    if unknown:
+        return fast_json({'success': False, 'message': f"unknown field(s): {', '.join(unknown)}"}, 400)
+    if 'id' in spec['fields'] and 'id' not in fields:
+        # صفحه‌بندی به id نیاز دارد
+        fields = ('id',) + fields
+    
+    etag = "v1-{}-{:08x}".format(db.get_write_generation(), zlib.crc32(
+        f"{current_tenant().name}|{resource}|{sorted(request.args.items(multi=True))}".encode('utf-8')))
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    
+    limit = min(max(request.args.get('limit', API_V1_PAGE_SIZE, type=int), 1), API_V1_MAX_PAGE_SIZE)
+    try:
+        rows = db.get_api_rows(resource, fields, api_v1_filters(spec), request.args.get('after', 0, type=int), limit)
+    except ValueError as e:
+        return fast_json({'success': False, 'message': str(e)}, 400)
+    payload = {'resource': resource, 'fields': fields, 'count': len(rows)}
+    if request.args.get('shape') == 'rows':
+        payload['rows'] = rows
+    else:
+        payload['data'] = [row._asdict() for row in rows]
+    if resource != 'ledgers':
+        payload['next_after'] = rows[-1].id if len(rows) == limit else None
+    response = fast_json(payload)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.route('/api/product_stock/<int:product_id>')
 def api_product_stock(product_id):
     product = db.get_product(product_id)
@@ -974,14 +4809,24 @@ def api_product_stock(product_id):
 # ==================== بکاپ ====================
 @app.route('/backup/download')
 def download_backup():
-    if os.path.exists(DB_PATH):
-        return send_file(
-            DB_PATH,
-            as_attachment=True,
-            download_name=f"warehouse_backup_{get_persian_today().strftime('%Y%m%d')}.db"
-        )
-    flash('فایل دیتابیس یافت نشد', 'error')
-    return redirect(url_for('dashboard'))
+    if not os.path.exists(db.db_path):
+        flash('فایل دیتابیس یافت نشد', 'error')
+        return redirect(url_for('dashboard'))
+    # فایل اصلی بدون WAL ناقص است؛ یک کپی سازگار از طریق نویسنده ساخته می‌شود
+    path = f"{db.db_path}.download-{os.getpid()}-{threading.get_ident()}"
+    success, message = db.backup_to(path)
+    if not success:
+        flash(message, 'error')
+        return redirect(url_for('dashboard'))
+    # فایل باز می‌ماند و نامش همین‌جا حذف می‌شود؛ با بسته شدن پاسخ فضا آزاد می‌شود
+    file = open(path, 'rb')
+    os.remove(path)
+    return send_file(
+        file,
+        mimetype='application/octet-stream',
+        as_attachment=True,
+        download_name=f"warehouse_backup_{get_persian_today().strftime('%Y%m%d')}.db"
+    )
 
 @app.route('/backup/upload', methods=['POST'])
 def upload_backup():
@@ -995,11 +4840,8 @@ def upload_backup():
         return redirect(url_for('dashboard'))
     
     if file:
-        os.makedirs(os.path.dirname(DB_PATH) if os.path.dirname(DB_PATH) else '.', exist_ok=True)
-        file.save(DB_PATH)
-        global db
-        db = DBManager()
-        flash('دیتابیس بازیابی شد', 'success')
+        success, message = current_tenant().restore(file)
+        flash(message, 'success' if success else 'error')
     
     return redirect(url_for('dashboard'))
 
@@ -1030,6 +4872,71 @@ def generate_barcode_image(barcode_text):
         print(f"Barcode Error: {e}")
         return None
 
+def _zpl_field(text):
+    """متن فیلد ZPL با ^FH: کاراکترهای کنترلی ^ ~ و _ به صورت hex"""
+    return ''.join(f"_{ord(char):02X}" if char in '^~_' else char for char in str(text or ''))
+
+
+def _label_text(text, unicode_font):
+    """متن قابل چاپ برچسب؛ بدون فونت یونیکد متن غیرلاتین به جای مربع‌های خالی حذف می‌شود"""
+    text = str(text or '')
+    return text if unicode_font or text.isascii() else ''
+
+
+def zpl_label(barcode_text, name, color='', copies=1):
+    """برچسب ZPL: نام، رنگ و Code128؛ تعداد نسخه با ^PQ در خود چاپگر"""
+    width, height = LABEL_WIDTH_DOTS, LABEL_HEIGHT_DOTS
+    name, color = _label_text(name, LABEL_ZPL_FONT), _label_text(color, LABEL_ZPL_FONT)
+    font = f"^A@N,{{size}},{{size}},{LABEL_ZPL_FONT}" if LABEL_ZPL_FONT else "^A0N,{size},{size}"
+    lines = ["^XA", "^CI28"]  # UTF-8
+    if LABEL_ZPL_FONT:
+        lines.append("^PA0,1,1,0")  # چیدمان راست به چپ و اتصال حروف (فقط با فونت TrueType)
+    lines.append(f"^PW{width}^LL{height}")
+    if name:
+        lines.append(f"^FO10,{height // 14}{font.format(size=height // 7)}^FB{width - 20},1,0,C^FH^FD{_zpl_field(name)}^FS")
+    if color:
+        lines.append(f"^FO10,{height * 4 // 16}{font.format(size=height // 9)}^FB{width - 20},1,0,C^FH^FD{_zpl_field(color)}^FS")
+    lines += [
+        f"^FO{width // 10},{height * 6 // 16}^BY2^BCN,{height * 3 // 8},Y,N,N^FH^FD{_zpl_field(barcode_text)}^FS",
+        f"^PQ{copies},0,1,Y",
+        "^XZ",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def epl_label(barcode_text, name, color='', copies=1):
+    """برچسب EPL2 (چاپگرهای قدیمی‌تر)؛ تعداد نسخه با دستور P"""
+    def quoted(text):
+        return '"' + str(text or '').replace('\\', '\\\\').replace('"', '\\"') + '"'
+    width, height = LABEL_WIDTH_DOTS, LABEL_HEIGHT_DOTS
+    # فونت‌های داخلی EPL حروف فارسی ندارند
+    name, color = _label_text(name, False), _label_text(color, False)
+    lines = ["", "N", f"q{width}", f"Q{height},24"]
+    if name:
+        lines.append(f"A10,{height // 14},0,3,1,1,N,{quoted(name)}")
+    if color:
+        lines.append(f"A10,{height * 4 // 16},0,2,1,1,N,{quoted(color)}")
+    lines += [f"B{width // 10},{height * 6 // 16},0,1,2,4,{height * 3 // 8},B,{quoted(barcode_text)}", f"P{copies}", ""]
+    return "\r\n".join(lines)
+
+
+LABEL_RENDERERS = {'zpl': zpl_label, 'epl': epl_label}
+
+
+def label_response(chunks, label_format, filename):
+    """ارسال متن برچسب به صورت جریان خام (برای ارسال مستقیم به پورت 9100) یا فایل دانلودی با ?download=1"""
+    response = Response(stream_with_context(chunks), mimetype='text/plain')
+    if request.args.get('download') == '1':
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{label_format}"'
+    return response
+
+
+def label_args():
+    label_format = request.args.get('format', 'zpl')
+    copies = request.args.get('count', '1')
+    return (label_format if label_format in LABEL_FORMATS else None,
+            copies if copies == 'stock' else min(max(int(copies) if copies.isdigit() else 1, 1), LABEL_MAX_COPIES))
+
 @app.route('/barcode/generate/<int:product_id>')
 def generate_barcode(product_id):
     """تولید بارکد برای یک محصول"""
@@ -1065,16 +4972,18 @@ def barcode_image(barcode_text):
 @app.route('/barcode/print')
 def print_barcodes():
     """صفحه چاپ بارکد برای همه محصولات"""
-    products = db.get_products()
-    barcodes = []
-    for product in products:
-        barcode_text = product['barcode'] or f"P{product['id']:08d}"
-        barcodes.append({
-            'product': product,
-            'barcode_text': barcode_text,
-            'barcode_img': generate_barcode_image(barcode_text)
-        })
-    return render_template('barcode_print.html', barcodes=barcodes)
+    count = db.execute_query("SELECT COUNT(*) as cnt FROM products")
+    
+    def barcodes():
+        # تصویر هر بارکد درست قبل از ارسال همان ردیف ساخته می‌شود
+        for product in db.get_products(stream=True):
+            barcode_text = product['barcode'] or f"P{product['id']:08d}"
+            yield {
+                'product': product,
+                'barcode_text': barcode_text,
+                'barcode_img': generate_barcode_image(barcode_text)
+            }
+    return render_list_page('barcode_print.html', barcodes=barcodes(), barcode_count=count[0]['cnt'] if count else 0)
 
 @app.route('/barcode/print/<int:product_id>')
 def print_single_barcode(product_id):
@@ -1095,6 +5004,41 @@ def print_single_barcode(product_id):
     
     return render_template('barcode_print.html', barcodes=barcodes, single=True)
 
+@app.route('/barcode/label/<int:product_id>')
+def product_label(product_id):
+    """برچسب ZPL/EPL یک محصول: ?format=zpl|epl&count=N (یا count=stock)&download=1"""
+    label_format, copies = label_args()
+    if label_format is None:
+        return 'format must be zpl or epl', 400
+    product = db.get_product(product_id)
+    if product is None:
+        return 'product not found', 404
+    if copies == 'stock':
+        copies = min(max(int(product['stock'] or 0), 1), LABEL_MAX_COPIES)
+    label = LABEL_RENDERERS[label_format](product['barcode'] or f"P{product_id:08d}", product['name'], product['color'], copies)
+    return label_response(iter([label]), label_format, f"label_{product_id}")
+
+@app.route('/barcode/labels')
+def product_labels():
+    """برچسب همه محصولات (یا ?ids=1,2,3) در یک جریان؛ با count=stock تعداد هر برچسب برابر موجودی است"""
+    label_format, copies = label_args()
+    if label_format is None:
+        return 'format must be zpl or epl', 400
+    ids = {int(value) for value in split_list(request.args.get('ids', '')) if value.isdigit()}
+    render = LABEL_RENDERERS[label_format]
+    
+    def labels():
+        for product in db.get_products(stream=True):
+            if ids and product['id'] not in ids:
+                continue
+            count = copies
+            if copies == 'stock':
+                count = min(int(product['stock'] or 0), LABEL_MAX_COPIES)
+                if count <= 0:
+                    continue
+            yield render(product['barcode'] or f"P{product['id']:08d}", product['name'], product['color'], count)
+    return label_response(labels(), label_format, f"labels_{get_persian_today().strftime('%Y%m%d')}")
+
 
 # ==================== اسکن بارکد ====================
 @app.route('/scan')
@@ -1103,17 +5047,24 @@ def scan_menu():
     return render_template('scan_menu.html')
 
 @app.route('/scan/inflow')
+@cached_page
 def scan_inflow():
     """صفحه اسکن برای ورودی انبار"""
     categories = db.get_categories()
     return render_template('scan_inflow.html', categories=categories)
 
 @app.route('/scan/outflow')
+@cached_page
 def scan_outflow():
     """صفحه اسکن برای خروجی انبار"""
     centers = db.get_centers()
     return render_template('scan_outflow.html', centers=centers)
 
+@app.route('/scan/return')
+def scan_return():
+    """صفحه اسکن شماره سفارش برای ثبت برگشتی"""
+    return render_template('scan_return.html')
+
 @app.route('/scan/inventory')
 def scan_inventory():
     """صفحه اسکن برای بررسی موجودی"""
@@ -1155,89 +5106,644 @@ def api_barcode_search(barcode_text):
     
     return jsonify({'found': False, 'message': 'محصول یافت نشد'})
 
+@app.route('/api/orders/<path:order_number>')
+def api_order_lines(order_number):
+    """ردیف‌های یک سفارش (برای انتخاب ردیف‌های برگشتی)"""
+    lines = db.get_order_lines(order_number)
+    return jsonify({
+        'found': bool(lines),
+        'order_number': order_number,
+        'lines': [dict(line) for line in lines]
+    })
+
+@app.route('/api/returns', methods=['POST'])
+def api_returns():
+    """برگشت سفارش‌ها: {"order_numbers": [...], "outflow_ids": [...]}؛ بدون outflow_ids همه ردیف‌ها برمی‌گردند"""
+    data = request.json or {}
+    order_numbers = data.get('order_numbers') or ([data['order_number']] if data.get('order_number') else [])
+    outflow_ids = data.get('outflow_ids') or []
+    if not order_numbers:
+        return jsonify({'success': False, 'message': 'شماره سفارش وارد نشده'}), 400
+    if len(order_numbers) > RETURN_BATCH_LIMIT or len(outflow_ids) > RETURN_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'حداکثر {RETURN_BATCH_LIMIT} مورد در هر درخواست'}), 413
+    try:
+        result = db.return_orders(order_numbers, outflow_ids)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'ردیف نامعتبر است'}), 400
+    if result is None:
+        return jsonify({'success': False, 'message': 'خطا در ثبت برگشتی'}), 500
+    return jsonify(dict(result, success=True))
+
+def scan_request_payload(kind):
+    data = dict(request.json or {})
+    data['kind'] = kind
+    data.setdefault('idempotency_key', request.headers.get('Idempotency-Key'))
+    return data
+
 @app.route('/api/scan/inflow', methods=['POST'])
 def api_scan_inflow():
     """ثبت ورودی با اسکن"""
-    data = request.json
-    barcode_text = data.get('barcode')
-    quantity = data.get('quantity', 1)
-    buy_price = data.get('buy_price', 0)
-    dollar_rate = data.get('dollar_rate', 0)
+    return jsonify(db.process_scans([scan_request_payload('inflow')])[0])
+
+@app.route('/api/scan/outflow', methods=['POST'])
+def api_scan_outflow():
+    """ثبت خروجی با اسکن"""
+    return jsonify(db.process_scans([scan_request_payload('outflow')])[0])
+
+@app.route('/api/scan/batch', methods=['POST'])
+def api_scan_batch():
+    """ثبت دسته‌ای اسکن‌های صف‌شده در مرورگر؛ هر اسکن کلید یکتایی خودش را دارد"""
+    scans = (request.json or {}).get('scans') or []
+    if len(scans) > SCAN_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'حداکثر {SCAN_BATCH_LIMIT} اسکن در هر درخواست'}), 413
+    responses = db.process_scans(scans)
+    return jsonify({
+        'success': True,
+        'results': [dict(response, idempotency_key=scan.get('idempotency_key'))
+                    for scan, response in zip(scans, responses)]
+    })
+
+
+# ==================== صف کارهای پس‌زمینه ====================
+JOBS_DIR = os.path.join(os.path.dirname(DB_PATH) or '.', 'jobs')
+
+
+class JobQueue:
+    """صف کارهای سنگین در یک فایل SQLite جدا تا قفل نوشتن دیتابیس اصلی درگیر نشود"""
     
-    # پیدا کردن محصول
-    result = db.execute_query(
-        "SELECT id FROM products WHERE barcode = ?",
-        (barcode_text,)
-    )
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = self.get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                params TEXT DEFAULT '{}',
+                status TEXT DEFAULT 'queued',
+                progress REAL DEFAULT 0,
+                message TEXT DEFAULT '',
+                result_file TEXT DEFAULT '',
+                download_name TEXT DEFAULT '',
+                tenant TEXT DEFAULT 'default',
+                worker_pid INTEGER,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT
+            )
+        ''')
+        columns = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if 'tenant' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN tenant TEXT DEFAULT 'default'")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)")
+        conn.commit()
+        conn.close()
     
-    if not result:
-        return jsonify({'success': False, 'message': 'محصول یافت نشد'})
+    def get_connection(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    def _execute(self, query, params=()):
+        conn = self.get_connection()
+        try:
+            cursor = conn.execute(query, params)
+            result = cursor.fetchall()
+            conn.commit()
+            return result, cursor.lastrowid
+        finally:
+            conn.close()
     
-    product_id = result[0]['id']
-    inflow_date = datetime.date.today().isoformat()
+    def enqueue(self, kind, params=None, tenant=DEFAULT_TENANT):
+        _, job_id = self._execute(
+            "INSERT INTO jobs (kind, params, tenant, created_at) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(params or {}), tenant, datetime.datetime.now().isoformat(timespec='seconds'))
+        )
+        return job_id
+    
+    def get(self, job_id, tenant=DEFAULT_TENANT):
+        result, _ = self._execute("SELECT * FROM jobs WHERE id = ? AND tenant = ?", (job_id, tenant))
+        return result[0] if result else None
     
-    db.add_inflow(product_id, quantity, buy_price, inflow_date, dollar_rate)
+    def get_recent(self, limit=50, tenant=DEFAULT_TENANT):
+        result, _ = self._execute("SELECT * FROM jobs WHERE tenant = ? ORDER BY id DESC LIMIT ?", (tenant, limit))
+        return result
     
-    # گرفتن اطلاعات به‌روز شده
-    product = db.get_product(product_id)
+    def claim(self):
+        """برداشتن قدیمی‌ترین کار در صف به صورت اتمیک"""
+        conn = self.get_connection()
+        conn.isolation_level = None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker_pid = ?, started_at = ? WHERE id = ?",
+                    (os.getpid(), datetime.datetime.now().isoformat(timespec='seconds'), row['id'])
+                )
+            conn.execute("COMMIT")
+            return row
+        finally:
+            conn.close()
+    
+    def set_progress(self, job_id, progress, message=''):
+        self._execute("UPDATE jobs SET progress = ?, message = ? WHERE id = ?", (round(progress, 3), message, job_id))
+    
+    def finish(self, job_id, result_file, download_name):
+        self._execute(
+            "UPDATE jobs SET status = 'done', progress = 1, result_file = ?, download_name = ?, finished_at = ? WHERE id = ?",
+            (result_file, download_name, datetime.datetime.now().isoformat(timespec='seconds'), job_id)
+        )
+    
+    def fail(self, job_id, message):
+        self._execute(
+            "UPDATE jobs SET status = 'failed', message = ?, finished_at = ? WHERE id = ?",
+            (message, datetime.datetime.now().isoformat(timespec='seconds'), job_id)
+        )
     
+    def fail_interrupted(self):
+        """کارهایی که با توقف worker نیمه‌کاره مانده‌اند"""
+        self._execute(
+            "UPDATE jobs SET status = 'failed', message = 'interrupted', finished_at = ? WHERE status = 'running'",
+            (datetime.datetime.now().isoformat(timespec='seconds'),)
+        )
+
+
+job_queue = JobQueue(os.path.join(os.path.dirname(DB_PATH) or '.', 'jobs.db'))
+
+
+def render_job_template(template, **context):
+    """رندر قالب خارج از درخواست HTTP (در worker)"""
+    with app.test_request_context():
+        return render_template(template, **context)
+
+def job_reports(manager, job, progress):
+    progress(0.1, 'جمع‌آوری داده‌ها')
+    html = render_job_template('reports.html', **build_reports_context(manager))
+    path = os.path.join(JOBS_DIR, f"job_{job['id']}_reports.html")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return path, f"reports_{get_persian_today().strftime('%Y%m%d')}.html"
+
+def job_barcode_print(manager, job, progress):
+    products = manager.get_products() or []
+    barcodes = []
+    for index, product in enumerate(products):
+        barcode_text = product['barcode'] or f"P{product['id']:08d}"
+        barcodes.append({
+            'product': product,
+            'barcode_text': barcode_text,
+            'barcode_img': generate_barcode_image(barcode_text)
+        })
+        if index % 50 == 0:
+            progress(index / len(products), f"{index} از {len(products)}")
+    html = render_job_template('barcode_print.html', barcodes=barcodes)
+    path = os.path.join(JOBS_DIR, f"job_{job['id']}_barcodes.html")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return path, f"barcodes_{get_persian_today().strftime('%Y%m%d')}.html"
+
+def job_forecast(manager, job, progress):
+    progress(0.1, 'محاسبه سرعت فروش')
+    manager.refresh_forecasts(full=True)
+    progress(0.8, 'تهیه فهرست سفارش')
+    path = os.path.join(JOBS_DIR, f"job_{job['id']}_reorder.csv")
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'name', 'color', 'stock', 'velocity_30', 'lead_time_days',
+                         'days_of_cover', 'reorder_point', 'suggested_qty'])
+        for row in manager.get_reorder_report() or []:
+            writer.writerow([row['id'], row['name'], row['color'], row['stock'], round(row['velocity_30'], 3),
+                             round(row['lead_time_days'], 1),
+                             '' if row['days_of_cover'] is None else round(row['days_of_cover'], 1),
+                             round(row['reorder_point'], 1), math.ceil(row['suggested_qty'])])
+    return path, f"reorder_{get_persian_today().strftime('%Y%m%d')}.csv"
+
+def job_backup(manager, job, progress):
+    path = os.path.join(JOBS_DIR, f"job_{job['id']}_backup.db")
+    src = sqlite3.connect(manager.db_path)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst, pages=256, progress=lambda status, remaining, total: progress(
+            (total - remaining) / total if total else 1, 'کپی صفحات'))
+    finally:
+        dst.close()
+        src.close()
+    return path, f"warehouse_backup_{get_persian_today().strftime('%Y%m%d')}.db"
+
+
+JOB_HANDLERS = {
+    'reports': job_reports,
+    'barcode_print': job_barcode_print,
+    'backup': job_backup,
+    'forecast': job_forecast,
+}
+
+
+# یک DBManager برای هر دیتابیس در هر پروسه worker (نویسنده، اتصال‌ها و مهاجرت‌ها یک بار)
+job_managers = {}
+
+
+def job_manager(db_path):
+    key = (os.getpid(), db_path)
+    manager = job_managers.get(key)
+    if manager is None:
+        manager = job_managers[key] = DBManager(db_path)
+    return manager
+
+
+def run_job(queue, job):
+    params = json.loads(job['params'] or '{}')
+    handler = JOB_HANDLERS.get(job['kind'])
+    if not handler:
+        queue.fail(job['id'], 'نوع کار نامعتبر است')
+        return
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    try:
+        manager = job_manager(params.get('db_path'))
+        result_file, download_name = handler(manager, job, lambda p, m='': queue.set_progress(job['id'], p, m))
+        queue.finish(job['id'], result_file, download_name)
+    except Exception as e:
+        print(f"Job Error: {e}")
+        queue.fail(job['id'], str(e))
+
+def job_worker_loop(queue_path, poll_interval=1.0):
+    """حلقه یک پروسه worker؛ خارج از gunicorn اجرا می‌شود"""
+    queue = JobQueue(queue_path)
+    while True:
+        job = queue.claim()
+        if job:
+            run_job(queue, job)
+        else:
+            time.sleep(poll_interval)
+
+
+@app.cli.command('jobs-worker')
+@click.option('--processes', default=2, show_default=True, help='تعداد پروسه‌های worker')
+def jobs_worker_command(processes):
+    """اجرای استخر پروسه‌های کارهای پس‌زمینه"""
+    job_queue.fail_interrupted()
+    workers = [multiprocessing.Process(target=job_worker_loop, args=(job_queue.path,), daemon=True)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    print(f"{processes} job worker(s) started")
+    for worker in workers:
+        worker.join()
+
+
+@app.cli.command('verify-stock')
+@click.option('--full', is_flag=True, help='بررسی همه محصولات به جای محصولات تغییر کرده')
+@click.option('--repair', is_flag=True, help='اصلاح موجودی و remaining لات‌ها بر اساس گردش')
+def verify_stock_command(full, repair):
+    """بررسی صحت موجودی انبار"""
+    checked, mismatches = db.verify_stock(full=full, repair=repair)
+    for item in mismatches:
+        print(f"[{item['product_id']}] {item['name']} {item['color'] or ''}: "
+              f"stock={item['stock']} expected={item['expected_stock']} lots={item['lot_remaining']}")
+    print(f"{checked} product(s) checked, {len(mismatches)} mismatch(es)" + (" repaired" if repair and mismatches else ""))
+
+
+@app.cli.command('forecast')
+@click.option('--full', is_flag=True, help='محاسبه دوباره همه محصولات')
+def forecast_command(full):
+    """به‌روزرسانی سرعت فروش و نقطه سفارش محصولات (اجرای روزانه)"""
+    started = time.perf_counter()
+    count = db.refresh_forecasts(full=full)
+    print(f"{count} product forecast(s) refreshed in {time.perf_counter() - started:.2f}s")
+
+
+@app.cli.command('db-maintenance')
+@click.option('--task', 'tasks', multiple=True, type=click.Choice(MAINTENANCE_TASKS),
+              help='کار مورد نظر (قابل تکرار)؛ پیش‌فرض: optimize، incremental_vacuum، analyze و quick_check')
+def db_maintenance_command(tasks):
+    """اجرای دستی کارهای نگهداری دیتابیس"""
+    for task in tasks or ('optimize', 'incremental_vacuum', 'analyze', 'quick_check'):
+        db.maintenance.run(task)
+    print(json.dumps(db.maintenance.stats(), ensure_ascii=False))
+
+
+@app.cli.command('warm-up')
+def warm_up_command():
+    """کامپایل قالب‌ها در کش bytecode و گزارش زمان هر مرحله گرم کردن"""
+    warm_up()
+
+
+@app.cli.command('ledger-checkpoint')
+@click.option('--as-of', 'dates', multiple=True, help='تاریخ میلادی YYYY-MM-DD (قابل تکرار)؛ پیش‌فرض: پایان ماه‌های اخیر و دیروز')
+def ledger_checkpoint_command(dates):
+    """ثبت نقاط کنترل دفتر حساب نقدی و مراکز فروش"""
+    print(f"{db.create_ledger_checkpoints(list(dates) or None)} checkpoint(s) created")
+    print(json.dumps(db.get_ledger_balance('cash'), ensure_ascii=False))
+
+
+@app.route('/jobs')
+def jobs():
+    return render_template('jobs.html', jobs=job_queue.get_recent(tenant=current_tenant().name), kinds=list(JOB_HANDLERS))
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def enqueue_job(kind):
+    if kind not in JOB_HANDLERS:
+        flash('نوع کار نامعتبر است', 'error')
+        return redirect(url_for('jobs'))
+    job_id = job_queue.enqueue(kind, {'db_path': db.db_path}, current_tenant().name)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'id': job_id, 'status_url': url_for('api_job_status', job_id=job_id)}), 202
+    flash('کار در صف قرار گرفت', 'success')
+    return redirect(url_for('jobs'))
+
+@app.route('/api/jobs/<int:job_id>')
+def api_job_status(job_id):
+    job = job_queue.get(job_id, current_tenant().name)
+    if not job:
+        return jsonify({'found': False}), 404
     return jsonify({
-        'success': True,
-        'message': f'{quantity} عدد اضافه شد',
-        'product': {
-            'id': product['id'],
-            'name': product['name'],
-            'stock': product['stock']
-        }
+        'found': True,
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'message': job['message'],
+        'download_url': url_for('download_job', job_id=job_id) if job['status'] == 'done' else None
     })
 
-@app.route('/api/scan/outflow', methods=['POST'])
-def api_scan_outflow():
-    """ثبت خروجی با اسکن"""
-    data = request.json
-    barcode_text = data.get('barcode')
-    quantity = data.get('quantity', 1)
-    sell_price = data.get('sell_price', 0)
-    center_id = data.get('center_id')
-    commission = data.get('commission', 0)
-    shipping = data.get('shipping', 0)
-    order_number = data.get('order_number', '')
-    
-    # پیدا کردن محصول
-    result = db.execute_query(
-        "SELECT id, stock FROM products WHERE barcode = ?",
-        (barcode_text,)
+@app.route('/jobs/<int:job_id>/download')
+def download_job(job_id):
+    job = job_queue.get(job_id, current_tenant().name)
+    if not job or job['status'] != 'done' or not os.path.exists(job['result_file']):
+        flash('فایل نتیجه یافت نشد', 'error')
+        return redirect(url_for('jobs'))
+    return send_file(os.path.abspath(job['result_file']), as_attachment=True, download_name=job['download_name'])
+
+
+# ==================== ژورنال تغییرات و نسخه آماده ====================
+def apply_journal_entry(cursor, entry):
+    """اعمال یک رکورد ژورنال روی دیتابیس دیگر (نسخه آماده یا بازیابی)"""
+    table = entry['tbl']
+    if table not in JOURNAL_TABLES:
+        raise ValueError(f"unknown journal table: {table}")
+    pk = json.loads(entry['pk'])
+    where = " AND ".join(f"{name} = ?" for name in pk)
+    if entry['op'] == 'D':
+        cursor.execute(f"DELETE FROM {table} WHERE {where}", list(pk.values()))
+        return
+    data = json.loads(entry['data'])
+    if entry['op'] == 'U' and any(data.get(name) != value for name, value in pk.items()):
+        cursor.execute(f"DELETE FROM {table} WHERE {where}", list(pk.values()))
+    columns = list(data)
+    cursor.execute(
+        f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        [data[name] for name in columns]
     )
+
+
+class JournalShipper:
+    """انتقال ژورنال تغییرات به یک پوشه دیگر (volume جدا)
     
-    if not result:
-        return jsonify({'success': False, 'message': 'محصول یافت نشد'})
+    محتوای پوشه:
+      base_<seq>.db       کپی کامل دیتابیس در شماره ترتیب seq
+      journal_<seq>.jsonl تغییرات بعد از همان base (فقط اضافه می‌شود)
+      standby.db          نسخه آماده که چند ثانیه از دیتابیس اصلی عقب است
+    """
     
-    product_id = result[0]['id']
-    stock = result[0]['stock']
+    def __init__(self, manager, directory=None, prune_rows=5000):
+        self.manager = manager
+        # مستأجرها نسخه آماده را کنار دیتابیس خودشان نگه می‌دارند
+        self.directory = directory or (STANDBY_DIR if manager.db_path == DB_PATH
+                                       else os.path.join(os.path.dirname(manager.db_path), 'standby'))
+        self.prune_rows = prune_rows
+        self.standby_path = os.path.join(self.directory, 'standby.db')
+        os.makedirs(self.directory, exist_ok=True)
     
-    if stock < quantity:
-        return jsonify({'success': False, 'message': f'موجودی کافی نیست ({stock} موجود)'})
+    def _path(self, kind, seq):
+        return os.path.join(self.directory, f"{kind}_{seq:012d}.{'db' if kind == 'base' else 'jsonl'}")
     
-    # محاسبه FIFO
-    cogs_unit, _ = db.calculate_fifo_cost(product_id, quantity)
-    if cogs_unit is None:
-        return jsonify({'success': False, 'message': 'خطا در محاسبه بهای تمام شده'})
+    def list_bases(self):
+        return sorted(int(name[5:17]) for name in os.listdir(self.directory)
+                      if name.startswith('base_') and name.endswith('.db'))
     
-    outflow_date = datetime.date.today().isoformat()
-    db.add_outflow(product_id, center_id, quantity, sell_price, cogs_unit, commission, shipping, outflow_date, order_number)
+    def _primary_position(self, conn):
+        """(epoch، آخرین seq ثبت شده) دیتابیس اصلی"""
+        epoch = conn.execute("SELECT value FROM app_meta WHERE key = 'journal_epoch'").fetchone()
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_journal'").fetchone()
+        return (epoch[0] if epoch else 0), (seq[0] if seq else 0)
     
-    # گرفتن اطلاعات به‌روز شده
-    product = db.get_product(product_id)
+    def _standby_state(self):
+        if not os.path.exists(self.standby_path):
+            return None
+        conn = sqlite3.connect(self.standby_path)
+        try:
+            return dict(conn.execute("SELECT key, value FROM journal_state").fetchall())
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.close()
     
-    return jsonify({
-        'success': True,
-        'message': f'{quantity} عدد خارج شد',
-        'product': {
-            'id': product['id'],
-            'name': product['name'],
-            'stock': product['stock']
+    @staticmethod
+    def _set_position(cursor, seq):
+        """ثبت seq در نسخه کپی تا بعد از جایگزینی با دیتابیس اصلی شماره‌گذاری ادامه پیدا کند"""
+        cursor.execute("UPDATE journal_state SET value = ? WHERE key = 'seq'", (seq,))
+        if not cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'change_journal'", (seq,)).rowcount:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_journal', ?)", (seq,))
+    
+    def _start_timeline(self, old_epoch, fork):
+        """دیتابیس اصلی جایگزین شده: فایل‌های قبلی به پوشه تاریخچه می‌روند و base جدید ساخته می‌شود"""
+        if fork:
+            # بکاپ قدیمی‌تر از همین دیتابیس بازیابی شده؛ شاخه جدید epoch جدید می‌گیرد
+            self.manager.execute_query("UPDATE app_meta SET value = ? WHERE key = 'journal_epoch'",
+                                       (int.from_bytes(os.urandom(6), 'big'),))
+        history = os.path.join(self.directory, f"history_{old_epoch}")
+        os.makedirs(history, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.startswith(('base_', 'journal_')):
+                os.replace(os.path.join(self.directory, name), os.path.join(history, name))
+        return self.create_base()
+    
+    @staticmethod
+    def _copy_file(src_path, dst_path):
+        src = sqlite3.connect(src_path)
+        dst = sqlite3.connect(dst_path + '.tmp')
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        os.replace(dst_path + '.tmp', dst_path)
+    
+    def create_base(self):
+        """کپی کامل دیتابیس به عنوان نقطه شروع جدید ژورنال و نسخه آماده"""
+        tmp_path = os.path.join(self.directory, 'base.tmp')
+        src = sqlite3.connect(self.manager.db_path, timeout=DB_BUSY_TIMEOUT)
+        dst = sqlite3.connect(tmp_path)
+        try:
+            src.backup(dst)
+            epoch, seq = self._primary_position(dst)
+            # نسخه آماده فقط تغییرات ژورنال را می‌پذیرد؛ تریگرها در زمان بازیابی دوباره ساخته می‌شوند
+            for (name,) in dst.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+                dst.execute(f"DROP TRIGGER {name}")
+            dst.execute("DELETE FROM change_journal")
+            # بدون تریگرها نقاط کنترل دفتر و رول‌آپ قیمت با اعمال ژورنال به‌روز نمی‌شوند؛ بعد از بازیابی دوباره ساخته می‌شوند
+            dst.execute("DELETE FROM ledger_checkpoints")
+            dst.execute("DELETE FROM app_meta WHERE key = 'price_rollup_seeded'")
+            dst.execute("CREATE TABLE IF NOT EXISTS journal_state (key TEXT PRIMARY KEY, value INTEGER)")
+            dst.executemany("INSERT OR REPLACE INTO journal_state (key, value) VALUES (?, ?)",
+                            [('epoch', epoch), ('seq', seq), ('base_seq', seq)])
+            self._set_position(dst.cursor(), seq)
+            dst.commit()
+        finally:
+            dst.close()
+            src.close()
+        
+        os.replace(tmp_path, self._path('base', seq))
+        open(self._path('journal', seq), 'a').close()
+        self._copy_file(self._path('base', seq), self.standby_path)
+        return seq
+    
+    def ship_once(self, limit=5000):
+        """انتقال تغییرات جدید به فایل ژورنال و نسخه آماده؛ خروجی: تعداد رکوردهای منتقل شده"""
+        state = self._standby_state()
+        conn = self.manager.get_connection()
+        try:
+            epoch, primary_seq = self._primary_position(conn)
+            if state is None:
+                self.create_base()
+                return 0
+            if state.get('epoch') != epoch or state.get('seq', 0) > primary_seq:
+                self._start_timeline(state.get('epoch'), fork=state.get('epoch') == epoch)
+                return 0
+            entries = conn.execute(
+                "SELECT seq, tbl, op, pk, data FROM change_journal WHERE seq > ? ORDER BY seq LIMIT ?",
+                (state['seq'], limit)
+            ).fetchall()
+            if not entries:
+                return 0
+            if entries[0]['seq'] != state['seq'] + 1 and conn.execute(
+                    "SELECT 1 FROM change_journal WHERE seq <= ? LIMIT 1", (state['seq'],)).fetchone() is None:
+                # بخشی از ژورنال قبل از انتقال حذف شده؛ شروع دوباره از یک base جدید
+                self.create_base()
+                return 0
+        finally:
+            conn.close()
+        
+        # اول ثبت در فایل ژورنال (برای بازیابی نقطه‌ای)، بعد اعمال روی نسخه آماده
+        with open(self._path('journal', state['base_seq']), 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(dict(entry), ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        
+        standby = sqlite3.connect(self.standby_path)
+        try:
+            cursor = standby.cursor()
+            for entry in entries:
+                apply_journal_entry(cursor, entry)
+            self._set_position(cursor, entries[-1]['seq'])
+            standby.commit()
+        except sqlite3.OperationalError:
+            # تغییر ساختار جدول‌ها (migration) در دیتابیس اصلی؛ نسخه آماده از نو ساخته می‌شود
+            standby.rollback()
+            standby.close()
+            self.create_base()
+            return 0
+        finally:
+            standby.close()
+        
+        self._prune(entries[-1]['seq'])
+        return len(entries)
+    
+    def _prune(self, shipped_seq):
+        """حذف رکوردهای منتقل شده از دیتابیس اصلی (دسته‌ای تا نوشتن اضافه کم باشد)"""
+        count = self.manager.execute_query("SELECT COUNT(*) as cnt FROM change_journal WHERE seq <= ?", (shipped_seq,))
+        if count and count[0]['cnt'] >= self.prune_rows:
+            self.manager.execute_query("DELETE FROM change_journal WHERE seq <= ?", (shipped_seq,))
+    
+    def run(self, interval=2.0):
+        while True:
+            try:
+                shipped = self.ship_once()
+            except Exception as e:
+                print(f"Journal ship error: {e}")
+                shipped = 0
+            if not shipped:
+                time.sleep(interval)
+    
+    def status(self):
+        state = self._standby_state() or {}
+        conn = self.manager.get_connection()
+        try:
+            epoch, primary_seq = self._primary_position(conn)
+        finally:
+            conn.close()
+        return {
+            'primary_seq': primary_seq,
+            'standby_seq': state.get('seq'),
+            'lag': primary_seq - state['seq'] if state.get('epoch') == epoch else None,
+            'bases': self.list_bases(),
         }
-    })
+    
+    def restore(self, output_path, to_seq=None):
+        """بازیابی نقطه‌ای: آخرین base قبل از to_seq به اضافه ژورنال تا همان شماره"""
+        bases = [seq for seq in self.list_bases() if to_seq is None or seq <= to_seq]
+        if not bases:
+            raise ValueError("no base snapshot at or before the requested sequence")
+        base_seq = bases[-1]
+        self._copy_file(self._path('base', base_seq), output_path)
+        
+        applied = base_seq
+        conn = sqlite3.connect(output_path)
+        try:
+            cursor = conn.cursor()
+            journal_path = self._path('journal', base_seq)
+            if os.path.exists(journal_path):
+                with open(journal_path, encoding='utf-8') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        entry = json.loads(line)
+                        # تکرار احتمالی رکوردها (قطع شدن وسط انتقال) نادیده گرفته می‌شود
+                        if entry['seq'] <= applied:
+                            continue
+                        if to_seq is not None and entry['seq'] > to_seq:
+                            break
+                        apply_journal_entry(cursor, entry)
+                        applied = entry['seq']
+            self._set_position(cursor, applied)
+            conn.commit()
+        finally:
+            conn.close()
+        return applied
+
+
+@app.cli.command('journal-ship')
+@click.option('--interval', default=2.0, help='فاصله بررسی تغییرات جدید (ثانیه)')
+@click.option('--once', is_flag=True, help='فقط یک بار انتقال و خروج')
+@click.option('--directory', default=None, help='پوشه base ها، ژورنال و نسخه آماده')
+def journal_ship_command(interval, once, directory):
+    """انتقال پیوسته ژورنال تغییرات به نسخه آماده"""
+    shipper = JournalShipper(db, directory)
+    if once:
+        print(f"{shipper.ship_once()} change(s) shipped")
+    else:
+        shipper.run(interval)
+
+@app.cli.command('journal-base')
+@click.option('--directory', default=None)
+def journal_base_command(directory):
+    """ساخت base جدید (مثلاً شبانه) تا بازیابی نقطه‌ای ژورنال کوتاه‌تری بخواند"""
+    print(f"base created at seq {JournalShipper(db, directory).create_base()}")
+
+@app.cli.command('journal-restore')
+@click.argument('output')
+@click.option('--seq', type=int, default=None, help='شماره ترتیب مقصد (پیش‌فرض: آخرین)')
+@click.option('--directory', default=None)
+def journal_restore_command(output, seq, directory):
+    """بازیابی دیتابیس در یک شماره ترتیب مشخص به فایل OUTPUT"""
+    print(f"restored to seq {JournalShipper(db, directory).restore(output, seq)} -> {output}")
+
+@app.cli.command('journal-status')
+@click.option('--directory', default=None)
+def journal_status_command(directory):
+    print(json.dumps(JournalShipper(db, directory).status()))
 
 
 if __name__ == '__main__':
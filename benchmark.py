@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+بنچمارک صفحات لیست بزرگ: زمان تا اولین بایت، زمان کل، حجم ارسالی و حداکثر حافظه هر درخواست
+در دو حالت رندر کامل (render_template) و ارسال تدریجی (stream)، با و بدون فشرده‌سازی.
+
+    python benchmark.py --products 500 --rows 20000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+import datetime
+
+
+PAGES = ('/products', '/inflows', '/outflows', '/barcode/print')
+
+
+def seed(db_path, n_products, n_rows):
+    """داده آزمایشی مستقیم با SQL (سریع‌تر از مسیر نوشتن برنامه)"""
+    rnd = random.Random(1)
+    start = datetime.date.today() - datetime.timedelta(days=365)
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO products (id, name, color, barcode, stock) VALUES (?, ?, ?, ?, ?)",
+        [(i, f"کالا {i}", rnd.choice(['مشکی', 'سفید', 'آبی']), f"200{i:010d}", n_rows // n_products)
+         for i in range(1, n_products + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO inflows (product_id, quantity, remaining, buy_price, inflow_date, dollar_rate) VALUES (?, ?, ?, ?, ?, ?)",
+        [(rnd.randint(1, n_products), 10, 5, rnd.randint(100, 900) * 1000,
+          (start + datetime.timedelta(days=rnd.randint(0, 364))).isoformat(), 60000)
+         for _ in range(n_rows)]
+    )
+    conn.executemany(
+        """INSERT INTO outflows (product_id, center_id, quantity, sell_price, cogs_unit, commission_amount,
+           shipping_cost, outflow_date, order_number, is_returned, is_paid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0)""",
+        [(rnd.randint(1, n_products), rnd.randint(1, 3), 1, rnd.randint(200, 1500) * 1000, 300000, 10000, 5000,
+          (start + datetime.timedelta(days=rnd.randint(0, 364))).isoformat(), f"ORD{i}")
+         for i in range(n_rows)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def measure(client, path, encoding):
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = client.get(path, headers=headers, buffered=False)
+    first_byte = None
+    size = 0
+    for chunk in response.response:
+        if chunk and first_byte is None:
+            first_byte = time.perf_counter() - started
+        size += len(chunk)
+    response.close()
+    total = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'ttfb_ms': (first_byte if first_byte is not None else total) * 1000,
+        'total_ms': total * 1000,
+        'bytes': size,
+        'peak_kb': peak / 1024,
+        'encoding': response.headers.get('Content-Encoding', '-'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--pages', nargs='*', default=list(PAGES))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='warehouse_bench_')
+    os.environ['DB_PATH'] = os.path.join(workdir, 'warehouse.db')
+    import app as warehouse
+    seed(os.environ['DB_PATH'], args.products, args.rows)
+    client = warehouse.app.test_client()
+
+    print(f"{'page':<16}{'mode':<10}{'encoding':<10}{'ttfb ms':>10}{'total ms':>10}{'bytes':>12}{'peak KB':>10}")
+    for path in args.pages:
+        client.get(path).close()  # گرم کردن کش قالب‌ها
+        for stream in (False, True):
+            for encoding in (None, 'gzip', 'br'):
+                if encoding == 'br' and warehouse.brotli is None:
+                    continue
+                warehouse.app.config['STREAM_TEMPLATES'] = stream
+                warehouse.app.config['COMPRESS_RESPONSES'] = encoding is not None
+                result = measure(client, path, encoding)
+                print(f"{path:<16}{'stream' if stream else 'render':<10}{result['encoding']:<10}"
+                      f"{result['ttfb_ms']:>10.1f}{result['total_ms']:>10.1f}{result['bytes']:>12}{result['peak_kb']:>10.0f}")
+    warehouse.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+تنظیمات gunicorn (به صورت خودکار از پوشه جاری خوانده می‌شود)
+
+هر worker بعد از بارگذاری برنامه و قبل از پذیرفتن اولین درخواست گرم می‌شود:
+قالب‌ها از کش bytecode کامپایل و اتصال‌ها و جدول‌های پرخواندنی آماده می‌شوند.
+با WARM_UP=0 غیرفعال می‌شود.
+"""
+
+import os
+
+
+def post_worker_init(worker):
+    if os.environ.get('WARM_UP', '1') != '0':
+        from app import warm_up
+        warm_up()